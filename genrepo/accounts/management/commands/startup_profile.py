@@ -0,0 +1,54 @@
+# file genrepo/accounts/management/commands/startup_profile.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from genrepo.startup import ImportTimer, load_views, warm_up
+
+
+class Command(BaseCommand):
+    help = '''Report how long the modules loaded by the site take to import, slowest
+first, and optionally how long each startup warm-up step takes.  Times are inclusive
+of any modules imported in turn.'''
+
+    # don't load the models before timing the imports
+    requires_model_validation = False
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', '-l',
+            dest='limit', type='int', default=25,
+            help='''Number of modules to report (default: %default; 0 for all)'''),
+        make_option('--warm-up',
+            dest='warm_up', action='store_true', default=False,
+            help='''Also run and time the warm-up steps run by the WSGI script'''),
+        )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        with ImportTimer() as timer:
+            load_views()
+        print 'Imported %d modules in %.3fs' % (len(timer.times), time.time() - start)
+        for module, seconds in timer.slowest(options['limit']):
+            print '  %8.3fs  %s' % (seconds, module)
+
+        if options['warm_up']:
+            print '\nWarm-up steps:'
+            for name, seconds, error in warm_up():
+                print '  %8.3fs  %s%s' % (seconds, name,
+                                           ' (failed: %s)' % error if error else '')
@@ -21,8 +21,15 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import sys
+from mock import Mock, patch
+
+from django.conf import settings
 from django.test import TestCase
 
+from genrepo import startup
+from genrepo.startup import ImportTimer, warm_up
+
 class SimpleTest(TestCase):
     def test_basic_addition(self):
         """
@@ -30,6 +37,43 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class StartupTest(TestCase):
+
+    def test_import_timer(self):
+        # use a standard library module that is not normally loaded
+        sys.modules.pop('colorsys', None)
+        with ImportTimer() as timer:
+            import colorsys
+            # second import should not be recorded again
+            import colorsys
+        self.assert_('colorsys' in timer.times)
+        self.assertEqual(('colorsys', timer.times['colorsys']), timer.slowest(1)[0])
+        # import hook should be removed
+        import __builtin__
+        self.assertNotEqual(__builtin__.__import__.__name__, 'timed_import')
+
+    def test_warm_up(self):
+        ok = Mock()
+        failed = Mock(side_effect=Exception('fedora is down'))
+        steps = [('one', failed), ('two', ok)]
+        with patch.object(startup, 'WARM_UP_STEPS', new=steps):
+            results = warm_up()
+            # failing step should not prevent later steps
+            ok.assert_called_with()
+            self.assertEqual(['one', 'two'], [name for name, secs, err in results])
+            self.assertEqual('fedora is down', str(results[0][2]))
+            self.assertEqual(None, results[1][2])
+
+            # warm-up can be disabled
+            ok.reset_mock()
+            settings.STARTUP_WARM_UP = False
+            try:
+                self.assertEqual([], warm_up())
+            finally:
+                del settings.STARTUP_WARM_UP
+            self.assertEqual(0, ok.call_count)
+
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
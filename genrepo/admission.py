@@ -0,0 +1,222 @@
+# file genrepo/admission.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Admission control for views that pass requests on to Fedora and
+Djatoka, so that a single aggressive client cannot tie up the image
+server and every site worker.
+
+Views are grouped into classes (e.g., ``image``, ``download``), each
+configured in **ADMISSION_CONTROL**::
+
+    ADMISSION_CONTROL = {
+        'image': {'rate': 20, 'burst': 200, 'concurrency': 8, 'queue_timeout': 5},
+    }
+
+``rate`` and ``burst``
+    each client (a logged-in user, or otherwise an IP address) may make
+    ``burst`` requests at once, and ``rate`` requests per second after
+    that; further requests get a 429 response
+``concurrency``
+    at most this many requests of the class are handled at once, by all
+    processes together; additional requests wait up to ``queue_timeout``
+    seconds (default 0) for one to finish, and otherwise get a 503
+    response; for streamed responses (e.g., downloads), the request is
+    handled until the content has been sent, so ``slot_timeout`` (default
+    300 seconds) should be longer than the slowest expected download
+
+Refused requests include a ``Retry-After`` header.  Classes that are not
+configured are not limited.  All counters are kept in the shared cache,
+so the limits apply across processes as long as the cache is shared
+(e.g., memcached).'''
+
+from functools import wraps
+import hashlib
+import math
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+# how often a queued request checks for a free slot, in seconds
+POLL_INTERVAL = 0.05
+
+
+def client_id(request):
+    '''Identify the client making a request, for rate limits: the
+    username for logged-in users, otherwise the IP address.  If the site
+    is behind a proxy, set **ADMISSION_CLIENT_HEADER** to the request
+    header the proxy adds the address to (e.g., ``HTTP_X_FORWARDED_FOR``).'''
+    if request.user.is_authenticated():
+        return 'user:%s' % request.user.username
+    header = getattr(settings, 'ADMISSION_CLIENT_HEADER', None)
+    if header and request.META.get(header):
+        # the last address is the one added by the proxy; earlier ones
+        # are supplied by the client and can't be trusted
+        return 'ip:%s' % request.META[header].split(',')[-1].strip()
+    return 'ip:%s' % request.META.get('REMOTE_ADDR', '')
+
+
+def _counter_key(endpoint, client, window):
+    return 'genrepo:admission:%s:%s:%d' % (endpoint,
+        hashlib.md5(client.encode('utf-8')).hexdigest(), window)
+
+def check_rate(endpoint, client, rate, burst, now=None):
+    '''Count a request from a client, and check it against the client's
+    rate limit.  Requests are counted in fixed windows of ``burst /
+    rate`` seconds, and the limit applies to a window sliding over the
+    last two, which behaves like a token bucket but only needs atomic
+    increments in the cache.  Refused requests are counted too, so
+    clients that keep retrying stay limited.
+
+    :returns: 0 if the request is allowed, otherwise the number of
+        seconds to wait before trying again
+    '''
+    if now is None:
+        now = time.time()
+    length = float(burst) / rate
+    window = int(now // length)
+    elapsed = (now - window * length) / length
+
+    key = _counter_key(endpoint, client, window)
+    cache.add(key, 0, int(math.ceil(length * 2)) + 1)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # expired or evicted since it was added
+        cache.set(key, 1, int(math.ceil(length * 2)) + 1)
+        count = 1
+    previous = cache.get(_counter_key(endpoint, client, window - 1), 0)
+
+    excess = previous * (1 - elapsed) + count - burst
+    if excess <= 0:
+        return 0
+    if count > burst or not previous:
+        # wait for the next window
+        wait = (1 - elapsed) * length
+    else:
+        # wait until enough of the previous window has slid out
+        wait = excess * length / previous
+    return max(int(math.ceil(wait)), 1)
+
+
+def _slot_key(endpoint, slot):
+    return 'genrepo:admission:%s:slot:%d' % (endpoint, slot)
+
+def acquire_slot(endpoint, concurrency, queue_timeout=0, slot_timeout=300):
+    '''Acquire one of a limited number of slots for handling a request,
+    waiting up to ``queue_timeout`` seconds for one to be free.  Slots
+    expire after ``slot_timeout`` seconds, in case a process dies
+    without releasing them.
+
+    :returns: cache key for the slot, to be passed to :func:`release_slot`,
+        or None if no slot was available
+    '''
+    deadline = time.time() + queue_timeout
+    # start at a random slot, so that requests don't all compete for the first
+    first = random.randrange(concurrency)
+    while True:
+        for i in xrange(concurrency):
+            key = _slot_key(endpoint, (first + i) % concurrency)
+            if cache.add(key, 1, slot_timeout):
+                return key
+        if time.time() + POLL_INTERVAL > deadline:
+            return None
+        time.sleep(POLL_INTERVAL)
+
+def release_slot(key):
+    cache.delete(key)
+
+
+class _ReleasingContent(object):
+    '''Streamed response content that releases a concurrency slot once
+    it has been sent, or when the response is closed (e.g., if the
+    client disconnects).'''
+
+    def __init__(self, content, slot):
+        self.content = content
+        self.iterator = iter(content)
+        self.slot = slot
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self.iterator.next()
+        except StopIteration:
+            self.release()
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self.content, 'close'):
+                self.content.close()
+        finally:
+            self.release()
+
+    def release(self):
+        if self.slot is not None:
+            release_slot(self.slot)
+            self.slot = None
+
+
+def _refused(status, retry_after, message):
+    response = HttpResponse(message, mimetype='text/plain', status=status)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+def admission_control(endpoint):
+    '''View decorator to apply the limits configured in
+    **ADMISSION_CONTROL** for a class of views.'''
+    def decorator(view):
+        @wraps(view)
+        def limited(request, *args, **kwargs):
+            limits = getattr(settings, 'ADMISSION_CONTROL', {}).get(endpoint)
+            if not limits:
+                return view(request, *args, **kwargs)
+
+            if limits.get('rate'):
+                retry_after = check_rate(endpoint, client_id(request), limits['rate'],
+                                         limits.get('burst', limits['rate']))
+                if retry_after:
+                    return _refused(429, retry_after,
+                                    'Too many requests; please slow down.')
+
+            if not limits.get('concurrency'):
+                return view(request, *args, **kwargs)
+            queue_timeout = limits.get('queue_timeout', 0)
+            slot = acquire_slot(endpoint, limits['concurrency'], queue_timeout,
+                                limits.get('slot_timeout', 300))
+            if slot is None:
+                return _refused(503, max(int(math.ceil(queue_timeout)), 1),
+                                'The server is busy; please try again shortly.')
+            try:
+                response = view(request, *args, **kwargs)
+            except:
+                release_slot(slot)
+                raise
+            if getattr(response, '_is_string', True):
+                release_slot(slot)
+            else:
+                # content is an iterator, and most of the work happens while
+                # it is sent; keep the slot until then (the handler always
+                # closes the response)
+                response._container = _ReleasingContent(response._container, slot)
+            return response
+        return limited
+    return decorator
@@ -0,0 +1,193 @@
+# file genrepo/cache.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Shared cache helpers for information about Fedora objects.
+
+Cached values are never deleted directly.  Instead, each pid has a
+version counter in the cache, the current version is part of every
+key for that pid, and :func:`invalidate` increments the version when
+the object changes, so all older entries are simply never read again
+and expire on their own.
+
+Cached information is also partitioned by *access class*, since
+objects are retrieved with the credentials of the current user and
+what Fedora returns depends on its access policies.  Objects with the
+public access content model can be read by anyone, so information
+about them is cached once in a single public partition
+(:data:`PUBLIC`); everything else is kept separately for anonymous
+users, for each role listed in **CACHE_ROLE_GROUPS**, or for each
+individual user (see :func:`request_identity`).'''
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# version counters should outlive anything cached under them
+VERSION_TIMEOUT = 7 * 24 * 60 * 60
+
+
+def _version_key(pid):
+    return 'genrepo:version:%s' % hashlib.md5(pid).hexdigest()
+
+def _counter(key):
+    # current value of a version counter, initializing it if necessary.
+    # New counters start from the current time, so a counter that is
+    # evicted and recreated cannot repeat an earlier version.
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        # another process may have initialized it first
+        if not cache.add(key, version, VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+def _increment(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # no counter yet, so nothing can be cached under the current one;
+        # start a new counter anyway in case one is being created concurrently
+        cache.set(key, int(time.time() * 1000), VERSION_TIMEOUT)
+
+def object_version(pid):
+    'Current cache version for a pid.'
+    return _counter(_version_key(pid))
+
+def object_versions(pids):
+    '''Current cache versions for a list of pids, as a dictionary,
+    using a single cache request where possible.'''
+    keys = dict((_version_key(pid), pid) for pid in pids)
+    found = cache.get_many(keys.keys())
+    versions = dict((keys[key], version) for key, version in found.iteritems())
+    for pid in pids:
+        if pid not in versions:
+            versions[pid] = object_version(pid)
+    return versions
+
+def invalidate(pid):
+    '''Invalidate all cached information for a pid (e.g., after the
+    object has been created or modified).'''
+    _increment(_version_key(pid))
+
+# access class for information that is the same for everyone
+PUBLIC = 'public'
+
+def is_public(cmodels):
+    '''Check if an object with the specified content models can be read
+    by anyone, so that information about it can be cached in the
+    :data:`PUBLIC` partition.'''
+    # import here to avoid a circular import with the object models
+    from genrepo.collection.models import AccessibleObject
+    return AccessibleObject.PUBLIC_ACCESS_CMODEL in [str(cm) for cm in cmodels]
+
+def request_identity(request):
+    '''Access class used to partition cached information by the Fedora
+    credentials a request will be made with.  Since objects may be
+    restricted by XACML policy, restricted information is only shared
+    between users whose access is known to be the same:
+
+    * ``anonymous`` for requests without a logged-in user
+    * ``role:<groups>`` for users whose groups are all listed in
+      **CACHE_ROLE_GROUPS** (groups whose Fedora access is determined
+      by the role alone), shared by every user with the same groups
+    * ``user:<username>`` for anyone else
+    '''
+    if request is None or not request.user.is_authenticated():
+        return 'anonymous'
+    # group membership requires a database query; only look it up once per request
+    identity = getattr(request, '_cache_identity', None)
+    if identity is None:
+        identity = 'user:%s' % request.user.username
+        role_groups = getattr(settings, 'CACHE_ROLE_GROUPS', None)
+        if role_groups and not request.user.is_superuser:
+            groups = sorted(request.user.groups.values_list('name', flat=True))
+            if groups and set(groups) <= set(role_groups):
+                identity = 'role:%s' % ','.join(groups)
+        request._cache_identity = identity
+    return identity
+
+def cache_key(prefix, pid, identity, version=None):
+    '''Cache key for information about a pid, specific to the current
+    version of the object and the identity it was retrieved as.  Keys
+    are hashed so that they are always valid for memcached.'''
+    if version is None:
+        version = object_version(pid)
+    return 'genrepo:%s:%s' % (prefix,
+        hashlib.md5('%s %s %s' % (pid, version, identity.encode('utf-8'))).hexdigest())
+
+
+# negative results: objects that could not be retrieved
+NOT_FOUND = 'not found'
+DENIED = 'denied'
+_NEGATIVE_GENERATION_KEY = 'genrepo:negative-generation'
+
+def _negative_key(pid, identity, generation=None, version=None):
+    if generation is None:
+        generation = _counter(_NEGATIVE_GENERATION_KEY)
+    return cache_key('negative-%s' % generation, pid, identity, version)
+
+def get_negative(pid, identity):
+    '''Check for a recent negative result for a pid.
+
+    :returns: :data:`NOT_FOUND` or :data:`DENIED` if the object could
+        not be retrieved with the specified identity; None if there is
+        no cached negative result
+    '''
+    return get_negatives([pid], identity).get(pid)
+
+def get_negatives(pids, identity, versions=None):
+    '''Check for recent negative results for a list of pids, as for
+    :func:`get_negative`, with a single cache request.
+
+    :param versions: current cache versions of the pids, if already
+        known (see :func:`object_versions`)
+    :returns: dictionary of pid and :data:`NOT_FOUND` or :data:`DENIED`,
+        for the pids that have a cached negative result
+    '''
+    if versions is None:
+        versions = object_versions(pids)
+    generation = _counter(_NEGATIVE_GENERATION_KEY)
+    keys = dict((pid, (_negative_key(pid, identity, generation, versions[pid]),
+                       _negative_key(pid, PUBLIC, generation, versions[pid])))
+                for pid in pids)
+    found = cache.get_many([key for pid in pids for key in keys[pid]])
+    negatives = {}
+    for pid in pids:
+        status = found.get(keys[pid][0], found.get(keys[pid][1]))
+        if status is not None:
+            negatives[pid] = status
+    return negatives
+
+def set_negative(pid, identity, status):
+    '''Remember that a pid could not be retrieved with the specified
+    identity, so that repeated requests (e.g., crawlers following stale
+    links) can be answered without asking Fedora again.  An object that
+    does not exist does not exist for anyone, so :data:`NOT_FOUND` is
+    shared by all identities; :data:`DENIED` is not.  Negative results
+    are only kept briefly, since access policies can change outside the
+    site.'''
+    if status == NOT_FOUND:
+        identity = PUBLIC
+    cache.set(_negative_key(pid, identity), status,
+              getattr(settings, 'NEGATIVE_CACHE_TIMEOUT', 60))
+
+def clear_negative():
+    '''Discard all cached negative results (e.g., after access
+    policies have been changed).  Negative results for a single
+    object are also discarded by :func:`invalidate`.'''
+    _increment(_NEGATIVE_GENERATION_KEY)
@@ -0,0 +1,360 @@
+# file genrepo/collection/archive.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Streaming ZIP archives of the master files in a collection.
+
+The archive is written as it is sent: each entry's sizes and checksum
+follow its content (in a data descriptor) rather than preceding it, so
+nothing is staged to disk, and ZIP64 records are used where needed so
+archives and files over 4GB work.  Files that are already compressed
+(JPEG, MP3, video, ...) are stored as they are; others are deflated.
+
+Master files are fetched from Fedora by up to **ARCHIVE_WORKERS**
+threads (default 3) ahead of the one being sent, each buffering at most
+**ARCHIVE_BUFFER** chunks (default 4), so the download does not wait on
+Fedora between files but memory use stays small and fixed.  If reading
+a file fails part way through, the archive is still completed, with
+the file as far as it was read and a note listing the incomplete files.'''
+
+from collections import deque
+from datetime import datetime
+import httplib
+from itertools import islice
+import logging
+import Queue
+import re
+import struct
+import sys
+import threading
+import zlib
+
+from django.conf import settings
+
+from genrepo.file.models import object_types
+from genrepo.file.streaming import datastream_chunks
+
+logger = logging.getLogger(__name__)
+
+# sizes and offsets at or above this need ZIP64 records
+ZIP64_LIMIT = 0xFFFFFFFF
+# entry counts at or above this need ZIP64 records
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+# mimetypes (or prefixes) of content that deflate will not make smaller
+COMPRESSED_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/jp2',
+                    'audio/mpeg', 'audio/mp4', 'audio/ogg', 'video/',
+                    'application/zip', 'application/x-gzip', 'application/gzip',
+                    'application/x-bzip2', 'application/pdf')
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+
+def _field(value, limit, marker):
+    # value for a header field, or a marker that it is in a zip64 record instead
+    return marker if value >= limit else value
+
+
+def is_compressed(mimetype):
+    'Check if content of the specified mimetype is already compressed.'
+    return bool(mimetype) and mimetype.startswith(COMPRESSED_TYPES)
+
+
+def _dos_datetime(modified):
+    # date and time fields for a zip header
+    if modified is None:
+        modified = datetime.now()
+    if modified.year < 1980:
+        return 0, (1 << 5) | 1    # 1980-01-01
+    return (modified.hour << 11) | (modified.minute << 5) | (modified.second // 2), \
+           ((modified.year - 1980) << 9) | (modified.month << 5) | modified.day
+
+
+class ZipStream(object):
+    '''Writer for a ZIP archive that is generated in order, as it is sent.
+    Use :meth:`entry` for each file, then :meth:`close`; both return
+    generators of archive content.'''
+
+    def __init__(self):
+        self.offset = 0
+        # central directory information for each entry
+        self.entries = []
+
+    def entry(self, name, chunks, size=None, modified=None, compress=True):
+        '''Generator of the archive content for a single file.
+
+        :param name: file name within the archive
+        :param chunks: iterable of file content
+        :param size: size of the content, if known; used to determine
+            if ZIP64 records are needed
+        :param modified: :class:`~datetime.datetime` the file was last modified
+        :param compress: deflate the content, or store it as it is
+        '''
+        name = name.encode('utf-8') if isinstance(name, unicode) else name
+        method = ZIP_DEFLATED if compress else ZIP_STORED
+        # deflated content is never much bigger than the original
+        zip64 = size is None or size + size // 1000 + 1024 >= ZIP64_LIMIT
+        # sizes and checksum follow the content (bit 3); name is utf-8 (bit 11)
+        flags = 0x08 | 0x800
+        dostime, dosdate = _dos_datetime(modified)
+        version = 45 if zip64 else 20
+        if zip64:
+            # in a local header, the sizes must both be in the extra field
+            # (with bit 3, as zero) for the data descriptor to use 8-byte sizes
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            header_size = 0xFFFFFFFF
+        else:
+            extra = ''
+            header_size = 0
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags, method,
+                             dostime, dosdate, 0, header_size, header_size,
+                             len(name), len(extra)) + name + extra
+        offset = self.offset
+        yield self._sent(header)
+
+        crc = 0
+        file_size = compress_size = 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if compress else None
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            compress_size += len(chunk)
+            yield self._sent(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            yield self._sent(chunk)
+        crc &= 0xFFFFFFFF
+        if not zip64 and max(file_size, compress_size) >= ZIP64_LIMIT:
+            raise ValueError('%s is larger than its expected size (%d)' % (name, size))
+
+        if zip64:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, compress_size, file_size)
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, crc, compress_size, file_size)
+        yield self._sent(descriptor)
+        self.entries.append((name, flags, method, dostime, dosdate, crc,
+                             compress_size, file_size, offset))
+
+    def close(self):
+        'Generator of the central directory that ends the archive.'
+        start = self.offset
+        for name, flags, method, dostime, dosdate, crc, compress_size, \
+                file_size, offset in self.entries:
+            # values too big for the record go in a zip64 extra field, in this order
+            large = [value for value in (file_size, compress_size, offset)
+                     if value >= ZIP64_LIMIT]
+            if large:
+                extra = struct.pack('<HH', 1, 8 * len(large)) + \
+                        ''.join(struct.pack('<Q', value) for value in large)
+            else:
+                extra = ''
+            version = 45 if large else 20
+            record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50,
+                                 (3 << 8) | version, version, flags, method,
+                                 dostime, dosdate, crc,
+                                 _field(compress_size, ZIP64_LIMIT, 0xFFFFFFFF),
+                                 _field(file_size, ZIP64_LIMIT, 0xFFFFFFFF),
+                                 len(name), len(extra), 0, 0, 0, 0100644 << 16,
+                                 _field(offset, ZIP64_LIMIT, 0xFFFFFFFF))
+            yield self._sent(record + name + extra)
+
+        count = len(self.entries)
+        size = self.offset - start
+        end = ''
+        if count >= ZIP64_COUNT_LIMIT or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            end = struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                              count, count, size, start) + \
+                  struct.pack('<IIQI', 0x07064b50, 0, self.offset, 1)
+        count = _field(count, ZIP64_COUNT_LIMIT, 0xFFFF)
+        end += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count,
+                           _field(size, ZIP64_LIMIT, 0xFFFFFFFF),
+                           _field(start, ZIP64_LIMIT, 0xFFFFFFFF), 0)
+        yield self._sent(end)
+
+    def _sent(self, data):
+        self.offset += len(data)
+        return data
+
+
+# marks the end of a prefetched job
+_END = object()
+
+def _put(queue, item, cancelled):
+    # wait for room in the queue, unless the consumer has gone away
+    while not cancelled.is_set():
+        try:
+            queue.put(item, timeout=0.5)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _run(job, queue, cancelled):
+    items = None
+    try:
+        items = job()
+        for item in items:
+            if not _put(queue, (item, None), cancelled):
+                return
+    except Exception:
+        _put(queue, (None, sys.exc_info()), cancelled)
+        return
+    finally:
+        if hasattr(items, 'close'):
+            items.close()
+    _put(queue, (_END, None), cancelled)
+
+def _drain(queue):
+    while True:
+        item, error = queue.get()
+        if error is not None:
+            raise error[0], error[1], error[2]
+        if item is _END:
+            return
+        yield item
+
+def prefetch(jobs, workers=None, buffer=None):
+    '''Run jobs ahead of their consumer, in order.
+
+    :param jobs: iterable of functions that return iterables
+    :param workers: number of jobs to run at once; defaults to
+        **ARCHIVE_WORKERS** (3)
+    :param buffer: number of items each job may produce before they are
+        consumed; defaults to **ARCHIVE_BUFFER** (4)
+    :returns: generator of iterators over the items from each job, which
+        must each be consumed before the next is requested
+    '''
+    if workers is None:
+        workers = getattr(settings, 'ARCHIVE_WORKERS', 3)
+    if buffer is None:
+        buffer = getattr(settings, 'ARCHIVE_BUFFER', 4)
+    jobs = iter(jobs)
+    pending = deque()
+    cancelled = threading.Event()
+
+    def start():
+        for job in jobs:
+            queue = Queue.Queue(buffer)
+            thread = threading.Thread(target=_run, args=(job, queue, cancelled))
+            thread.daemon = True
+            thread.start()
+            pending.append(queue)
+            return True
+        return False
+
+    try:
+        while len(pending) < workers and start():
+            pass
+        while pending:
+            queue = pending.popleft()
+            start()
+            yield _drain(queue)
+    finally:
+        # stop any jobs still running, e.g. if the download was abandoned
+        cancelled.set()
+
+
+def master_file(pid, repo, objtype):
+    '''Job for :func:`prefetch` that produces a dictionary of information
+    about the master file of an object (name, size, mimetype and
+    modified), followed by its content in chunks; or nothing, if the
+    object has no master file that can be read.'''
+    def fetch():
+        obj = repo.get_object(pid, type=objtype)
+        try:
+            master = getattr(obj, 'master', None)
+            if master is None or not master.exists:
+                return
+            info = {'name': master.label or pid.replace(':', '-'), 'size': master.size,
+                    'mimetype': master.mimetype, 'modified': master.created}
+        except (IOError, httplib.HTTPException) as err:
+            # includes RequestFailed and BackendUnavailable
+            logger.warn('Not adding %s to archive: %s' % (pid, err))
+            return
+        yield info
+        for chunk in datastream_chunks(obj, master.id):
+            yield chunk
+    return fetch
+
+def master_files(pids, repo, batch_size=None):
+    '''Generator of :func:`master_file` jobs for a sequence of pids, with
+    object types determined for ``batch_size`` objects at a time.'''
+    if batch_size is None:
+        batch_size = getattr(settings, 'EXPORT_BATCH_SIZE', 50)
+    pids = iter(pids)
+    batch = list(islice(pids, batch_size))
+    while batch:
+        types = object_types.for_pids(batch, repo)
+        for pid in batch:
+            yield master_file(pid, repo, types[pid])
+        batch = list(islice(pids, batch_size))
+
+
+def _unique_name(name, used):
+    # file name safe to extract, not already used in the archive
+    name = re.sub(r'[/\\]', '_', name).lstrip('.') or 'file'
+    if name in used:
+        base, dot, ext = name.rpartition('.')
+        if not base:
+            base, dot, ext = name, '', ''
+        i = 2
+        while '%s (%d)%s%s' % (base, i, dot, ext) in used:
+            i += 1
+        name = '%s (%d)%s%s' % (base, i, dot, ext)
+    used.add(name)
+    return name
+
+def _until_failure(items, name, failed):
+    # content of an archive entry; if reading it fails part way through,
+    # the entry ends there so that the rest of the archive is still valid
+    try:
+        for item in items:
+            yield item
+    except Exception as err:
+        logger.error('Archive entry %s is incomplete: %s' % (name, err))
+        failed.append(name)
+
+def zip_archive(jobs, workers=None, buffer=None):
+    '''Generator of a ZIP archive of the files produced by a sequence of
+    :func:`master_file` jobs, fetched with :func:`prefetch`.  Files that
+    could not be read completely are listed in an ``INCOMPLETE.txt``
+    file at the end of the archive.'''
+    archive = ZipStream()
+    used = set()
+    failed = []
+    for items in prefetch(jobs, workers, buffer):
+        info = next(items, None)
+        if info is None:
+            continue
+        name = _unique_name(info['name'], used)
+        for data in archive.entry(name, _until_failure(items, name, failed),
+                                  info['size'], info['modified'],
+                                  compress=not is_compressed(info['mimetype'])):
+            yield data
+    if failed:
+        note = 'These files could not be read completely, and are incomplete ' + \
+               'in this archive:\n\n' + \
+               ''.join('%s\n' % (name.encode('utf-8') if isinstance(name, unicode) else name)
+                       for name in failed)
+        for data in archive.entry(_unique_name('INCOMPLETE.txt', used), [note], len(note)):
+            yield data
+    for data in archive.close():
+        yield data
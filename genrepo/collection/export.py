@@ -0,0 +1,143 @@
+# file genrepo/collection/export.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Streaming export of a collection inventory as CSV or JSON.
+
+Everything here is a generator: member pids are read from RISearch as
+they arrive, metadata is fetched in small concurrent batches, and rows
+are serialized one at a time, so memory use does not depend on the
+size of the collection.'''
+
+import csv
+from cStringIO import StringIO
+from itertools import islice
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from eulfedora.rdfns import relsext
+from eulfedora.util import RequestFailed
+
+from genrepo.file.models import init_by_cmodel, object_types
+from genrepo.summary import DC_FIELDS, DC_LIST_FIELDS
+from genrepo.util import risearch_pids
+
+logger = logging.getLogger(__name__)
+
+# inventory fields, in output order
+EXPORT_FIELDS = ['pid', 'label', 'title', 'creator', 'contributor', 'date',
+                 'description', 'subject', 'type', 'format', 'identifier',
+                 'language', 'publisher', 'rights', 'source', 'coverage',
+                 'relation', 'mimetype', 'size', 'oai_id']
+
+
+def member_pids(coll, repo):
+    '''Generator of the pids of all objects that belong to a
+    collection, streamed from RISearch as the results arrive.'''
+    query = 'select ?item where { ?item <%s> <%s> }' % \
+            (relsext.isMemberOfCollection, coll.uri)
+    return risearch_pids(repo, query)
+
+
+def object_row(pid, repo, objtype=None):
+    '''Inventory information for a single object, as a dictionary
+    keyed on :data:`EXPORT_FIELDS`.  If the object type is not
+    specified, it is determined from the object's content models.'''
+    if objtype is None:
+        obj = init_by_cmodel(pid, repo=repo)
+    else:
+        obj = repo.get_object(pid, type=objtype)
+    dc = obj.dc.content
+    row = {'pid': pid, 'label': obj.label}
+    for field in DC_FIELDS:
+        row[field] = getattr(dc, field)
+    # repeating fields are exported as a single value joined by '; '
+    for field in DC_LIST_FIELDS:
+        row[field] = '; '.join(getattr(dc, '%s_list' % field))
+    if obj.master.exists:
+        row['mimetype'] = obj.master.mimetype
+        row['size'] = obj.master.size
+    row['oai_id'] = obj.oai_id
+    return row
+
+def _export_row(pid, repo, objtype):
+    # objects that can't be read (e.g., not accessible) are left out,
+    # rather than ending the export part way through
+    try:
+        return object_row(pid, repo, objtype)
+    except RequestFailed as err:
+        logger.warn('Not exporting %s: %s' % (pid, err))
+
+def export_rows(pids, repo, batch_size=None, workers=None):
+    '''Generator of inventory rows for a sequence of pids.  Metadata
+    is retrieved for ``batch_size`` objects at a time using a pool of
+    ``workers`` threads, with the object types for each batch
+    determined by a single Resource Index query; rows are returned in
+    the same order as the pids.  Objects that can't be read are skipped.'''
+    if batch_size is None:
+        batch_size = getattr(settings, 'EXPORT_BATCH_SIZE', 50)
+    if workers is None:
+        workers = getattr(settings, 'EXPORT_WORKERS', 5)
+
+    pids = iter(pids)
+    pool = ThreadPool(workers)
+    try:
+        batch = list(islice(pids, batch_size))
+        while batch:
+            types = object_types.for_pids(batch, repo)
+            for row in pool.map(lambda pid: _export_row(pid, repo, types[pid]), batch):
+                if row is not None:
+                    yield row
+            batch = list(islice(pids, batch_size))
+    finally:
+        pool.terminate()
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def csv_export(rows):
+    'Serialize inventory rows as CSV, one line at a time.'
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_FIELDS)
+    yield buf.getvalue()
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow([_encode(row.get(field)) for field in EXPORT_FIELDS])
+        yield buf.getvalue()
+
+def json_export(rows):
+    'Serialize inventory rows as a JSON list, one object at a time.'
+    yield '['
+    separator = '\n'
+    for row in rows:
+        yield separator + json.dumps(row)
+        separator = ',\n'
+    yield '\n]\n'
+
+# supported export formats: serializer and mimetype
+EXPORT_FORMATS = {
+    'csv': (csv_export, 'text/csv'),
+    'json': (json_export, 'application/json'),
+}
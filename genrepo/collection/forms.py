@@ -16,9 +16,25 @@
 
 from django import forms
 
+from eulcommon.djangoextras.formfields import DynamicChoiceField
 from eulxml.xmlmap.dc import DublinCore
 from eulxml.forms import XmlObjectForm
 
+from genrepo.collection.models import CollectionNode, CollectionClosure
+
+def _parent_options(exclude=()):
+    # parent collection options from the local collection index
+    return [('', '')] + [(node.pid, node.label or node.pid)
+                         for node in CollectionNode.objects.all()
+                         if node.pid not in exclude]
+
+def _self_and_descendants(pid):
+    # pids that can't be the parent of a collection without making a cycle
+    pids = set(CollectionClosure.objects.filter(ancestor__pid=pid) \
+                                        .values_list('descendant__pid', flat=True))
+    pids.add(pid)
+    return pids
+
 class CollectionDCEditForm(XmlObjectForm):
     """Form to edit
     :class:`~genrepo.collection.models.CollectionObject` metadata."""
@@ -35,12 +51,30 @@ class CollectionDCEditForm(XmlObjectForm):
             ': can be used to indicate hierarchy (everything in OAI set a:b is also in set a).')
     oai_set_name = forms.CharField(required=False,
          help_text='One-line description of the OAI set (will be included in OAI ListSets result).')
+    parent = DynamicChoiceField(choices=_parent_options, required=False,
+        help_text='Collection this collection belongs to, if it is not implied by ' +
+            'the OAI set identifier. (optional)')
 
     
     class Meta:
         model = DublinCore
         fields = ['title', 'description']
 
+    def __init__(self, *args, **kwargs):
+        # pid of the collection being edited, if any; it and the
+        # collections below it can't be its parent
+        pid = kwargs.pop('pid', None)
+        super(CollectionDCEditForm, self).__init__(*args, **kwargs)
+        self.excluded_parents = _self_and_descendants(pid) if pid else set()
+        self.fields['parent'].choices = lambda: _parent_options(self.excluded_parents)
+
+    def clean_parent(self):
+        parent = self.cleaned_data.get('parent')
+        if parent and parent in self.excluded_parents:
+            raise forms.ValidationError('A collection can\'t belong to itself or to a ' +
+                                        'collection it contains.')
+        return parent
+
 
     def clean(self):
         # oai set & set name are optional, but if either is entered the other is required
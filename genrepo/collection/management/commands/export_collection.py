@@ -0,0 +1,80 @@
+# file genrepo/collection/management/commands/export_collection.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from getpass import getpass
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from genrepo.fedora import Repository
+
+from genrepo.collection.export import EXPORT_FORMATS, export_rows, member_pids
+from genrepo.collection.models import CollectionObject
+
+
+class Command(BaseCommand):
+    def get_password_option(option, opt, value, parser):
+        setattr(parser.values, option.dest, getpass())
+
+    help = '''Export an inventory of the items in a collection (pid, label, Dublin Core,
+master file mimetype and size, OAI id) as CSV or JSON.'''
+    args = 'collection-pid'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--username', '-u',
+            dest='username',
+            action='store',
+            help='''Username to connect to fedora'''),
+        make_option('--password',
+            dest='password',
+            action='callback', callback=get_password_option,
+            help='''Prompt for password required when username used'''),
+        make_option('--format', '-f',
+            dest='format', default='csv', choices=EXPORT_FORMATS.keys(),
+            help='''Export format: %s (default: %%default)''' % \
+                 ', '.join(EXPORT_FORMATS.keys())),
+        make_option('--output', '-o',
+            dest='output',
+            help='''File to write the export to (default: standard output)'''),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Please specify a single collection pid')
+
+        repo_args = {}
+        if options.get('username') is not None:
+            repo_args['username'] = options.get('username')
+        if options.get('password') is not None:
+            repo_args['password'] = options.get('password')
+        repo = Repository(**repo_args)
+
+        coll = repo.get_object(args[0], type=CollectionObject)
+        if not coll.exists:
+            raise CommandError('Collection %s not found' % args[0])
+
+        serialize = EXPORT_FORMATS[options['format']][0]
+        if options.get('output'):
+            out = open(options['output'], 'w')
+        else:
+            out = sys.stdout
+        try:
+            for chunk in serialize(export_rows(member_pids(coll, repo), repo)):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,42 @@
+# file genrepo/collection/management/commands/rebuild_collection_index.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from django.core.management.base import BaseCommand
+
+from genrepo.collection.models import CollectionObject, CollectionNode
+from genrepo.util import accessible
+
+
+class Command(BaseCommand):
+    help = '''Regenerate the local collection hierarchy index from the collections
+currently in Fedora.'''
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        pids = []
+        for coll in accessible(CollectionObject.all()):
+            CollectionNode.objects.update_node(coll)
+            pids.append(coll.pid)
+        # remove any collections that are no longer in the repository
+        removed = CollectionNode.objects.exclude(pid__in=pids)
+        if verbosity > 1 and removed.count():
+            print 'Removing %d collections no longer in Fedora' % removed.count()
+        removed.delete()
+        CollectionNode.objects.rebuild_closure()
+
+        if verbosity:
+            print 'Indexed %d collections' % len(pids)
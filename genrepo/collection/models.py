@@ -14,15 +14,22 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from rdflib import Literal
+from rdflib import Literal, URIRef
 
 from django.conf import settings
-from django.db.models import Model
+from django.db import transaction
+from django.db.models import Model, Manager, CharField, ForeignKey, \
+     PositiveIntegerField, SET_NULL
 
-from eulfedora.server import Repository
+from genrepo.fedora import Repository
 from eulfedora.models import DigitalObject
 from eulfedora.rdfns import relsext, oai
 
+from genrepo.cache import invalidate
+from genrepo.pids import next_pid
+from genrepo.rels import RelsExtReader
+from genrepo.util import risearch_pids
+
 class AccessibleObject(DigitalObject):
     """A place-holder Fedora Object for auto-generating a PublicAccess
     content model which will be used for Fedora XACML access controls.
@@ -42,7 +49,7 @@ class Collection(Model):
         )
 
 
-class CollectionObject(DigitalObject):
+class CollectionObject(RelsExtReader, DigitalObject):
     """A Fedora CollectionObject.  Inherits the standard Dublin Core
     and RELS-EXT datastreams from
     :class:`~eulcore.fedora.models.DigitalObject`, and adds a content
@@ -57,6 +64,10 @@ class CollectionObject(DigitalObject):
         # dynamic property so it will always get current setting (e.g., if changed for tests)
         return getattr(settings, 'FEDORA_PIDSPACE', None)
 
+    def get_default_pid(self):
+        # use pids reserved in advance, instead of asking fedora for each one
+        return next_pid(self)
+
     @staticmethod
     def all():
         """
@@ -71,19 +82,21 @@ class CollectionObject(DigitalObject):
     @property
     def members(self):
         '''Return all Fedora objects in the repository that are related to the current
-        collection via isMemberOfCollection.'''
-        # FIXME: loses repo permissions/credentials here... 
-        repo = Repository()
+        collection via isMemberOfCollection, initialized as the appropriate
+        type based on their content models (determined with a single query).
+        Objects are accessed with the same credentials as the collection.'''
+        # import here to avoid a circular import with the file models
+        from genrepo.file.models import init_by_cmodels
+        repo = Repository(username=self.api.opener.username,
+                          password=self.api.opener.password)
         members = repo.risearch.get_subjects(relsext.isMemberOfCollection, self.uri)
-        # for now, just returning as generic DigitalObject instances
-        for pid in members:
-            # TODO: should we restrict to accessible objects only?
-            # (requires passing correct credentials through...)
-            yield repo.get_object(pid)
+        pids = [unicode(pid).replace('info:fedora/', '') for pid in members]
+        # TODO: should we restrict to accessible objects only?
+        return init_by_cmodels(pids, repo=repo)
 
     # OAI set identifier (if this collection is also an OAI set)
     def _get_oai_set(self):
-        return self.rels_ext.content.value(subject=self.uriref, predicate=oai.setSpec)
+        return self.rels.oai_set
     def _set_oai_set(self, value):
 	# if value is None, remove the value
         if value is None:
@@ -92,12 +105,12 @@ class CollectionObject(DigitalObject):
             # update/replace any oai item id (only one allowed)
             self.rels_ext.content.set((self.uriref, oai.setSpec, Literal(value)))
     def _del_oai_set(self):
-        self.rels_ext.content.remove((self.uriref, oai.setSpec, self.oai_set))
+        self.rels_ext.content.remove((self.uriref, oai.setSpec, None))
     oai_set = property(_get_oai_set, _set_oai_set, _del_oai_set)
     
     # OAI set label (if this collection is also an OAI set)
     def _get_oai_setlabel(self):
-        return self.rels_ext.content.value(subject=self.uriref, predicate=oai.setName)
+        return self.rels.oai_setlabel
     def _set_oai_setlabel(self, value):
 	# if value is None, remove the value
         if value is None:
@@ -106,7 +119,150 @@ class CollectionObject(DigitalObject):
             # update/replace any oai item id (only one allowed)
             self.rels_ext.content.set((self.uriref, oai.setName, Literal(value)))
     def _del_oai_setlabel(self):
-        self.rels_ext.content.remove((self.uriref, oai.setName, self.oai_setlabel)) 
+        self.rels_ext.content.remove((self.uriref, oai.setName, None))
     oai_setlabel = property(_get_oai_setlabel, _set_oai_setlabel, _del_oai_setlabel)
 
+    # parent collection (optional; otherwise implied by OAI set hierarchy)
+    def _get_parent(self):
+        return self.rels.parent
+    def _set_parent(self, value):
+        # if value is None, remove the value
+        if value is None:
+            self._del_parent()
+        else:
+            if not value.startswith('info:fedora/'):
+                value = 'info:fedora/' + value
+            # update/replace any parent collection (only one allowed)
+            self.rels_ext.content.set((self.uriref, relsext.isSubsetOf, URIRef(value)))
+    def _del_parent(self):
+        self.rels_ext.content.remove((self.uriref, relsext.isSubsetOf, None))
+    parent = property(_get_parent, _set_parent, _del_parent)
+    "pid of the parent :class:`CollectionObject`, if any"
+
+    def save(self, logMessage=None):
+        result = super(CollectionObject, self).save(logMessage)
+        invalidate(self.pid)
+        # keep the local collection hierarchy index current
+        CollectionNode.objects.update_for(self)
+        return result
+
+
+class CollectionNodeManager(Manager):
+
+    def update_for(self, coll):
+        '''Add or update the index entry for a
+        :class:`CollectionObject` and recalculate the hierarchy.'''
+        self.update_node(coll)
+        self.rebuild_closure()
+
+    def update_node(self, coll):
+        'Add or update the index entry for a collection, without recalculating the hierarchy.'
+        node, created = self.get_or_create(pid=coll.pid)
+        node.label = coll.label or ''
+        node.oai_set = coll.oai_set or ''
+        node.parent_pid = coll.parent or ''
+        node.save()
+        return node
+
+    @transaction.commit_on_success
+    def rebuild_closure(self):
+        '''Recalculate the effective parent of every indexed collection
+        and regenerate the ancestor/descendant closure table.
+
+        A collection's parent is the collection explicitly set as its
+        parent, if any; otherwise, the collection with the longest OAI
+        setSpec that is a ``:``-delimited prefix of its own setSpec.
+        The number of collections is small, so the whole table is
+        regenerated rather than patched.'''
+        nodes = dict((node.pid, node) for node in self.all())
+        by_set = dict((node.oai_set, node) for node in nodes.itervalues() if node.oai_set)
+
+        parents = {}
+        for node in nodes.itervalues():
+            parent = None
+            if node.parent_pid in nodes:
+                parent = nodes[node.parent_pid]
+            elif node.oai_set:
+                setspec = node.oai_set.split(':')[:-1]
+                while setspec and parent is None:
+                    parent = by_set.get(':'.join(setspec))
+                    setspec.pop()
+            parents[node.pid] = parent
+            parent_id = parent.id if parent is not None else None
+            if parent_id != node.parent_id:
+                node.parent = parent
+                node.save()
+
+        CollectionClosure.objects.all().delete()
+        for node in nodes.itervalues():
+            # every collection is its own ancestor at depth 0
+            ancestor, depth, seen = node, 0, set()
+            while ancestor is not None and ancestor.pid not in seen:
+                seen.add(ancestor.pid)
+                CollectionClosure.objects.create(ancestor=ancestor, descendant=node,
+                                                 depth=depth)
+                ancestor = parents[ancestor.pid]
+                depth += 1
+
+
+class CollectionNode(Model):
+    '''Local index of collection objects and their hierarchy, so that
+    nested collections and OAI set trees can be queried without
+    recursive RISearch calls.  Kept current when a
+    :class:`CollectionObject` is saved; can be regenerated from Fedora
+    with the ``rebuild_collection_index`` command.'''
+    pid = CharField(max_length=255, unique=True)
+    label = CharField(max_length=255, blank=True)
+    oai_set = CharField(max_length=255, blank=True, db_index=True)
+    parent_pid = CharField(max_length=255, blank=True,
+        help_text='parent collection explicitly set in RELS-EXT')
+    parent = ForeignKey('self', null=True, blank=True, related_name='children',
+        on_delete=SET_NULL, help_text='effective parent, explicit or implied by OAI set hierarchy')
+
+    objects = CollectionNodeManager()
+
+    class Meta:
+        ordering = ['label']
+
+    def __unicode__(self):
+        return self.label or self.pid
+
+    @property
+    def uri(self):
+        return 'info:fedora/' + self.pid
+
+    def ancestors(self):
+        '''All collections above this one, starting from the top (e.g.,
+        for a breadcrumb).'''
+        return CollectionNode.objects.filter(descendant_links__descendant=self,
+                                             descendant_links__depth__gt=0) \
+                                     .order_by('-descendant_links__depth')
+
+    def descendants(self, include_self=False):
+        'All collections nested anywhere below this one.'
+        min_depth = 0 if include_self else 1
+        return CollectionNode.objects.filter(ancestor_links__ancestor=self,
+                                             ancestor_links__depth__gte=min_depth)
+
+    def item_pids(self, repo):
+        '''Generator of pids for all items in this collection or any
+        collection below it, using a single RISearch query.'''
+        colls = ' || '.join('?coll = <%s>' % node.uri
+                            for node in self.descendants(include_self=True))
+        query = 'select ?item where { ?item <%s> ?coll . filter (%s) }' % \
+                (relsext.isMemberOfCollection, colls)
+        return risearch_pids(repo, query)
+
+
+class CollectionClosure(Model):
+    '''Closure table for :class:`CollectionNode`: one row for every
+    ancestor/descendant pair (including each collection paired with
+    itself at depth 0).'''
+    ancestor = ForeignKey(CollectionNode, related_name='descendant_links')
+    descendant = ForeignKey(CollectionNode, related_name='ancestor_links')
+    depth = PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+
 
@@ -14,8 +14,15 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from contextlib import contextmanager
+from cStringIO import StringIO
+from datetime import datetime
+import json
 from mock import patch, Mock
 import re
+import threading
+import time
+import zipfile
 
 from django import forms
 from django.conf import settings
@@ -29,9 +36,12 @@ from eulfedora.rdfns import relsext
 from eulfedora.util import RequestFailed, PermissionDenied
 from eulxml.xmlmap.dc import DublinCore
 
+from genrepo import util
+from genrepo.collection import archive, export
 from genrepo.collection.forms import CollectionDCEditForm
-from genrepo.collection.models import CollectionObject
-from genrepo.file.models import FileObject
+from genrepo.collection.models import CollectionObject, CollectionNode
+from genrepo.summary import ObjectSummary
+from genrepo.file.models import FileObject, ImageObject
 
 # users defined in users.json fixture
 ADMIN_CREDENTIALS = {'username': 'repoeditor', 'password': 'r3p03d'} 
@@ -319,8 +329,8 @@ class CollectionViewsTest(TestCase):
         
 
         # check for object display
-        self.assert_(isinstance(response.context['obj'], CollectionObject),
-                     'collection object should be set in response context')
+        self.assert_(isinstance(response.context['obj'], ObjectSummary),
+                     'collection summary should be set in response context')
         self.assertEqual(self.obj.pid, response.context['obj'].pid,
                          'correct collection object should be set in response context')
 
@@ -350,18 +360,16 @@ class CollectionViewsTest(TestCase):
 
     def test_view_members(self):
         # collection view should include brief listing of items that belong to the collection
-        # use mock objects to test collection member view
-        testcoll = Mock(spec=CollectionObject, name='MockCollectionObject')
+        # use mock summaries to test collection member view
+        testcoll = Mock(spec=ObjectSummary, name='MockCollectionSummary')
         testcoll.pid = 'coll:1'
-        testcoll.label.return_value = 'mock collection'
-        testcoll.exists = True
-        file1 = Mock(spec=FileObject, name='MockDigitalObject')
+        testcoll.label = 'mock collection'
+        file1 = Mock(spec=ObjectSummary, name='MockObjectSummary')
         file1.pid = 'file:1'
         file1.label = 'One Fish'
-        file2 = Mock(spec=FileObject, name='MockDigitalObject')
+        file2 = Mock(spec=ObjectSummary, name='MockObjectSummary')
         file2.pid = 'file:2'
         file2.label = 'Two Fish'
-        testcoll.members = (file1, file2)
 
         # django templates recognize Mock objects as callables; work around that
         # by setting the objects to return themselves when called
@@ -369,39 +377,39 @@ class CollectionViewsTest(TestCase):
         file1.return_value = file1
         file2.return_value = file2
 
-        # patch the repository class to return the mock object instead of a real one
-	with patch.object(Repository, 'get_object', new=Mock(return_value=testcoll)):
-            response = self.client.get(self.view_coll_url)
-            code = response.status_code
-            expected = 200
-            self.assertEqual(code, expected,
+        # patch the summary lookups to return the mock objects instead of real ones
+        with patch('genrepo.collection.views.get_summary', new=Mock(return_value=testcoll)):
+            with patch('genrepo.collection.views.get_summaries',
+                       new=Mock(return_value=[file1, file2])):
+                with patch('genrepo.collection.views.member_pids'):
+                    response = self.client.get(self.view_coll_url)
+                    code = response.status_code
+                    expected = 200
+                    self.assertEqual(code, expected,
                              'Expected %s but returned %s for %s as AnonymousUser'
                              % (expected, code, self.view_coll_url))
 
-            # FIXME: works in django 1.2.5, not in django 1.3
-            
-            # member items should be listed
-            self.assertContains(response, file1.label,
-                msg_prefix='collection view should include first member item label')
-            self.assertContains(response, file2.label,
-                msg_prefix='collection view should include second member item label')
-            self.assertContains(response, reverse('file:view', kwargs={'pid': file1.pid}),
-                msg_prefix='collection view should include link to view first member item')
-            self.assertContains(response, reverse('file:view', kwargs={'pid': file2.pid}),
-                msg_prefix='collection view should include link to view second member item')
-            self.assertNotContains(response, reverse('file:edit', kwargs={'pid': file1.pid}),
-                msg_prefix='collection view should include link to edit first member item (not repo editor)')
-            self.assertNotContains(response, reverse('file:edit', kwargs={'pid': file2.pid}),
-                msg_prefix='collection view should include link to edit second member item (not repo editor)')
-
-        # log in as repo editor - should also see item edit links
-        self.client.post(settings.LOGIN_URL, ADMIN_CREDENTIALS)
-	with patch.object(Repository, 'get_object', new=Mock(return_value=testcoll)):
-            response = self.client.get(self.view_coll_url)
-            self.assertContains(response, reverse('file:edit', kwargs={'pid': file1.pid}),
-                msg_prefix='collection view should include link to edit first member item (repo editor)')
-            self.assertContains(response, reverse('file:edit', kwargs={'pid': file2.pid}),
-                msg_prefix='collection view should include link to edit second member item (repo editor)')
+                    # member items should be listed
+                    self.assertContains(response, file1.label,
+                        msg_prefix='collection view should include first member item label')
+                    self.assertContains(response, file2.label,
+                        msg_prefix='collection view should include second member item label')
+                    self.assertContains(response, reverse('file:view', kwargs={'pid': file1.pid}),
+                        msg_prefix='collection view should include link to view first member item')
+                    self.assertContains(response, reverse('file:view', kwargs={'pid': file2.pid}),
+                        msg_prefix='collection view should include link to view second member item')
+                    self.assertNotContains(response, reverse('file:edit', kwargs={'pid': file1.pid}),
+                        msg_prefix='collection view should include link to edit first member item (not repo editor)')
+                    self.assertNotContains(response, reverse('file:edit', kwargs={'pid': file2.pid}),
+                        msg_prefix='collection view should include link to edit second member item (not repo editor)')
+
+                    # log in as repo editor - should also see item edit links
+                    self.client.post(settings.LOGIN_URL, ADMIN_CREDENTIALS)
+                    response = self.client.get(self.view_coll_url)
+                    self.assertContains(response, reverse('file:edit', kwargs={'pid': file1.pid}),
+                        msg_prefix='collection view should include link to edit first member item (repo editor)')
+                    self.assertContains(response, reverse('file:edit', kwargs={'pid': file2.pid}),
+                        msg_prefix='collection view should include link to edit second member item (repo editor)')
 
 
     def test_list(self):
@@ -470,17 +478,23 @@ class CollectionObjectTest(TestCase):
         
     def test_members(self):
         # mock out risearch call
-        member_pids = ['pid:1', 'pid:2']
+        member_pids = ['info:fedora/pid:1', 'info:fedora/pid:2']
         mockri = Mock(name='MockRIsearch')
         mockri.get_subjects.return_value = member_pids
         with patch.object(Repository, 'risearch', new=mockri):
-            members = list(self.coll.members)
-            self.assertEqual(len(member_pids), len(members),
-                'collection members length should equal number of items returned by risearch call')
-            self.assert_(isinstance(members[0], DigitalObject),
-                'collection members should be instances of DigitalObject')
-            self.assert_(isinstance(members[1], DigitalObject),
-                'collection members should be instances of DigitalObject')
+            with patch('genrepo.file.models.object_types') as mocktypes:
+                mocktypes.for_pids.return_value = {'pid:1': ImageObject, 'pid:2': FileObject}
+                members = list(self.coll.members)
+                self.assertEqual(len(member_pids), len(members),
+                    'collection members length should equal number of items returned by risearch call')
+                self.assert_(isinstance(members[0], ImageObject),
+                    'collection members should be initialized by content model')
+                self.assert_(isinstance(members[1], FileObject),
+                    'collection members should be initialized by content model')
+                self.assertEqual('pid:1', members[0].pid)
+                # types should be determined with a single query
+                self.assertEqual(1, mocktypes.for_pids.call_count)
+                self.assertEqual(['pid:1', 'pid:2'], mocktypes.for_pids.call_args[0][0])
             mockri.get_subjects.assert_called_once_with(relsext.isMemberOfCollection,
                                                         self.coll.uri)
 
@@ -524,6 +538,67 @@ class CollectionObjectTest(TestCase):
         self.coll.oai_setlabel = None
         self.assert_('<oai:setName>' not in self.coll.rels_ext.content.serialize())
 
+    def test_set_parent(self):
+        # set
+        self.coll.parent = 'coll:parent'
+        self.assert_('info:fedora/coll:parent' in self.coll.rels_ext.content.serialize())
+        # get
+        self.assertEqual('coll:parent', self.coll.parent)
+        # set None - should be equivalent to delete
+        self.coll.parent = None
+        self.assertEqual(None, self.coll.parent)
+        self.assert_('coll:parent' not in self.coll.rels_ext.content.serialize())
+
+
+class CollectionHierarchyTest(TestCase):
+    'Tests for the local collection hierarchy index'
+
+    def _index(self, pid, oai_set=None, parent=None, label=None):
+        coll = Mock(spec=CollectionObject)
+        coll.pid, coll.oai_set, coll.parent = pid, oai_set, parent
+        coll.label = label or pid
+        CollectionNode.objects.update_for(coll)
+        return CollectionNode.objects.get(pid=pid)
+
+    def test_hierarchy(self):
+        # add the child first; parent should be found once it is indexed
+        self._index('coll:ab', oai_set='a:b')
+        self.assertEqual(None, CollectionNode.objects.get(pid='coll:ab').parent)
+        top = self._index('coll:a', oai_set='a')
+        abc = self._index('coll:abc', oai_set='a:b:c')
+        # explicit parent, no OAI set
+        nested = self._index('coll:nested', parent='coll:abc')
+        # setSpec whose immediate prefix is not a collection
+        axy = self._index('coll:axy', oai_set='a:x:y')
+
+        ab = CollectionNode.objects.get(pid='coll:ab')
+        self.assertEqual(top, ab.parent)
+        self.assertEqual(ab, abc.parent)
+        self.assertEqual(abc, CollectionNode.objects.get(pid='coll:nested').parent)
+        self.assertEqual(top, CollectionNode.objects.get(pid='coll:axy').parent)
+
+        self.assertEqual(['coll:a', 'coll:ab', 'coll:abc'],
+                         [n.pid for n in nested.ancestors()])
+        self.assertEqual([], list(top.ancestors()))
+        self.assertEqual(set(['coll:ab', 'coll:abc', 'coll:nested', 'coll:axy']),
+                         set(n.pid for n in top.descendants()))
+        self.assertEqual(set(['coll:abc', 'coll:nested']),
+                         set(n.pid for n in ab.descendants()))
+
+        # removing the explicit parent moves the collection to the top level
+        self._index('coll:nested')
+        self.assertEqual([], list(CollectionNode.objects.get(pid='coll:nested').ancestors()))
+
+    @patch('genrepo.collection.models.risearch_pids')
+    def test_item_pids(self, mockpids):
+        top = self._index('coll:a', oai_set='a')
+        self._index('coll:ab', oai_set='a:b')
+        top.item_pids(Mock())
+        query = mockpids.call_args[0][1]
+        # single query should include the collection and everything below it
+        self.assert_('?coll = <info:fedora/coll:a>' in query)
+        self.assert_('?coll = <info:fedora/coll:ab>' in query)
+        self.assert_(str(relsext.isMemberOfCollection) in query)
 
 
 class CollectionDCEditFormTest(TestCase):
@@ -537,3 +612,253 @@ class CollectionDCEditFormTest(TestCase):
         dcform.cleaned_data = {'oai_set': 'foo', 'oai_set_name': 'foo stuff'}
         # should not raise an exception
         self.assertEqual(dcform.cleaned_data, dcform.clean())
+
+    def test_parent_choices(self):
+        for pid, parent in (('coll:a', ''), ('coll:b', 'coll:a'), ('coll:c', 'coll:b'),
+                            ('coll:d', '')):
+            CollectionNode.objects.create(pid=pid, parent_pid=parent)
+        CollectionNode.objects.rebuild_closure()
+        dcform = CollectionDCEditForm(pid='coll:b')
+        # a collection and those below it can't be its parent
+        self.assertEqual(['', 'coll:a', 'coll:d'],
+                         [value for value, label in dcform.fields['parent'].choices])
+        dcform.cleaned_data = {'parent': 'coll:c'}
+        self.assertRaises(forms.ValidationError, dcform.clean_parent)
+        dcform.cleaned_data = {'parent': 'coll:b'}
+        self.assertRaises(forms.ValidationError, dcform.clean_parent)
+        dcform.cleaned_data = {'parent': 'coll:d'}
+        self.assertEqual('coll:d', dcform.clean_parent())
+        # any collection can be the parent of a new one
+        self.assertEqual(5, len(CollectionDCEditForm().fields['parent'].choices))
+
+
+class CollectionExportTest(TestCase):
+    'Tests for :mod:`genrepo.collection.export`'
+
+    rows = [{'pid': 'pid:1', 'label': u'One Fish', 'subject': 'fish; counting',
+             'mimetype': 'image/jpeg', 'size': 1024},
+            {'pid': 'pid:2', 'label': u'Two Fish \u2013 Red Fish', 'oai_id': 'oai:2'}]
+
+    def test_member_pids(self):
+        risearch_csv = '"item"\ninfo:fedora/pid:1\ninfo:fedora/pid:2\ninfo:fedora/pid:3\n'
+        @contextmanager
+        def mock_open(method, url):
+            yield StringIO(risearch_csv)
+        repo = Mock()
+        repo.risearch.open = mock_open
+        coll = CollectionObject(Mock(), 'coll:1')
+        # use a tiny read buffer to exercise lines split across reads
+        with patch.object(util, 'READ_SIZE', new=5):
+            self.assertEqual(['pid:1', 'pid:2', 'pid:3'],
+                             list(export.member_pids(coll, repo)))
+
+    @patch('genrepo.collection.export.object_types')
+    @patch('genrepo.collection.export.object_row')
+    def test_export_rows(self, mockrow, mocktypes):
+        mockrow.side_effect = lambda pid, repo, objtype: {'pid': pid, 'type': objtype}
+        mocktypes.for_pids.side_effect = lambda pids, repo: dict((pid, FileObject) for pid in pids)
+        pids = ['pid:%d' % i for i in range(10)]
+        rows = list(export.export_rows(iter(pids), Mock(), batch_size=3, workers=2))
+        self.assertEqual(pids, [row['pid'] for row in rows],
+            'export rows should be returned in the same order as pids')
+        self.assertEqual(FileObject, rows[0]['type'])
+        # object types should be looked up once per batch
+        self.assertEqual(4, mocktypes.for_pids.call_count)
+
+        # objects that can't be read are skipped
+        err_resp = Mock()
+        err_resp.status = 401
+        err_resp.reason = 'Unauthorized'
+        err_resp.read.return_value = ''
+        def row(pid, repo, objtype):
+            if pid == 'pid:4':
+                raise PermissionDenied(err_resp)
+            return {'pid': pid}
+        mockrow.side_effect = row
+        rows = list(export.export_rows(iter(pids), Mock(), batch_size=3, workers=2))
+        self.assertEqual([pid for pid in pids if pid != 'pid:4'], [row['pid'] for row in rows])
+
+    def test_csv_export(self):
+        output = ''.join(export.csv_export(iter(self.rows)))
+        lines = output.splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertEqual(','.join(export.EXPORT_FIELDS), lines[0])
+        self.assert_(lines[1].startswith('pid:1,One Fish,'))
+        self.assert_('fish; counting' in lines[1])
+        self.assert_('Two Fish \xe2\x80\x93 Red Fish' in lines[2],
+            'unicode values should be exported as utf-8')
+
+    def test_json_export(self):
+        output = ''.join(export.json_export(iter(self.rows)))
+        self.assertEqual(self.rows, json.loads(output))
+        self.assertEqual([], json.loads(''.join(export.json_export(iter([])))))
+
+    def test_export_view(self):
+        testcoll = Mock(spec=ObjectSummary, name='MockCollectionSummary')
+        export_url = reverse('collection:export', kwargs={'pid': 'coll:1'})
+        with patch('genrepo.collection.views.get_summary',
+                   new=Mock(return_value=testcoll)) as mocksummary:
+            with patch('genrepo.collection.views.member_pids'):
+                with patch('genrepo.collection.views.export_rows',
+                           new=Mock(return_value=iter(self.rows))):
+                    response = self.client.get(export_url, {'format': 'json'})
+                    self.assertEqual(200, response.status_code)
+                    self.assertEqual('application/json', response['Content-Type'])
+                    self.assertEqual('attachment; filename=coll-1.json',
+                                     response['Content-Disposition'])
+                    self.assertEqual(self.rows, json.loads(response.content))
+
+                # items in nested collections, from the hierarchy index
+                CollectionNode.objects.create(pid='coll:1')
+                with patch.object(CollectionNode, 'item_pids') as mockitems:
+                    with patch('genrepo.collection.views.export_rows') as mockrows:
+                        mockrows.return_value = iter([])
+                        self.client.get(export_url, {'nested': 1})
+                        self.assertEqual(mockitems.return_value, mockrows.call_args[0][0])
+
+            # unsupported format
+            response = self.client.get(export_url, {'format': 'xls'})
+            self.assertEqual(404, response.status_code)
+
+            # nonexistent collection
+            mocksummary.return_value = None
+            response = self.client.get(export_url)
+            self.assertEqual(404, response.status_code)
+
+
+class CollectionArchiveTest(TestCase):
+    'Tests for :mod:`genrepo.collection.archive`'
+
+    files = [('one.tif', ['II*\x00', 'a' * 5000, 'b' * 3], 'image/tiff'),
+             ('two.jpg', ['\xff\xd8jpeg data'], 'image/jpeg'),
+             (u'th\u0159ee.txt', [], 'text/plain')]
+
+    def _job(self, name, chunks, mimetype, delay=0):
+        def job():
+            time.sleep(delay)
+            yield {'name': name, 'size': sum(len(c) for c in chunks), 'mimetype': mimetype,
+                   'modified': datetime(2011, 6, 1, 12, 30, 10)}
+            for chunk in chunks:
+                yield chunk
+        return job
+
+    def _check(self, data):
+        zip = zipfile.ZipFile(StringIO(data))
+        self.assertEqual(None, zip.testzip())
+        return zip
+
+    def test_zip_archive(self):
+        jobs = [self._job(*f) for f in self.files]
+        # an object without a master file is left out
+        jobs.insert(1, lambda: iter([]))
+        zip = self._check(''.join(archive.zip_archive(jobs, workers=2, buffer=1)))
+        self.assertEqual(['one.tif', 'two.jpg', u'th\u0159ee.txt'], zip.namelist())
+        for name, chunks, mimetype in self.files:
+            self.assertEqual(''.join(chunks), zip.read(name))
+        info = zip.getinfo('one.tif')
+        self.assertEqual(zipfile.ZIP_DEFLATED, info.compress_type)
+        self.assert_(info.compress_size < info.file_size)
+        self.assertEqual((2011, 6, 1, 12, 30, 10), info.date_time)
+        # already compressed
+        self.assertEqual(zipfile.ZIP_STORED, zip.getinfo('two.jpg').compress_type)
+
+    def test_duplicate_names(self):
+        jobs = [self._job(name, ['x'], 'text/plain')
+                for name in ('a.txt', 'a.txt', 'a.txt', '../b', 'c/d')]
+        zip = self._check(''.join(archive.zip_archive(jobs)))
+        self.assertEqual(['a.txt', 'a (2).txt', 'a (3).txt', '_b', 'c_d'], zip.namelist())
+
+    def test_incomplete_file(self):
+        def failing():
+            yield {'name': 'bad.txt', 'size': 10000, 'mimetype': 'text/plain',
+                   'modified': None}
+            yield 'c' * 100
+            raise IOError('connection reset')
+        jobs = [self._job(*self.files[0]), failing, self._job(*self.files[1])]
+        zip = self._check(''.join(archive.zip_archive(jobs)))
+        # the rest of the archive is complete
+        self.assertEqual(['one.tif', 'bad.txt', 'two.jpg', 'INCOMPLETE.txt'], zip.namelist())
+        self.assertEqual('c' * 100, zip.read('bad.txt'))
+        self.assertEqual(''.join(self.files[1][1]), zip.read('two.jpg'))
+        self.assert_(zip.read('INCOMPLETE.txt').endswith('\n\nbad.txt\n'))
+
+    def test_zip64(self):
+        # use zip64 records for small sizes and counts, which are read the same way
+        with patch.object(archive, 'ZIP64_LIMIT', new=100):
+            with patch.object(archive, 'ZIP64_COUNT_LIMIT', new=2):
+                jobs = [self._job(*f) for f in self.files]
+                data = ''.join(archive.zip_archive(jobs))
+        self.assert_('PK\x06\x06' in data, 'archive should have a zip64 end record')
+        zip = self._check(data)
+        self.assertEqual(3, len(zip.namelist()))
+        for name, chunks, mimetype in self.files:
+            self.assertEqual(''.join(chunks), zip.read(name))
+
+    def test_prefetch(self):
+        # later jobs run while earlier ones are consumed, but results stay in order
+        started = []
+        def job(i):
+            def run():
+                started.append(i)
+                time.sleep(0.05 * (3 - i))
+                return ['%d-%d' % (i, n) for n in range(3)]
+            return run
+        fetched = archive.prefetch([job(i) for i in range(4)], workers=3, buffer=2)
+        first = next(fetched)
+        self.assertEqual(['0-0', '0-1', '0-2'], list(first))
+        self.assertEqual([0, 1, 2], sorted(started[:3]))
+        self.assertEqual([['%d-%d' % (i, n) for n in range(3)] for i in (1, 2, 3)],
+                         [list(items) for items in fetched])
+
+        # errors are raised in the consumer
+        def fail():
+            raise RequestFailed(Mock(status=404, reason='Not Found'))
+        fetched = archive.prefetch([fail])
+        self.assertRaises(RequestFailed, list, next(fetched))
+
+        # jobs stop when the consumer goes away
+        produced = []
+        def endless():
+            while True:
+                produced.append(1)
+                yield 'x'
+        fetched = archive.prefetch([endless], buffer=2)
+        next(next(fetched))
+        fetched.close()
+        time.sleep(0.6)
+        count = len(produced)
+        time.sleep(0.6)
+        self.assertEqual(count, len(produced))
+        self.assert_(count <= 4)
+
+    def test_download_view(self):
+        testcoll = Mock(spec=ObjectSummary, name='MockCollectionSummary')
+        download_url = reverse('collection:download', kwargs={'pid': 'coll:1'})
+        jobs = dict((pid, self._job(*f)) for pid, f in zip(['pid:1', 'pid:2', 'pid:3'], self.files))
+        with patch('genrepo.collection.views.get_summary',
+                   new=Mock(return_value=testcoll)) as mocksummary:
+            with patch('genrepo.collection.views.member_pids',
+                       new=Mock(return_value=iter(['pid:1', 'pid:2', 'pid:3']))) as mockpids:
+                with patch('genrepo.collection.views.master_files') as mockfiles:
+                    mockfiles.side_effect = lambda pids, repo: [jobs[pid] for pid in pids]
+                    response = self.client.get(download_url)
+                    self.assertEqual(200, response.status_code)
+                    self.assertEqual('application/zip', response['Content-Type'])
+                    self.assertEqual('attachment; filename=coll-1.zip',
+                                     response['Content-Disposition'])
+                    self.assertEqual(3, len(self._check(response.content).namelist()))
+
+                    # selected members only; non-members are ignored
+                    mockpids.return_value = iter(['pid:1', 'pid:2', 'pid:3'])
+                    response = self.client.get(download_url, {'pid': ['pid:3', 'pid:1', 'other:1']})
+                    self.assertEqual(['pid:3', 'pid:1'], mockfiles.call_args[0][0])
+                    self.assertEqual([u'th\u0159ee.txt', 'one.tif'],
+                                     self._check(response.content).namelist())
+
+                    mockpids.return_value = iter(['pid:1'])
+                    response = self.client.get(download_url, {'pid': 'other:1'})
+                    self.assertEqual(404, response.status_code)
+
+            mocksummary.return_value = None
+            response = self.client.get(download_url)
+            self.assertEqual(404, response.status_code)
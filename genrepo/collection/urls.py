@@ -16,17 +16,12 @@
 
 from django.conf.urls.defaults import patterns, url
 
-from genrepo.collection.models import CollectionObject
-
 urlpatterns = patterns('genrepo.collection.views',
     url(r'^$', 'list_collections', name='list'),
     url(r'^new/$', 'create_collection', name='new'),
     url(r'^(?P<pid>[^/]+)/edit/$', 'edit_collection', name='edit'),
+    url(r'^(?P<pid>[^/]+)/export/$', 'export_collection', name='export'),
+    url(r'^(?P<pid>[^/]+)/download/$', 'download_collection', name='download'),
+    url(r'^(?P<pid>[^/]+)/(?P<dsid>(DC|RELS-EXT))/$', 'raw_datastream', name='raw-ds'),
     url(r'^(?P<pid>[^/]+)/$', 'view_collection', name='view'),
 )
-
-# use eulfedora view for raw datastream access
-urlpatterns += patterns('eulfedora.views',
-    url(r'^(?P<pid>[^/]+)/(?P<dsid>(DC|RELS-EXT))/$', 'raw_datastream',
-        {'type': CollectionObject}, name='raw-ds'),
-)
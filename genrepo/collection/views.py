@@ -17,19 +17,23 @@
 from django.contrib import messages
 from django.contrib.auth.decorators import permission_required
 from django.core.urlresolvers import reverse
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
 from django.template import RequestContext
 
-from eulfedora.server import Repository
+from eulfedora import views as fedora_views
+from genrepo.fedora import Repository
 from eulfedora.models import DigitalObjectSaveFailure
 from eulcommon.djangoextras.auth.decorators import permission_required_with_403
 from eulcommon.djangoextras.http import HttpResponseSeeOtherRedirect
 from eulfedora.util import RequestFailed, PermissionDenied
 
+from genrepo.admission import admission_control
+from genrepo.collection.archive import master_files, zip_archive
+from genrepo.collection.export import EXPORT_FORMATS, export_rows, member_pids
 from genrepo.collection.forms import CollectionDCEditForm
-from genrepo.collection.models import CollectionObject
-from genrepo.util import accessible
+from genrepo.collection.models import CollectionObject, CollectionNode
+from genrepo.summary import get_summary, get_summaries
 
 @permission_required_with_403('collection.add_collection')
 def create_collection(request):
@@ -69,13 +73,14 @@ def _create_or_edit_collection(request, pid=None):
     # on GET, instantiate the form with existing object data (if any)
     if request.method == 'GET':
         # pre-populate oai setSpec and setName if set on the object
-        initial_data = {'oai_set': obj.oai_set, 'oai_set_name': obj.oai_setlabel}
-        form = CollectionDCEditForm(instance=obj.dc.content, initial=initial_data)
+        initial_data = {'oai_set': obj.oai_set, 'oai_set_name': obj.oai_setlabel,
+                        'parent': obj.parent}
+        form = CollectionDCEditForm(instance=obj.dc.content, initial=initial_data, pid=pid)
 
     # on POST, create a new collection object, update DC from form
     # data (if valid), and save
     elif request.method == 'POST':
-        form = CollectionDCEditForm(request.POST, instance=obj.dc.content)
+        form = CollectionDCEditForm(request.POST, instance=obj.dc.content, pid=pid)
         if form.is_valid():
             form.update_instance()
             # also use dc:title as object label
@@ -91,6 +96,10 @@ def _create_or_edit_collection(request, pid=None):
                 # if no value, clear out any previous OAI set information
                 obj.oai_set = None
                 obj.oai_setlabel = None
+
+            # set or clear explicit parent collection (the form doesn't allow
+            # the collection itself or any collection below it)
+            obj.parent = form.cleaned_data.get('parent') or None
             
             try:
                 if obj.exists:
@@ -138,20 +147,92 @@ def view_collection(request, pid):
     :class:`~genrepo.collection.models.CollectionObject` identified by
     pid.
     '''
-    repo = Repository(request=request)
-    obj = repo.get_object(pid, type=CollectionObject)
+    obj = get_summary(pid, request)
     # if the object does not exist or the current user doesn't have
     # permission to see that it exists, 404
-    if not obj.exists:
+    if obj is None:
+        raise Http404
+    repo = Repository(request=request)
+    members = get_summaries(member_pids(obj, repo), request)
+    # breadcrumb & nested collections from the local hierarchy index
+    try:
+        node = CollectionNode.objects.get(pid=pid)
+        ancestors = node.ancestors()
+        subcollections = node.children.all()
+    except CollectionNode.DoesNotExist:
+        ancestors = subcollections = []
+    return render(request, 'collection/view.html', {'obj': obj, 'members': members,
+                  'ancestors': ancestors, 'subcollections': subcollections})
+
+def raw_datastream(request, pid, dsid):
+    '''Access raw DC or RELS-EXT datastream content for a
+    :class:`~genrepo.collection.models.CollectionObject` .'''
+    # use generic raw datastream view from eulfedora
+    return fedora_views.raw_datastream(request, pid, dsid, type=CollectionObject)
+
+def export_collection(request, pid):
+    '''Export an inventory of the items in a
+    :class:`~genrepo.collection.models.CollectionObject` as CSV or
+    JSON, according to the ``format`` request parameter; if the
+    ``nested`` parameter is set, items in collections nested anywhere
+    below it are included.  The response content is generated as it is
+    sent, so large collections can be exported without holding the
+    whole inventory in memory.
+    '''
+    format = request.GET.get('format', 'csv')
+    if format not in EXPORT_FORMATS:
         raise Http404
-    return render(request, 'collection/view.html', {'obj': obj})
+    obj = get_summary(pid, request)
+    if obj is None:
+        raise Http404
+    repo = Repository(request=request)
+    serialize, mimetype = EXPORT_FORMATS[format]
+    pids = None
+    if request.GET.get('nested'):
+        try:
+            pids = CollectionNode.objects.get(pid=pid).item_pids(repo)
+        except CollectionNode.DoesNotExist:
+            pass
+    if pids is None:
+        pids = member_pids(obj, repo)
+    rows = export_rows(pids, repo)
+    response = HttpResponse(serialize(rows), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % \
+                                      (pid.replace(':', '-'), format)
+    return response
+
+@admission_control('download')
+def download_collection(request, pid):
+    '''Download the master files of the items in a
+    :class:`~genrepo.collection.models.CollectionObject` as a ZIP
+    archive; if any ``pid`` request parameters are specified, only
+    those items are included.  The archive is generated as it is sent.
+    Items without a master file, or whose master file the current user
+    may not read, are left out.
+    '''
+    obj = get_summary(pid, request)
+    if obj is None:
+        raise Http404
+    repo = Repository(request=request)
+    pids = member_pids(obj, repo)
+    selected = request.GET.getlist('pid')
+    if selected:
+        members = set(pids)
+        pids = []
+        for item in selected:
+            if item in members and item not in pids:
+                pids.append(item)
+        if not pids:
+            raise Http404
+    response = HttpResponse(zip_archive(master_files(pids, repo)), mimetype='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=%s.zip' % pid.replace(':', '-')
+    return response
 
 def list_collections(request):
     '''list all collections in repository returns list of
     :class:`~genrepo.collection.models.CollectionObject`
     '''
-    colls = CollectionObject.all()
-    colls = list(accessible(colls))
-    colls.sort(key=lambda coll: coll.label.upper()) # sort based on label
+    colls = get_summaries([coll.pid for coll in CollectionObject.all()], request)
+    colls.sort(key=lambda coll: (coll.label or '').upper()) # sort based on label
 
     return render(request, 'collection/list.html', {'colls': colls})
@@ -0,0 +1,740 @@
+# file genrepo/fedora.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Resilient access to Fedora, so that a slow or failing repository (or
+image server behind it) does not stall the whole site.
+
+:class:`Repository` should be used instead of
+:class:`eulfedora.server.Repository`; it makes requests through a
+shared :class:`ResilientConnection`, which adds, for each kind of
+operation (see :func:`operation`):
+
+* socket timeouts (**FEDORA_TIMEOUTS**, in seconds)
+* a :class:`CircuitBreaker` (configured by **FEDORA_BREAKER**): when
+  too many recent requests have failed, further requests fail
+  immediately with :class:`BackendUnavailable` instead of waiting on
+  Fedora, until a trial request succeeds
+* retries of failed reads (GET and HEAD requests), up to
+  **FEDORA_RETRIES** times (default 2), with randomized backoff
+* optionally, hedged reads (**FEDORA_HEDGE**): if a read has not
+  finished after the configured number of seconds, an identical request
+  is sent from one of **FEDORA_HEDGE_THREADS** threads (default 8; not
+  sent if they are all busy) and whichever response arrives first is
+  used
+
+If **FEDORA_READ_REPLICAS** lists the urls of Fedora read replicas (or
+mirrors) of **FEDORA_ROOT**, requests are made through a
+:class:`ReplicatedConnection` instead, which sends reads to the healthy
+replicas in turn and everything else to the primary **FEDORA_ROOT**,
+with a :class:`ResilientConnection` for each of them.
+:class:`ReadRoutingMiddleware` sends reads for a session that has just
+changed something to the primary, so users see their own changes.
+
+:class:`BackendUnavailableMiddleware` turns :class:`BackendUnavailable`
+into a 503 response.  Request counts and breaker states are available
+from :func:`metrics`.'''
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import heapq
+import httplib
+import itertools
+import logging
+import math
+import Queue
+import random
+import socket
+import sys
+import threading
+import time
+from urlparse import urlsplit
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.shortcuts import render
+
+from eulfedora import server
+from eulfedora.util import RelativeServerConnection, RequestFailed, PermissionDenied, \
+     auth_headers
+
+from genrepo import metrics as app_metrics
+
+logger = logging.getLogger(__name__)
+
+# default socket timeouts, in seconds, by kind of operation
+DEFAULT_TIMEOUTS = {
+    'default': 30,
+    'risearch': 15,
+    'dissemination': 20,
+    'content': 120,
+}
+# default circuit breaker configuration
+DEFAULT_BREAKER = {
+    'window': 30,           # seconds of requests to consider
+    'min_requests': 20,     # don't open with fewer requests in the window than this
+    'error_rate': 0.5,      # open when this fraction of requests have failed
+    'reset_timeout': 15,    # seconds to wait before trying again
+}
+# statuses worth retrying; other errors will not go away
+RETRY_STATUSES = (502, 503, 504)
+# base delay between retries, in seconds; doubled for each retry
+RETRY_DELAY = 0.1
+# read used to check that a replica is up
+HEALTH_CHECK_URL = 'describe?xml=true'
+
+
+class BackendUnavailable(IOError):
+    '''Fedora could not be reached or did not respond in time, or has
+    been failing and is being given time to recover.
+
+    :param retry_after: seconds until requests will be tried again, if known
+    '''
+    def __init__(self, message, retry_after=None):
+        super(BackendUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def operation(url):
+    '''Kind of operation a Fedora url is for: ``risearch``,
+    ``dissemination`` (e.g., Djatoka image regions), ``content``
+    (datastream content) or ``default`` (everything else).'''
+    path = urlsplit(url).path
+    if path.endswith('/risearch'):
+        return 'risearch'
+    if '/methods/' in path:
+        return 'dissemination'
+    if path.endswith('/content'):
+        return 'content'
+    return 'default'
+
+
+class CircuitBreaker(object):
+    '''Tracks recent failures for one kind of operation, and stops
+    requests for a while once too many of them are failing.
+
+    The breaker is *closed* (requests allowed) until at least
+    ``min_requests`` have been made in the last ``window`` seconds and
+    ``error_rate`` of them failed; it is then *open* (requests refused)
+    for ``reset_timeout`` seconds, after which it is *half-open*: a
+    single trial request is allowed, which closes the breaker if it
+    succeeds and opens it again if it fails.'''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window=30, min_requests=20, error_rate=0.5, reset_timeout=15):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.times_opened = 0
+        self._trial = False
+        # (time, failed) for recent requests
+        self._results = deque()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        'Check if a request should be made now.'
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.HALF_OPEN:
+                # only one trial request at a time
+                if self._trial:
+                    return False
+                self._trial = True
+            return True
+
+    def record(self, failed):
+        'Record the outcome of a request allowed by :meth:`allow`.'
+        with self._lock:
+            now = time.time()
+            if self.state == self.HALF_OPEN:
+                self._trial = False
+                if failed:
+                    self._open(now)
+                else:
+                    logger.warning('Fedora %s requests are succeeding again' % self.name)
+                    self.state = self.CLOSED
+                    self._results.clear()
+                return
+            self._results.append((now, failed))
+            while self._results and self._results[0][0] < now - self.window:
+                self._results.popleft()
+            failures = len([r for r in self._results if r[1]])
+            if self.state == self.CLOSED and len(self._results) >= self.min_requests and \
+                   failures >= self.error_rate * len(self._results):
+                logger.warning('Fedora %s requests are failing (%d of the last %d); ' \
+                               'not trying for %ds' % (self.name, failures,
+                                                       len(self._results), self.reset_timeout))
+                self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.times_opened += 1
+        self._results.clear()
+
+    def retry_after(self):
+        'Seconds until a request will be tried again (0 if requests are allowed).'
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(int(math.ceil(self.opened_at + self.reset_timeout - time.time())), 1)
+
+    def status(self):
+        with self._lock:
+            return {'state': self.state, 'times_opened': self.times_opened,
+                    'recent_requests': len(self._results),
+                    'recent_failures': len([r for r in self._results if r[1]])}
+
+
+class _Scheduled(object):
+    # a function scheduled to run in a _WorkerPool
+    def __init__(self, func):
+        self.func = func
+        self.cancelled = False
+        self.started = False
+        self.skipped = False
+
+class _WorkerPool(object):
+    # persistent threads for hedged reads; each thread keeps its own
+    # connection to fedora, so connections are reused between reads.
+    # Functions are scheduled to start after a delay, and skipped if no
+    # thread is idle by then, so they never wait in a queue.
+    def __init__(self, size):
+        self.size = size
+        self.idle = size
+        self.tasks = Queue.Queue()
+        self._scheduled = []    # heap of (time due, sequence, _Scheduled)
+        self._sequence = itertools.count()
+        self._started = False
+        self._lock = threading.Condition()
+
+    def schedule(self, delay, func):
+        'Run ``func`` in an idle thread after ``delay`` seconds, unless cancelled.'
+        scheduled = _Scheduled(func)
+        with self._lock:
+            if not self._started:
+                for target in [self._work] * self.size + [self._start_due]:
+                    thread = threading.Thread(target=target)
+                    thread.daemon = True
+                    thread.start()
+                self._started = True
+            heapq.heappush(self._scheduled,
+                           (time.time() + delay, self._sequence.next(), scheduled))
+            self._lock.notify()
+        return scheduled
+
+    def cancel(self, scheduled):
+        'Cancel a scheduled function; returns True if it has already started.'
+        with self._lock:
+            scheduled.cancelled = True
+            return scheduled.started
+
+    def _start_due(self):
+        with self._lock:
+            while True:
+                if not self._scheduled:
+                    self._lock.wait()
+                    continue
+                wait = self._scheduled[0][0] - time.time()
+                if wait > 0:
+                    self._lock.wait(wait)
+                    continue
+                scheduled = heapq.heappop(self._scheduled)[2]
+                if scheduled.cancelled:
+                    continue
+                if self.idle:
+                    self.idle -= 1
+                    scheduled.started = True
+                    self.tasks.put(scheduled.func)
+                else:
+                    scheduled.skipped = True
+
+    def _work(self):
+        while True:
+            func = self.tasks.get()
+            try:
+                func()
+            except Exception:
+                logger.exception('Error in hedged read')
+            finally:
+                with self._lock:
+                    self.idle += 1
+
+
+class _Superseded(Exception):
+    # a read was abandoned because its hedge finished first
+    pass
+
+class _Hedge(object):
+    # state shared by a read made by the calling thread and its hedge;
+    # a hedge that succeeds first shuts down the socket of the original
+    # read, so the calling thread stops waiting for it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.result = None      # (content, exc_info) from the hedge
+        self.connection = None
+        self.original_finished = False
+
+    @property
+    def won(self):
+        return self.result is not None and self.result[1] is None
+
+    def register(self, connection):
+        # connection the original read is about to use; False if it is too late
+        with self.lock:
+            if self.won:
+                return False
+            self.connection = connection
+            return True
+
+    def finish_original(self):
+        # the original read has finished; returns True if the hedge won
+        with self.lock:
+            self.original_finished = True
+            self.connection = None
+            return self.won
+
+    def finish_hedge(self, content, error):
+        with self.lock:
+            self.result = (content, error)
+            connection = None
+            if error is None and not self.original_finished:
+                connection = self.connection
+        self.done.set()
+        if connection is not None and connection.sock is not None:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class ResilientConnection(RelativeServerConnection):
+    '''Connection to Fedora with timeouts, circuit breakers, retries and
+    hedged reads, as configured in the Django settings.  Like the
+    eulfedora connection it extends, it may be shared by all threads.'''
+
+    def __init__(self, base_url):
+        super(ResilientConnection, self).__init__(base_url)
+        self.breakers = {}
+        self.counts = defaultdict(lambda: defaultdict(int))
+        # server label for application metrics
+        self.backend = urlsplit(base_url).netloc
+        self._lock = threading.Lock()
+        self._hedge_pool = _WorkerPool(getattr(settings, 'FEDORA_HEDGE_THREADS', 8))
+
+    def breaker(self, op):
+        'The :class:`CircuitBreaker` for a kind of operation.'
+        with self._lock:
+            if op not in self.breakers:
+                config = DEFAULT_BREAKER.copy()
+                config.update(getattr(settings, 'FEDORA_BREAKER', {}))
+                self.breakers[op] = CircuitBreaker(op, **config)
+            return self.breakers[op]
+
+    def _count(self, op, name):
+        with self._lock:
+            self.counts[op][name] += 1
+        app_metrics.increment('genrepo_fedora_events_total',
+                              (('backend', self.backend), ('operation', op), ('event', name)))
+
+    def _timed(self, op, started):
+        app_metrics.observe('genrepo_upstream_request_seconds', time.time() - started,
+                            (('backend', self.backend), ('operation', op)))
+
+    def _timeout(self, op):
+        timeouts = getattr(settings, 'FEDORA_TIMEOUTS', {})
+        return timeouts.get(op, timeouts.get('default', DEFAULT_TIMEOUTS[op]))
+
+    def _make_request(self, method, url, body, headers):
+        # apply the timeout for the current operation to the (reused) connection
+        connection = self.thread_local.connection
+        hedge = getattr(self.thread_local, 'hedge', None)
+        if hedge is not None and not hedge.register(connection):
+            raise _Superseded()
+        connection.timeout = getattr(self.thread_local, 'timeout', DEFAULT_TIMEOUTS['default'])
+        if connection.sock is not None:
+            connection.sock.settimeout(connection.timeout)
+        return super(ResilientConnection, self)._make_request(method, url, body, headers)
+
+    def request(self, method, url, body=None, headers=None, throw_errors=True):
+        op = operation(url)
+        breaker = self.breaker(op)
+        retries = 0
+        if method in ('GET', 'HEAD') and body is None:
+            retries = getattr(settings, 'FEDORA_RETRIES', 2)
+        for attempt in xrange(retries + 1):
+            if attempt:
+                self._count(op, 'retries')
+                # randomized, so that retries from many requests are spread out
+                time.sleep(random.uniform(0, RETRY_DELAY * 2 ** attempt))
+            if not breaker.allow():
+                self._count(op, 'short_circuited')
+                raise BackendUnavailable('Fedora %s requests are failing; not trying for now' % op,
+                                         breaker.retry_after())
+            self._count(op, 'requests')
+            self.thread_local.timeout = self._timeout(op)
+            started = time.time()
+            try:
+                response = self._connect_and_request(method, url, body, headers)
+            except (socket.error, httplib.HTTPException) as err:
+                # includes timeouts
+                self._timed(op, started)
+                breaker.record(True)
+                self._count(op, 'errors')
+                if attempt < retries:
+                    continue
+                raise BackendUnavailable('Fedora %s request failed: %s' % (op, err))
+            self._timed(op, started)
+            failed = response.status >= 500
+            breaker.record(failed)
+            if failed:
+                self._count(op, 'errors')
+            if response.status in RETRY_STATUSES and attempt < retries:
+                # discard the error, so the connection can be reused
+                response.read()
+                continue
+            break
+
+        if response.status >= 400 and throw_errors:
+            if response.status in (401, 403):
+                raise PermissionDenied(response)
+            raise RequestFailed(response)
+        return response
+
+    def read(self, rel_url, data=None, headers={}):
+        if data is None:
+            hedge_after = getattr(settings, 'FEDORA_HEDGE', {}).get(operation(self.absurl(rel_url)))
+            if hedge_after:
+                return self._hedged_read(rel_url, headers, hedge_after)
+        return super(ResilientConnection, self).read(rel_url, data, headers)
+
+    def _hedged_read(self, rel_url, headers, hedge_after):
+        # send the request from this thread, and a second copy from the
+        # hedge pool if the first is slow; use whichever response arrives first
+        abs_url = self.absurl(rel_url)
+        op = operation(abs_url)
+        hedge = _Hedge()
+        def send_hedge():
+            self._count(op, 'hedged')
+            try:
+                content, error = self.request('GET', abs_url, None, headers).read(), None
+            except Exception:
+                content, error = None, sys.exc_info()
+            hedge.finish_hedge(content, error)
+
+        scheduled = self._hedge_pool.schedule(hedge_after, send_hedge)
+        self.thread_local.hedge = hedge
+        try:
+            content, error = self.request('GET', abs_url, None, headers).read(), None
+        except Exception:
+            # includes being cut off by a hedge that finished first
+            content, error = None, sys.exc_info()
+        finally:
+            self.thread_local.hedge = None
+        hedge_won = hedge.finish_original()
+        hedge_started = self._hedge_pool.cancel(scheduled)
+        if scheduled.skipped:
+            self._count(op, 'hedge_skipped')
+        if error is not None and hedge_started and not hedge_won:
+            # failed; the hedge may still succeed
+            hedge.done.wait(self._timeout(op))
+            hedge_won = hedge.won
+        if hedge_won:
+            self._count(op, 'hedge_wins')
+            return hedge.result[0], abs_url
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return content, abs_url
+
+    def metrics(self):
+        '''Request counts and circuit breaker status, by kind of
+        operation, for this process.'''
+        with self._lock:
+            ops = dict((op, dict(counts)) for op, counts in self.counts.iteritems())
+            breakers = self.breakers.items()
+        for op, breaker in breakers:
+            ops.setdefault(op, {})['breaker'] = breaker.status()
+        return ops
+
+
+# per-thread (i.e., per-request) routing state: reads go to the primary
+# until ``primary_until``; ``wrote`` is set when anything is changed
+_routing = threading.local()
+
+def _is_read(method, body):
+    return method in ('GET', 'HEAD') and body is None
+
+def _wrote():
+    # reads by the current thread (and session) should see the change
+    _routing.wrote = True
+    _routing.primary_until = time.time() + getattr(settings, 'FEDORA_STICKY_SECONDS', 30)
+
+def reading_from_primary():
+    'Check if reads by the current thread must go to the primary.'
+    return time.time() < getattr(_routing, 'primary_until', 0)
+
+
+class ReadReplica(object):
+    '''A Fedora read replica, and whether it is healthy: checked with a
+    read in the background, at most every **FEDORA_HEALTH_INTERVAL**
+    seconds (default 15) while it is in use.'''
+
+    def __init__(self, url):
+        self.url = url
+        self.connection = ResilientConnection(url)
+        self.healthy = True
+        self.last_checked = 0
+        self.reads = 0
+        self.fallbacks = 0
+        self._checking = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        'Check if reads should be sent to this replica, and schedule a health check if due.'
+        interval = getattr(settings, 'FEDORA_HEALTH_INTERVAL', 15)
+        with self._lock:
+            due = not self._checking and time.time() - self.last_checked >= interval
+            if due:
+                self._checking = True
+        if due:
+            thread = threading.Thread(target=self.check)
+            thread.daemon = True
+            thread.start()
+        return self.healthy
+
+    def check(self):
+        'Check that the replica responds to a read, and update :attr:`healthy`.'
+        try:
+            try:
+                self.connection.read(HEALTH_CHECK_URL)
+                healthy, error = True, None
+            except Exception as err:
+                healthy, error = False, err
+            if healthy != self.healthy:
+                if healthy:
+                    logger.warning('Fedora replica %s is available again' % self.url)
+                else:
+                    logger.warning('Fedora replica %s is unavailable; reading from the ' \
+                                   'primary: %s' % (self.url, error))
+            self.healthy = healthy
+        finally:
+            with self._lock:
+                self.last_checked = time.time()
+                self._checking = False
+
+    def status(self):
+        return {'healthy': self.healthy, 'reads': self.reads, 'fallbacks': self.fallbacks,
+                'operations': self.connection.metrics()}
+
+
+class ReplicatedConnection(object):
+    '''Connection to a primary Fedora and its read replicas, which can be
+    used in place of a :class:`~eulfedora.util.RelativeServerConnection`.
+
+    Reads (GET and HEAD requests) go to the healthy replicas in turn,
+    unless the current thread has recently changed something (see
+    :func:`reading_from_primary`).  A read that fails on a replica, or
+    finds nothing there (the change may not have been replicated yet), is
+    made again on the primary.  Everything else goes to the primary.'''
+
+    def __init__(self, base_url, replica_urls):
+        self.base_url = base_url
+        self.replica_urls = list(replica_urls)
+        self.primary = ResilientConnection(base_url)
+        self.replicas = [ReadReplica(url) for url in self.replica_urls]
+        self._turn = itertools.count()
+
+    def absurl(self, rel_url):
+        return self.primary.absurl(rel_url)
+
+    def replica(self):
+        'The replica to send the next read to, or None if it should go to the primary.'
+        if reading_from_primary():
+            return None
+        healthy = [replica for replica in self.replicas if replica.available()]
+        if not healthy:
+            return None
+        return healthy[self._turn.next() % len(healthy)]
+
+    def _read(self, func):
+        # call func with the connection to read from, falling back to the primary
+        replica = self.replica()
+        if replica is not None:
+            replica.reads += 1
+            try:
+                return func(replica.connection)
+            except BackendUnavailable as err:
+                reason = err
+            except RequestFailed as err:
+                if err.code != 404:
+                    raise
+                reason = err
+            replica.fallbacks += 1
+            logger.debug('Read from Fedora replica %s failed (%s); reading from the primary' % \
+                         (replica.url, reason))
+        return func(self.primary)
+
+    def request(self, method, rel_url, body=None, headers=None, throw_errors=True):
+        '''Make a request for a url relative to the base url, on the
+        primary or a replica.'''
+        if not _is_read(method, body):
+            _wrote()
+            return self.primary.request(method, self.absurl(rel_url), body, headers, throw_errors)
+
+        def attempt(connection):
+            response = connection.request(method, connection.absurl(rel_url), body,
+                                          headers, throw_errors)
+            if response.status == 404 and connection is not self.primary:
+                response.read()
+                raise RequestFailed(response)
+            return response
+        return self._read(attempt)
+
+    @contextmanager
+    def open(self, method, rel_url, body=None, headers={}, throw_errors=True):
+        response = self.request(method, rel_url, body, headers, throw_errors)
+        yield response
+        response.read()
+
+    def read(self, rel_url, data=None, headers={}):
+        if data is not None:
+            _wrote()
+            return self.primary.read(rel_url, data, headers)
+        content, url = self._read(lambda connection: connection.read(rel_url, None, headers))
+        # report the primary url, as a replica url could end up in parsed content
+        return content, self.absurl(rel_url)
+
+    def metrics(self):
+        '''Request counts and circuit breaker status for the primary (as
+        for :meth:`ResilientConnection.metrics`), with the status of each
+        replica under ``replicas``.'''
+        metrics = self.primary.metrics()
+        metrics['replicas'] = dict((replica.url, replica.status()) for replica in self.replicas)
+        return metrics
+
+    def __repr__(self):
+        return '<%s %s (replicas: %s)>' % (self.__class__.__name__, self.base_url,
+                                           ', '.join(self.replica_urls))
+
+
+_connection_lock = threading.Lock()
+
+def connection():
+    '''The shared :class:`ResilientConnection` for **FEDORA_ROOT** (or
+    :class:`ReplicatedConnection`, if **FEDORA_READ_REPLICAS** are
+    configured), installed as the eulfedora pooled connection so that it
+    is used by all repositories that don't specify a root url.'''
+    replicas = list(getattr(settings, 'FEDORA_READ_REPLICAS', []))
+    with _connection_lock:
+        current = server._connection
+        if replicas:
+            if not isinstance(current, ReplicatedConnection) or \
+                   current.base_url != settings.FEDORA_ROOT or \
+                   current.replica_urls != replicas:
+                server._connection = ReplicatedConnection(settings.FEDORA_ROOT, replicas)
+        elif not isinstance(current, ResilientConnection) or \
+                 current.base_url != settings.FEDORA_ROOT:
+            server._connection = ResilientConnection(settings.FEDORA_ROOT)
+        return server._connection
+
+def metrics():
+    'Request counts and circuit breaker status for the shared connection.'
+    current = server._connection
+    if isinstance(current, (ResilientConnection, ReplicatedConnection)):
+        return current.metrics()
+    return {}
+
+def _stream(connection, rel_url, headers):
+    response = connection.request('GET', connection.absurl(rel_url), None, headers)
+    return response, connection.thread_local.connection.close
+
+def open_stream(opener, rel_url, headers=None):
+    '''Send a GET request for content that will be read a piece at a
+    time (and possibly not all of it), with the credentials and shared
+    connection of an opener (e.g., ``obj.api.opener``), so that the
+    connection's timeouts and circuit breaker apply; a read replica is
+    used if there is one, unless it does not have the content.
+
+    :returns: tuple of the response and a function to call if the
+        response is abandoned before all of the content is read, which
+        closes the current thread's connection to Fedora so that the
+        unread content is not taken for the next response
+    '''
+    headers = dict(headers or {})
+    headers.update(auth_headers(opener.username, opener.password))
+    base = opener.base
+    if isinstance(base, ReplicatedConnection):
+        return base._read(lambda connection: _stream(connection, rel_url, headers))
+    return _stream(base, rel_url, headers)
+
+
+class Repository(server.Repository):
+    ''':class:`eulfedora.server.Repository` that uses the shared
+    :class:`ResilientConnection`, unless a root url is specified.'''
+    def __init__(self, root=None, username=None, password=None, request=None):
+        if root is None:
+            connection()
+        super(Repository, self).__init__(root, username, password, request)
+
+
+class ReadRoutingMiddleware(object):
+    '''Read-your-writes for Fedora read replicas: once a request has
+    changed something in Fedora, reads for the same session go to the
+    primary for **FEDORA_STICKY_SECONDS** (default 30), by which time the
+    change should have reached the replicas.  Must come after the session
+    middleware.'''
+
+    SESSION_KEY = 'fedora_primary_until'
+
+    def process_request(self, request):
+        session = getattr(request, 'session', None)
+        _routing.primary_until = session.get(self.SESSION_KEY, 0) if session is not None else 0
+        _routing.wrote = False
+
+    def process_response(self, request, response):
+        if getattr(_routing, 'wrote', False) and hasattr(request, 'session'):
+            request.session[self.SESSION_KEY] = _routing.primary_until
+        _routing.primary_until = 0
+        _routing.wrote = False
+        return response
+
+
+class BackendUnavailableMiddleware(object):
+    '''Respond to :class:`BackendUnavailable` errors with a 503 (Service
+    Unavailable) page and a ``Retry-After`` header.'''
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, BackendUnavailable):
+            return None
+        try:
+            response = render(request, '503.html', status=503)
+        except Exception:
+            # the page may itself need something from fedora
+            response = HttpResponse('The repository is temporarily unavailable.',
+                                    mimetype='text/plain', status=503)
+        response['Retry-After'] = str(exception.retry_after or 30)
+        return response
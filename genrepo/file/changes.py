@@ -0,0 +1,291 @@
+# file genrepo/file/changes.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Change feed for objects modified outside the site (e.g., with the
+Fedora admin client or batch tools), so that cached information and
+local indexes can be updated for just the objects that changed, rather
+than rebuilt from scratch.
+
+Changes are found either by polling the Fedora Resource Index for
+objects modified since the latest modification already processed (the
+*high-water mark*, kept in :class:`~genrepo.file.models.ChangeFeedState`),
+or by consuming Fedora API-M notification messages (the Atom entries
+Fedora sends over JMS) written as files to a spool directory by a
+message listener.  Each change is handled by :func:`apply_changes`:
+
+* everything cached for the object is invalidated (summaries, content
+  model types, image information; see :mod:`genrepo.cache`)
+* collections are updated in the collection hierarchy index
+* publicly accessible objects in a collection are updated in the
+  sitemap index, and other objects are removed from it
+
+The Resource Index is updated asynchronously, so each poll looks back
+**CHANGES_OVERLAP** seconds (default 120) before the high-water mark,
+skipping changes that have already been processed.  Purged objects are
+not in the Resource Index, so they are only seen as notifications.'''
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+import logging
+import os
+import re
+from xml.etree import ElementTree
+from xml.parsers.expat import ExpatError
+
+from django.conf import settings
+from django.db import transaction
+
+from eulfedora.rdfns import model, relsext
+from eulfedora.util import RequestFailed
+
+from genrepo.cache import invalidate
+from genrepo.collection.models import CollectionNode, CollectionObject
+from genrepo.file.models import ChangeFeedState, SitemapEntry
+from genrepo.util import risearch_rows
+
+logger = logging.getLogger(__name__)
+
+# fedora's last modification date, in the resource index
+LAST_MODIFIED = 'info:fedora/fedora-system:def/view#lastModifiedDate'
+XSD_DATETIME = 'http://www.w3.org/2001/XMLSchema#dateTime'
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+# API-M methods that change an object; notifications for anything else are ignored
+WRITE_METHODS = ('add', 'ingest', 'modify', 'purge', 'set')
+# name of the change feed state for resource index polling
+RISEARCH_FEED = 'risearch'
+
+FEDORA_DATE_RE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d{1,6}))?Z?$')
+
+
+class Change(namedtuple('Change', 'pid modified deleted')):
+    '''A change to a Fedora object: its pid, modification date (as a
+    naive UTC :class:`~datetime.datetime`) and whether it was purged.'''
+    __slots__ = ()
+
+
+def fedora_date(value):
+    'Parse a Fedora (UTC) date, e.g. ``2011-06-01T12:30:10.12Z``.'
+    match = FEDORA_DATE_RE.match(value.strip())
+    if match is None:
+        raise ValueError('Not a Fedora date: %s' % value)
+    date = datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    if match.group(2):
+        date = date.replace(microsecond=int(match.group(2).ljust(6, '0')))
+    return date
+
+def format_date(date):
+    'Format a UTC :class:`~datetime.datetime` as a Fedora date, to the millisecond.'
+    return '%s.%03dZ' % (date.strftime('%Y-%m-%dT%H:%M:%S'), date.microsecond // 1000)
+
+
+def modified_since(repo, since):
+    '''Objects modified after a date, according to the Resource Index,
+    in order of modification.
+
+    :param since: UTC :class:`~datetime.datetime`
+    :returns: generator of :class:`Change`
+    '''
+    query = 'select ?obj ?modified where { ?obj <%s> ?modified . ' \
+            'filter (?modified > \'%s\'^^<%s>) } order by ?modified' % \
+            (LAST_MODIFIED, format_date(since), XSD_DATETIME)
+    for obj, modified in risearch_rows(repo, query):
+        yield Change(obj.replace('info:fedora/', ''), fedora_date(modified), False)
+
+def object_info(repo, pids):
+    '''Content models and collection of a batch of objects, with a
+    single Resource Index query.
+
+    :returns: dictionary of pid -> (set of content model uris, collection
+        uri or None), for the objects found in the Resource Index
+    '''
+    pids = list(pids)
+    if not pids:
+        return {}
+    query = 'select ?obj ?cmodel ?coll where { ?obj <%s> ?cmodel . ' \
+            'optional { ?obj <%s> ?coll } filter (%s) }' % \
+            (model.hasModel, relsext.isMemberOfCollection,
+             ' || '.join('?obj = <info:fedora/%s>' % pid for pid in pids))
+    info = {}
+    for obj, cmodel, coll in risearch_rows(repo, query):
+        cmodels, collection = info.setdefault(obj.replace('info:fedora/', ''), (set(), [None]))
+        cmodels.add(cmodel)
+        if coll:
+            collection[0] = coll
+    return dict((pid, (cmodels, collection[0]))
+                for pid, (cmodels, collection) in info.iteritems())
+
+
+@transaction.commit_on_success
+def apply_changes(changes, repo):
+    '''Invalidate cached information and update the local indexes for a
+    batch of changed objects.
+
+    :param changes: list of :class:`Change`
+    :returns: dictionary of counts: ``invalidated``, ``collections`` and
+        ``sitemap`` (index entries updated) and ``removed`` (objects
+        purged, or no longer listed, removed from the indexes)
+    '''
+    # only the latest change to each object matters
+    latest = {}
+    for change in changes:
+        if change.pid not in latest or change.modified >= latest[change.pid].modified:
+            latest[change.pid] = change
+    counts = {'invalidated': 0, 'collections': 0, 'sitemap': 0, 'removed': 0}
+    for pid in latest:
+        invalidate(pid)
+        counts['invalidated'] += 1
+
+    purged = [pid for pid, change in latest.iteritems() if change.deleted]
+    info = object_info(repo, [pid for pid, change in latest.iteritems() if not change.deleted])
+    hierarchy_changed = False
+    for pid, (cmodels, collection) in info.iteritems():
+        if CollectionObject.COLLECTION_CONTENT_MODEL in cmodels:
+            try:
+                CollectionNode.objects.update_node(repo.get_object(pid, type=CollectionObject))
+            except RequestFailed as err:
+                logger.warn('Could not update collection index for %s: %s' % (pid, err))
+                continue
+            hierarchy_changed = True
+            counts['collections'] += 1
+        elif SitemapEntry.objects.listed(cmodels, collection):
+            SitemapEntry.objects.update_entry(pid, collection, latest[pid].modified)
+            counts['sitemap'] += 1
+        else:
+            # no longer public or in a collection
+            entries = SitemapEntry.objects.filter(pid=pid)
+            if entries.exists():
+                entries.delete()
+                counts['removed'] += 1
+
+    if purged:
+        counts['removed'] = SitemapEntry.objects.filter(pid__in=purged).count()
+        SitemapEntry.objects.filter(pid__in=purged).delete()
+        nodes = CollectionNode.objects.filter(pid__in=purged)
+        if nodes.count():
+            counts['removed'] += nodes.count()
+            nodes.delete()
+            hierarchy_changed = True
+    if hierarchy_changed:
+        CollectionNode.objects.rebuild_closure()
+    return counts
+
+
+def _add_counts(total, counts):
+    for name, value in counts.iteritems():
+        total[name] = total.get(name, 0) + value
+
+def poll_resource_index(repo, since=None, batch_size=None):
+    '''Apply the changes found in the Resource Index since the stored
+    high-water mark, in batches of **CHANGES_BATCH_SIZE** (default 50),
+    storing the new mark after each batch.  The first time, the mark
+    starts at ``since`` (or the current time, if not specified).
+
+    :param since: UTC :class:`~datetime.datetime` to start from, instead
+        of the stored mark
+    :returns: dictionary of counts, as for :func:`apply_changes`, with
+        the number of ``changes`` found
+    '''
+    if batch_size is None:
+        batch_size = getattr(settings, 'CHANGES_BATCH_SIZE', 50)
+    overlap = timedelta(seconds=getattr(settings, 'CHANGES_OVERLAP', 120))
+    state, created = ChangeFeedState.objects.get_or_create(name=RISEARCH_FEED)
+    if since is not None or not state.high_water:
+        state.high_water = format_date(since or datetime.utcnow())
+        state.set_recent({})
+        state.save()
+    high_water = fedora_date(state.high_water)
+    recent = state.get_recent()
+
+    totals = {'changes': 0}
+    batch = []
+    def apply_batch():
+        _add_counts(totals, apply_changes(batch, repo))
+        totals['changes'] += len(batch)
+        for change in batch:
+            recent[change.pid] = format_date(change.modified)
+        mark = max(high_water, batch[-1].modified)
+        # forget changes too old to be seen again
+        cutoff = format_date(mark - overlap)
+        state.high_water = format_date(mark)
+        state.set_recent(dict((pid, modified) for pid, modified in recent.iteritems()
+                              if modified >= cutoff))
+        state.save()
+        return mark
+
+    for change in modified_since(repo, high_water - overlap):
+        if recent.get(change.pid) == format_date(change.modified):
+            continue
+        batch.append(change)
+        if len(batch) >= batch_size:
+            high_water = apply_batch()
+            batch = []
+    if batch:
+        apply_batch()
+    return totals
+
+
+def parse_notification(data):
+    '''Parse a Fedora API-M notification message (an Atom entry).
+
+    :returns: :class:`Change`, or None if the message is not for a
+        method that changes an object
+    :raises: ValueError if the message has no pid or date
+    '''
+    entry = ElementTree.fromstring(data)
+    method = entry.findtext('{%s}title' % ATOM_NS, '').strip()
+    if not method.startswith(WRITE_METHODS):
+        return None
+    pid = entry.findtext('{%s}summary' % ATOM_NS, '').strip()
+    if not pid:
+        raise ValueError('No pid in %s notification' % method)
+    updated = entry.findtext('{%s}updated' % ATOM_NS, '').strip()
+    if not updated:
+        raise ValueError('No date in %s notification for %s' % (method, pid))
+    return Change(pid, fedora_date(updated), method == 'purgeObject')
+
+def consume_spool(repo, directory=None, batch_size=None):
+    '''Apply the changes in the notification messages in a spool
+    directory (**CHANGES_SPOOL_DIR**), one file per message, in order of
+    file name; files are removed once their changes have been applied.
+    Files that are not valid notifications are logged and removed.
+
+    :returns: dictionary of counts, as for :func:`poll_resource_index`
+    '''
+    if directory is None:
+        directory = settings.CHANGES_SPOOL_DIR
+    if batch_size is None:
+        batch_size = getattr(settings, 'CHANGES_BATCH_SIZE', 50)
+    # skip hidden files, which may still be being written
+    names = sorted(name for name in os.listdir(directory) if not name.startswith('.'))
+    totals = {'changes': 0}
+    for start in xrange(0, len(names), batch_size):
+        paths = [os.path.join(directory, name) for name in names[start:start + batch_size]]
+        batch = []
+        for path in paths:
+            try:
+                with open(path) as message:
+                    change = parse_notification(message.read())
+            except (ValueError, SyntaxError, ExpatError) as err:
+                logger.warn('Discarding invalid notification %s: %s' % (path, err))
+                continue
+            if change is not None:
+                batch.append(change)
+        if batch:
+            _add_counts(totals, apply_changes(batch, repo))
+            totals['changes'] += len(batch)
+        for path in paths:
+            os.remove(path)
+    return totals
@@ -0,0 +1,367 @@
+# file genrepo/file/derivatives.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Background generation of derivative datastreams (web-playable
+copies, video poster frames, audio waveforms) from master files.
+
+Object types list the datastreams to be generated in ``DERIVATIVES``.
+When an object is ingested, a :class:`~genrepo.file.models.DerivativeTask`
+is queued for each of them; the ``process_derivatives`` command works
+through the queue, downloading each master once, running the generator
+registered in :data:`GENERATORS` for every pending derivative, and
+saving the results to Fedora together.'''
+
+from array import array
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings
+
+from eulfedora.util import RequestFailed
+
+from genrepo.fedora import BackendUnavailable
+from genrepo.file.fixity import CHUNK_SIZE, file_checksum
+from genrepo.file.models import DerivativeTask, init_by_cmodel
+
+logger = logging.getLogger(__name__)
+
+
+class DerivativeError(Exception):
+    'A derivative could not be generated.'
+
+
+def ffmpeg(*args):
+    '''Run ffmpeg (as configured by **FFMPEG_BINARY**) with the specified
+    arguments, overwriting any existing output file.
+
+    :raises: :class:`DerivativeError` if ffmpeg fails
+    '''
+    cmd = [getattr(settings, 'FFMPEG_BINARY', 'ffmpeg'), '-y', '-v', 'error'] + list(args)
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as err:
+        raise DerivativeError('Could not run %s: %s' % (cmd[0], err))
+    output, errors = proc.communicate()
+    if proc.returncode != 0:
+        # the last lines of output are the most likely to explain the failure
+        raise DerivativeError('ffmpeg failed (%d): %s' % \
+                              (proc.returncode, '\n'.join(errors.splitlines()[-5:])))
+
+
+def download_master(obj, path):
+    'Save the content of an object\'s master datastream to a local file, in chunks.'
+    url = 'objects/%s/datastreams/%s/content' % (obj.pid, obj.master.id)
+    with obj.api.open('GET', url) as response:
+        with open(path, 'wb') as outfile:
+            chunk = response.read(CHUNK_SIZE)
+            while chunk:
+                outfile.write(chunk)
+                chunk = response.read(CHUNK_SIZE)
+
+
+def _set_content(ds, path, mimetype):
+    ds.content = open(path, 'rb')
+    ds.mimetype = mimetype
+    if ds.checksum_type not in (None, 'DISABLED'):
+        ds.checksum = file_checksum(ds.content, ds.checksum_type)
+
+def access_video(obj, master, workdir):
+    '''Transcode a video to H.264/AAC in an MP4 container, no larger than
+    **VIDEO_ACCESS_HEIGHT** pixels high (default 480), with the index at
+    the start of the file so playback can begin before it is downloaded.'''
+    height = getattr(settings, 'VIDEO_ACCESS_HEIGHT', 480)
+    path = os.path.join(workdir, 'access.mp4')
+    ffmpeg('-i', master,
+           # scale down (never up), keeping the width even as H.264 requires
+           '-vf', 'scale=-2:min(ih\\,%d)' % height,
+           '-c:v', 'libx264', '-preset', 'medium', '-crf', '23', '-pix_fmt', 'yuv420p',
+           '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart', path)
+    _set_content(obj.access, path, 'video/mp4')
+
+def poster_frame(obj, master, workdir):
+    '''Extract a JPEG still from a video to display before playback;
+    uses the frame at **VIDEO_POSTER_OFFSET** seconds (default 5), or
+    the first frame for shorter videos.'''
+    path = os.path.join(workdir, 'poster.jpg')
+    ffmpeg('-ss', str(getattr(settings, 'VIDEO_POSTER_OFFSET', 5)), '-i', master,
+           '-frames:v', '1', '-q:v', '3', path)
+    if not os.path.exists(path) or not os.path.getsize(path):
+        # offset is past the end of the video
+        ffmpeg('-i', master, '-frames:v', '1', '-q:v', '3', path)
+    _set_content(obj.poster, path, 'image/jpeg')
+
+def access_audio(obj, master, workdir):
+    '''Encode audio as MP3 at **AUDIO_ACCESS_BITRATE** (default 96k),
+    for streaming to the browser player.'''
+    path = os.path.join(workdir, 'access.mp3')
+    ffmpeg('-i', master, '-vn', '-c:a', 'libmp3lame',
+           '-b:a', getattr(settings, 'AUDIO_ACCESS_BITRATE', '96k'), path)
+    _set_content(obj.access, path, 'audio/mpeg')
+
+# sample rate used to decode audio for waveforms; high enough to find
+# peaks accurately at display resolution
+WAVEFORM_SAMPLE_RATE = 8000
+# bytes of samples read at a time for waveforms
+WAVEFORM_CHUNK_SIZE = 1024 * 1024
+
+def waveform_peaks(path, points, chunk_size=WAVEFORM_CHUNK_SIZE):
+    '''Calculate waveform peaks from a file of raw, signed 16-bit mono
+    samples, reading it in chunks of ``chunk_size`` bytes.  The samples
+    are divided into (at most) the specified number of equal blocks, and
+    the minimum and maximum of each block are scaled to 8 bits.
+
+    :returns: tuple of (samples per block, list of alternating min and
+        max values)
+    '''
+    samples = os.path.getsize(path) // 2
+    block = max(1, -(-samples // points))   # round up
+    peaks = []
+    # minimum, maximum and number of samples so far in the current block,
+    # which may continue into the next chunk
+    low = high = None
+    count = 0
+    remainder = ''
+    with open(path, 'rb') as pcm:
+        chunk = pcm.read(chunk_size)
+        while chunk:
+            chunk = remainder + chunk
+            whole = len(chunk) - len(chunk) % 2
+            remainder = chunk[whole:]
+            data = array('h', chunk[:whole])
+            start = 0
+            while start < len(data):
+                values = data[start:start + block - count]
+                if count:
+                    low, high = min(low, min(values)), max(high, max(values))
+                else:
+                    low, high = min(values), max(values)
+                count += len(values)
+                start += len(values)
+                if count == block:
+                    peaks.extend((low >> 8, high >> 8))
+                    count = 0
+            chunk = pcm.read(chunk_size)
+    if count:
+        peaks.extend((low >> 8, high >> 8))
+    return block, peaks
+
+def waveform(obj, master, workdir):
+    '''Precompute the waveform of an audio file, so the player can
+    display it without downloading the audio.  The JSON uses the format
+    of the BBC *audiowaveform* tool (as read by *peaks.js*), with
+    **WAVEFORM_POINTS** (default 1000) min/max pairs.'''
+    pcm = os.path.join(workdir, 'waveform.raw')
+    ffmpeg('-i', master, '-vn', '-ac', '1', '-ar', str(WAVEFORM_SAMPLE_RATE),
+           '-f', 's16le', '-c:a', 'pcm_s16le', pcm)
+    block, peaks = waveform_peaks(pcm, getattr(settings, 'WAVEFORM_POINTS', 1000))
+    path = os.path.join(workdir, 'waveform.json')
+    with open(path, 'wb') as outfile:
+        json.dump({'version': 1, 'channels': 1, 'bits': 8,
+                   'sample_rate': WAVEFORM_SAMPLE_RATE,
+                   'samples_per_pixel': block, 'length': len(peaks) // 2,
+                   'data': peaks}, outfile, separators=(',', ':'))
+    _set_content(obj.waveform, path, 'application/json')
+
+# derivative datastream id -> function to generate it, called with the
+# object, the path to a local copy of the master file, and a temporary
+# directory for output
+GENERATORS = {
+    'access-video': access_video,
+    'poster': poster_frame,
+    'access-audio': access_audio,
+    'waveform': waveform,
+}
+
+
+def queue_derivatives(obj):
+    '''Queue tasks to generate all of the derivatives for an object
+    (e.g., after its master file is ingested or replaced).  Tasks already
+    queued are reset, so that derivatives are regenerated.'''
+    for dsid in obj.DERIVATIVES:
+        task, created = DerivativeTask.objects.get_or_create(pid=obj.pid, dsid=dsid)
+        if not created:
+            task.status = DerivativeTask.PENDING
+            task.attempts = 0
+            task.detail = ''
+            task.save()
+
+def queue_existing(repo, objtype):
+    '''Queue derivatives for existing objects of the specified type
+    that have never had any queued (e.g., objects ingested before the
+    type defined derivatives).
+
+    :returns: number of objects queued
+    '''
+    queued = set(DerivativeTask.objects.values_list('pid', flat=True))
+    count = 0
+    for obj in repo.get_objects_with_cmodel(objtype.CONTENT_MODELS[0], type=objtype):
+        if obj.pid not in queued:
+            queue_derivatives(obj)
+            count += 1
+    return count
+
+def reclaim_stale(timeout=None, max_attempts=None):
+    '''Return tasks that have been running for longer than
+    **DERIVATIVE_TASK_TIMEOUT** seconds (default 6 hours) to the queue,
+    counting an attempt; their worker has presumably died.
+
+    :returns: number of tasks reclaimed
+    '''
+    if timeout is None:
+        timeout = getattr(settings, 'DERIVATIVE_TASK_TIMEOUT', 6 * 60 * 60)
+    if max_attempts is None:
+        max_attempts = getattr(settings, 'DERIVATIVE_MAX_ATTEMPTS', 3)
+    cutoff = datetime.now() - timedelta(seconds=timeout)
+    count = 0
+    for task in DerivativeTask.objects.filter(status=DerivativeTask.RUNNING,
+                                              updated__lt=cutoff):
+        attempts = task.attempts + 1
+        status = DerivativeTask.PENDING if attempts < max_attempts else DerivativeTask.FAILED
+        # only if another worker hasn't already reclaimed it
+        count += DerivativeTask.objects.filter(pk=task.pk, status=DerivativeTask.RUNNING,
+                                               updated=task.updated) \
+                     .update(status=status, attempts=attempts, updated=datetime.now(),
+                             detail='Not finished after %d seconds' % timeout)
+    if count:
+        logger.warn('Reclaimed %d stale derivative tasks' % count)
+    return count
+
+def pending_tasks(max_attempts=None):
+    '''Pending tasks, grouped by object, in the order they were queued.
+    Stale running tasks are returned to the queue first (see
+    :func:`reclaim_stale`).
+
+    :returns: list of (pid, list of :class:`DerivativeTask`)
+    '''
+    if max_attempts is None:
+        max_attempts = getattr(settings, 'DERIVATIVE_MAX_ATTEMPTS', 3)
+    reclaim_stale(max_attempts=max_attempts)
+    tasks = DerivativeTask.objects.filter(status=DerivativeTask.PENDING,
+                                          attempts__lt=max_attempts)
+    groups = []
+    by_pid = {}
+    for task in tasks:
+        if task.pid not in by_pid:
+            by_pid[task.pid] = []
+            groups.append((task.pid, by_pid[task.pid]))
+        by_pid[task.pid].append(task)
+    return groups
+
+def claim(task):
+    '''Mark a pending task as running.  Returns False if another process
+    has already claimed it, so several workers can share the queue.'''
+    # record when it was claimed, to find tasks whose worker died
+    now = datetime.now()
+    claimed = DerivativeTask.objects.filter(pk=task.pk, status=DerivativeTask.PENDING) \
+                                    .update(status=DerivativeTask.RUNNING, updated=now)
+    if claimed:
+        task.status = DerivativeTask.RUNNING
+        task.updated = now
+    return bool(claimed)
+
+def process_object(pid, tasks, repo=None):
+    '''Generate the derivatives for a group of tasks for a single
+    object, and save them to Fedora.  Each task is updated with its
+    outcome; failed tasks go back in the queue until they have been
+    attempted **DERIVATIVE_MAX_ATTEMPTS** times, whatever the error.
+    :class:`~genrepo.fedora.BackendUnavailable` is raised after updating
+    the tasks, since other objects would fail the same way.
+
+    :returns: list of the processed :class:`DerivativeTask`
+    '''
+    tasks = [task for task in tasks if claim(task)]
+    if not tasks:
+        return tasks
+    max_attempts = getattr(settings, 'DERIVATIVE_MAX_ATTEMPTS', 3)
+    workdir = tempfile.mkdtemp(prefix='genrepo-derivatives-')
+    try:
+        _generate(pid, tasks, repo, workdir, max_attempts)
+    except BackendUnavailable as err:
+        _failed_running(tasks, 'Fedora is unavailable: %s' % err, max_attempts)
+        raise
+    except Exception as err:
+        logger.exception('Error generating derivatives for %s' % pid)
+        _failed_running(tasks, 'Unexpected error: %s' % err, max_attempts)
+    except:
+        # interrupted; put the tasks back in the queue as they were
+        for task in tasks:
+            if task.status == DerivativeTask.RUNNING:
+                task.status = DerivativeTask.PENDING
+                task.save()
+        raise
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return tasks
+
+def _generate(pid, tasks, repo, workdir, max_attempts):
+    generated = []
+    try:
+        obj = init_by_cmodel(pid, repo=repo)
+        master = os.path.join(workdir, 'master')
+        download_master(obj, master)
+    except RequestFailed as rf:
+        for task in tasks:
+            _failed(task, 'Could not retrieve master file: %s' % rf, max_attempts)
+        return
+
+    for task in tasks:
+        generator = GENERATORS.get(task.dsid)
+        if generator is None or task.dsid not in obj.DERIVATIVES:
+            # nothing can be done for this task; don't retry
+            _failed(task, 'No derivative %s for %s' % (task.dsid, obj.__class__.__name__))
+            continue
+        try:
+            generator(obj, master, workdir)
+            generated.append(task)
+        except DerivativeError as err:
+            _failed(task, str(err), max_attempts)
+        except (EnvironmentError, ValueError) as err:
+            # e.g., ffmpeg missing, disk full, or invalid output
+            _failed(task, 'Error generating %s: %s' % (task.dsid, err), max_attempts)
+
+    if generated:
+        try:
+            obj.save('generated derivatives: %s' % \
+                     ', '.join(task.dsid for task in generated))
+            for task in generated:
+                task.status = DerivativeTask.DONE
+                task.detail = ''
+                task.attempts += 1
+                task.save()
+        except RequestFailed as rf:
+            for task in generated:
+                _failed(task, 'Could not save to Fedora: %s' % rf, max_attempts)
+
+def _failed_running(tasks, detail, max_attempts):
+    for task in tasks:
+        if task.status == DerivativeTask.RUNNING:
+            _failed(task, detail, max_attempts)
+
+def _failed(task, detail, max_attempts=0):
+    logger.warn('Derivative %s for %s failed: %s' % (task.dsid, task.pid, detail))
+    task.attempts += 1
+    task.detail = detail
+    # return to the queue to be tried again, up to the maximum attempts
+    if task.attempts < max_attempts:
+        task.status = DerivativeTask.PENDING
+    else:
+        task.status = DerivativeTask.FAILED
+    task.save()
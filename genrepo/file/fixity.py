@@ -0,0 +1,198 @@
+# file genrepo/file/fixity.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Checksum calculation and fixity auditing for master file datastreams.'''
+
+import hashlib
+from itertools import islice
+import logging
+from Queue import Queue
+import threading
+import time
+
+from eulfedora.rdfns import relsext
+from eulfedora.util import RequestFailed
+
+from genrepo.file.models import FixityCheck, init_by_cmodel
+from genrepo.util import risearch_pids
+
+logger = logging.getLogger(__name__)
+
+# read file and datastream content in chunks of this size, so that
+# large masters are never loaded into memory all at once
+CHUNK_SIZE = 64 * 1024
+
+
+def hash_for_type(checksum_type):
+    '''Initialize a new :mod:`hashlib` hash object for a Fedora
+    checksum type (e.g., MD5, SHA-1, SHA-256).'''
+    return hashlib.new(checksum_type.replace('-', '').lower())
+
+def file_checksum(fileobj, checksum_type='MD5'):
+    '''Calculate the checksum for a file-like object (e.g., an uploaded
+    file), reading it in chunks.  The file is rewound when done, so it
+    can be read again (e.g., when it is sent to Fedora).'''
+    digest = hash_for_type(checksum_type)
+    fileobj.seek(0)
+    chunk = fileobj.read(CHUNK_SIZE)
+    while chunk:
+        digest.update(chunk)
+        chunk = fileobj.read(CHUNK_SIZE)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def datastream_checksum(obj, dsid, checksum_type='MD5'):
+    '''Calculate the checksum for the current content of a datastream by
+    streaming it from Fedora in chunks.'''
+    digest = hash_for_type(checksum_type)
+    url = 'objects/%s/datastreams/%s/content' % (obj.pid, dsid)
+    with obj.api.open('GET', url) as response:
+        chunk = response.read(CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = response.read(CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+def audit_pids(repo):
+    '''Generator of pids for all file objects that should be audited
+    (i.e., everything that belongs to a collection), each listed once
+    even if it belongs to several collections.'''
+    query = 'select distinct ?item where { ?item <%s> ?coll }' % relsext.isMemberOfCollection
+    return risearch_pids(repo, query)
+
+def skip_recent(pids, since, batch_size=500):
+    '''Generator of the pids in a sequence that have not been checked
+    since the specified date, looking up recent checks for
+    ``batch_size`` pids at a time.'''
+    pids = iter(pids)
+    batch = list(islice(pids, batch_size))
+    while batch:
+        recent = set(FixityCheck.objects.filter(pid__in=batch, checked__gte=since) \
+                                        .values_list('pid', flat=True))
+        for pid in batch:
+            if pid not in recent:
+                yield pid
+        batch = list(islice(pids, batch_size))
+
+def audit_object(pid, repo=None):
+    '''Verify the master datastream of a single object against the
+    checksum stored in Fedora.
+
+    :returns: unsaved :class:`~genrepo.file.models.FixityCheck`
+    '''
+    check = FixityCheck(pid=pid)
+    try:
+        obj = init_by_cmodel(pid, repo=repo)
+        check.dsid = obj.master.id
+        if not obj.master.exists:
+            check.status = FixityCheck.MISSING
+            return check
+        check.checksum_type = obj.master.checksum_type or ''
+        check.expected = obj.master.checksum or ''
+        if not check.expected or check.checksum_type in ('', 'DISABLED'):
+            check.status = FixityCheck.NO_CHECKSUM
+            return check
+        check.computed = datastream_checksum(obj, check.dsid, check.checksum_type)
+        if check.computed.lower() == check.expected.lower():
+            check.status = FixityCheck.OK
+        else:
+            check.status = FixityCheck.MISMATCH
+    except Exception as err:
+        # record any failure as a result instead of stopping the audit
+        check.status = FixityCheck.ERROR
+        check.detail = str(err)
+    return check
+
+
+class RateLimiter(object):
+    '''Thread-safe rate limiter; :meth:`wait` blocks as needed so that
+    callers proceed no more than ``rate`` times per second.  A rate of
+    None or 0 means no limit.'''
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class FixityAudit(object):
+    '''Audit a series of objects using a pool of worker threads, with
+    an optional limit on the number of objects checked per second
+    across all workers.
+
+    :param repo: :class:`~eulfedora.server.Repository` to audit
+    :param workers: number of objects to check in parallel
+    :param rate: maximum number of objects to check per second
+    '''
+
+    def __init__(self, repo, workers=4, rate=None):
+        self.repo = repo
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+
+    def run(self, pids, callback):
+        '''Audit all of the specified pids.  ``callback`` is called in
+        the current thread with each :class:`FixityCheck` as it
+        completes, so results can be recorded incrementally.'''
+        # bounded queue, so a very large pid list is consumed as needed
+        todo = Queue(self.workers * 2)
+        done = Queue()
+
+        def producer():
+            try:
+                for pid in pids:
+                    todo.put(pid)
+            except RequestFailed as rf:
+                logger.error('Error retrieving pids to audit: %s' % rf)
+            finally:
+                # one stop marker for each worker
+                for i in range(self.workers):
+                    todo.put(None)
+
+        def worker():
+            try:
+                pid = todo.get()
+                while pid is not None:
+                    self.limiter.wait()
+                    done.put(audit_object(pid, self.repo))
+                    pid = todo.get()
+            finally:
+                done.put(None)
+
+        threads = [threading.Thread(target=producer)] + \
+                  [threading.Thread(target=worker) for i in range(self.workers)]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+
+        finished = 0
+        while finished < self.workers:
+            check = done.get()
+            if check is None:
+                finished += 1
+            else:
+                callback(check)
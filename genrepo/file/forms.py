@@ -30,12 +30,31 @@ def _collection_options():
           for c in collections ]
     return options
 
+_dcmi_type_options = None
+def dcmi_type_options():
+    '''Choices for dc:type, based on the DCMI type vocabulary.  The
+    vocabulary is loaded the first time it is needed and then reused,
+    since it must be retrieved and parsed as RDF.'''
+    global _dcmi_type_options
+    if _dcmi_type_options is None:
+        # add a blank value first so there is no default value
+        _dcmi_type_options = [(None, '')] + [(t, t) for t in DublinCore().dcmi_types]
+    return _dcmi_type_options
+
 class IngestForm(forms.Form):
     """Form to ingest new files into the repository."""
     collection = DynamicChoiceField(choices=_collection_options, required=True,
         help_text="Add the new item to this collection.")
     file = forms.FileField()
 
+class UploadForm(forms.Form):
+    '''Form to start a resumable upload (see :mod:`genrepo.file.uploads`).'''
+    collection = DynamicChoiceField(choices=_collection_options, required=True)
+    filename = forms.CharField(max_length=255)
+    size = forms.IntegerField(min_value=0)
+    md5 = forms.RegexField(regex=r'^[0-9a-fA-F]{32}$', required=False,
+        help_text='MD5 checksum of the complete file, to be verified at commit')
+
 class ReadOnlyInput(forms.TextInput):
     '''Customized version of :class:`~django.forms.TextInput` to act as
     a read-only form field.'''
@@ -58,10 +77,7 @@ class DublinCoreEditForm(XmlObjectForm):
     # make title required
     title = forms.CharField(required=True)
     # configure dc:type as a choice field populated by DCMI type vocabulary
-    _type_choices = [(t, t) for t in DublinCore().dcmi_types]
-    # add a blank value first so there is no default value
-    _type_choices.insert(0, (None, '')) 
-    type = forms.ChoiceField(choices=_type_choices, required=False)
+    type = DynamicChoiceField(choices=dcmi_type_options, required=False)
     # TODO: possibly make type a repeating field?
 
     # TODO: sort order is a little strange because of xmlobject formsets
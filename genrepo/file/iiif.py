@@ -0,0 +1,247 @@
+# file genrepo/file/iiif.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''`IIIF Image API 2.1 <http://iiif.io/api/image/2.1/>`_ requests for
+images served by Djatoka.
+
+Requests are parsed and normalized to their canonical form, so that
+equivalent requests written differently (``pct:`` or pixel regions,
+``max`` or ``full`` sizes, and so on) are cached once, and translated to
+Djatoka ``getRegion`` parameters, decoding the image at the smallest
+resolution level that is at least as large as the requested size.
+
+Supported: regions in pixels, percentages, ``full`` and ``square``;
+sizes by width, height, percentage, exact or best-fit dimensions (but
+not larger than the region); rotation by multiples of 90 degrees;
+``default`` and ``color`` quality; ``jpg`` and ``png`` formats.'''
+
+from collections import namedtuple
+import math
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+
+from genrepo.cache import cache_key, is_public, request_identity, PUBLIC
+from genrepo.metrics import cache_result
+
+CONTEXT = 'http://iiif.io/api/image/2/context.json'
+PROTOCOL = 'http://iiif.io/api/image'
+PROFILE = 'http://iiif.io/api/image/2/level1.json'
+# features supported beyond level 1
+SUPPORTS = ['regionSquare', 'rotationBy90s', 'sizeByConfinedWh', 'sizeByDistortedWh',
+            'sizeByWh', 'cors', 'canonicalLinkHeader']
+# format extension: djatoka format (mimetype)
+FORMATS = {'jpg': 'image/jpeg', 'png': 'image/png'}
+QUALITIES = ('default', 'color')
+TILE_SIZE = 256
+
+NUMBER = r'\d+(?:\.\d+)?'
+PIXEL_REGION_RE = re.compile(r'^(\d+),(\d+),(\d+),(\d+)$')
+PCT_REGION_RE = re.compile(r'^pct:(%s),(%s),(%s),(%s)$' % ((NUMBER,) * 4))
+SIZE_RE = re.compile(r'^(!)?(\d*),(\d*)$')
+PCT_SIZE_RE = re.compile(r'^pct:(%s)$' % NUMBER)
+ROTATION_RE = re.compile(r'^(!)?(%s)$' % NUMBER)
+
+
+class IIIFError(ValueError):
+    '''Invalid (status 400) or unsupported (status 501) IIIF request.'''
+    def __init__(self, message, status=400):
+        super(IIIFError, self).__init__(message)
+        self.status = status
+
+
+class ImageInfo(namedtuple('ImageInfo', 'width height levels')):
+    '''Size of an image and the number of resolution levels Djatoka can
+    decode it at, below the full size.'''
+    __slots__ = ()
+
+    def level_size(self, reduction):
+        'Size of the image at ``reduction`` levels below the full size.'
+        return (int(math.ceil(self.width / 2.0 ** reduction)),
+                int(math.ceil(self.height / 2.0 ** reduction)))
+
+
+def parse_region(value, info):
+    '''Parse the region of an IIIF request.
+
+    :returns: tuple of (x, y, width, height) in full-size pixels,
+        limited to the image
+    '''
+    if value == 'full':
+        return 0, 0, info.width, info.height
+    if value == 'square':
+        side = min(info.width, info.height)
+        return (info.width - side) // 2, (info.height - side) // 2, side, side
+    match = PIXEL_REGION_RE.match(value)
+    if match:
+        x, y, w, h = [int(n) for n in match.groups()]
+    else:
+        match = PCT_REGION_RE.match(value)
+        if match is None:
+            raise IIIFError('Invalid region: %s' % value)
+        px, py, pw, ph = [float(n) for n in match.groups()]
+        x, y = int(round(px * info.width / 100)), int(round(py * info.height / 100))
+        w, h = int(round(pw * info.width / 100)), int(round(ph * info.height / 100))
+    w, h = min(w, info.width - x), min(h, info.height - y)
+    if w <= 0 or h <= 0:
+        raise IIIFError('Region is outside the image or empty: %s' % value)
+    return x, y, w, h
+
+def parse_size(value, region):
+    '''Parse the size of an IIIF request for a region, as returned by
+    :func:`parse_region`.
+
+    :returns: tuple of (width, height)
+    '''
+    rw, rh = region[2], region[3]
+    if value in ('full', 'max'):
+        return rw, rh
+    match = PCT_SIZE_RE.match(value)
+    if match:
+        pct = float(match.group(1))
+        w, h = int(round(rw * pct / 100)), int(round(rh * pct / 100))
+    else:
+        match = SIZE_RE.match(value)
+        if match is None or match.groups()[1:] == ('', ''):
+            raise IIIFError('Invalid size: %s' % value)
+        confined, w, h = match.groups()
+        if confined and (not w or not h):
+            raise IIIFError('Invalid size: %s' % value)
+        if confined:
+            # largest size with the region's proportions that fits
+            scale = min(float(w) / rw, float(h) / rh)
+            w, h = int(round(rw * scale)), int(round(rh * scale))
+        elif not h:
+            w = int(w)
+            h = int(round(rh * float(w) / rw))
+        elif not w:
+            h = int(h)
+            w = int(round(rw * float(h) / rh))
+        else:
+            w, h = int(w), int(h)
+    if w <= 0 or h <= 0:
+        raise IIIFError('Size is empty: %s' % value)
+    if w > rw or h > rh:
+        raise IIIFError('Sizes larger than the region are not supported: %s' % value, 501)
+    return w, h
+
+def parse_rotation(value):
+    'Parse the rotation of an IIIF request, as degrees clockwise.'
+    match = ROTATION_RE.match(value)
+    if match is None:
+        raise IIIFError('Invalid rotation: %s' % value)
+    mirror, degrees = match.groups()
+    degrees = float(degrees)
+    if degrees > 360:
+        raise IIIFError('Invalid rotation: %s' % value)
+    if mirror or degrees % 90:
+        raise IIIFError('Only rotation by multiples of 90 degrees is supported', 501)
+    return int(degrees) % 360
+
+
+def image_request(info, region, size, rotation, quality, format):
+    '''Normalize an IIIF image request and translate it for Djatoka.
+
+    :param info: :class:`ImageInfo` for the image
+    :returns: tuple of the canonical form of the request (the IIIF url
+        path after the identifier) and a dictionary of parameters for
+        Djatoka ``getRegion``
+    :raises: :class:`IIIFError` if the request is invalid or unsupported
+    '''
+    if format not in FORMATS:
+        raise IIIFError('Unsupported format: %s' % format, 501)
+    if quality not in QUALITIES:
+        raise IIIFError('Unsupported quality: %s' % quality, 501)
+    x, y, rw, rh = parse_region(region, info)
+    w, h = parse_size(size, (x, y, rw, rh))
+    degrees = parse_rotation(rotation)
+
+    if (x, y, rw, rh) == (0, 0, info.width, info.height):
+        canonical_region = 'full'
+    else:
+        canonical_region = '%d,%d,%d,%d' % (x, y, rw, rh)
+    if (w, h) == (rw, rh):
+        canonical_size = 'full'
+    elif h == int(round(rh * float(w) / rw)):
+        canonical_size = '%d,' % w
+    else:
+        canonical_size = '%d,%d' % (w, h)
+    canonical = '%s/%s/%d/default.%s' % (canonical_region, canonical_size, degrees, format)
+
+    # decode at the smallest level at least as large as the requested size
+    reduction = 0
+    while reduction < info.levels and \
+              math.ceil(rw / 2.0 ** (reduction + 1)) >= w and \
+              math.ceil(rh / 2.0 ** (reduction + 1)) >= h:
+        reduction += 1
+    level_w = int(math.ceil(rw / 2.0 ** reduction))
+    level_h = int(math.ceil(rh / 2.0 ** reduction))
+    params = {
+        # djatoka regions are y,x in full-size pixels and height,width at the level
+        'region': '%d,%d,%d,%d' % (y, x, level_h, level_w),
+        'level': str(info.levels - reduction),
+        'rotate': str(degrees),
+        'format': FORMATS[format],
+    }
+    if (level_w, level_h) != (w, h):
+        params['scale'] = '%d,%d' % (w, h)
+    return canonical, params
+
+
+def image_identity(summary, request):
+    '''Access class for cached image information and content: shared by
+    everyone for public images (see :mod:`genrepo.cache`).'''
+    if is_public(summary.cmodels):
+        return PUBLIC
+    return request_identity(request)
+
+def image_info(summary, request):
+    '''Get the :class:`ImageInfo` for an image object, from the cache if
+    possible, otherwise from Djatoka image metadata.
+
+    :param summary: :class:`~genrepo.summary.ObjectSummary` for the object
+    :returns: :class:`ImageInfo`, or None if the object is not an image
+    '''
+    # import here to avoid a circular import with the object models
+    from genrepo.file.models import ImageObject, init_by_cmodel, object_types
+    if not issubclass(object_types.for_cmodels(summary.cmodels), ImageObject):
+        return None
+    key = cache_key('image-info', summary.pid, image_identity(summary, request))
+    info = cache.get(key)
+    cache_result('image-info', info is not None)
+    if info is None:
+        metadata = init_by_cmodel(summary.pid, request).image_metadata
+        info = ImageInfo(int(metadata['width']), int(metadata['height']),
+                         int(metadata.get('levels', 0)))
+        cache.set(key, info, getattr(settings, 'IMAGE_INFO_TIMEOUT', 24 * 60 * 60))
+    return info
+
+def info_json(info, base_uri):
+    'IIIF image information, as a dictionary to be serialized as JSON.'
+    return {
+        '@context': CONTEXT,
+        '@id': base_uri,
+        'protocol': PROTOCOL,
+        'width': info.width,
+        'height': info.height,
+        'sizes': [dict(zip(('width', 'height'), info.level_size(reduction)))
+                  for reduction in xrange(info.levels, 0, -1)],
+        'tiles': [{'width': TILE_SIZE,
+                   'scaleFactors': [2 ** reduction for reduction in xrange(info.levels + 1)]}],
+        'profile': [PROFILE, {'formats': sorted(FORMATS), 'qualities': list(QUALITIES),
+                              'supports': SUPPORTS}],
+    }
@@ -0,0 +1,39 @@
+# file genrepo/file/management/commands/clear_object_cache.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from django.core.management.base import BaseCommand
+
+from genrepo.cache import clear_negative, invalidate
+
+
+class Command(BaseCommand):
+    help = '''Discard cached information about Fedora objects.  If pids are specified,
+everything cached for those objects is discarded; otherwise, all cached "not found"
+and "permission denied" results are discarded.  Run this after changing access
+policies directly in Fedora.'''
+    args = '[pid pid ...]'
+
+    def handle(self, *pids, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if pids:
+            for pid in pids:
+                invalidate(pid)
+            if verbosity:
+                print 'Cleared cached information for %d objects' % len(pids)
+        else:
+            clear_negative()
+            if verbosity:
+                print 'Cleared cached negative results for all objects'
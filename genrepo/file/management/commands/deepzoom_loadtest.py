@@ -0,0 +1,117 @@
+# file genrepo/file/management/commands/deepzoom_loadtest.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+from optparse import make_option
+import urllib2
+
+from django.core.management.base import BaseCommand, CommandError
+
+from genrepo.loadtest import DeepZoomLoad
+
+# minimum increase in throughput for an added step of viewers to count
+# as an improvement; below this, the site is saturated
+SATURATION_GAIN = 1.1
+
+
+class Command(BaseCommand):
+    help = '''Load test deep zoom image viewing on a running site, with simulated
+Seadragon viewers zooming and panning around the specified images.  The number of
+simultaneous viewers is increased in steps, reporting tile throughput, response time
+percentiles, cache hit ratio (from the X-Cache header, if a cache in front of the
+site sets one) and, when the site is using the fedora_standin server, how many
+requests the site had waiting on the backend at once; the step where throughput
+stops increasing is where the site's workers are saturated.'''
+    args = 'base_url pid [pid ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--viewers',
+            dest='viewers', default='1,2,4,8,16',
+            help='''Comma-separated numbers of simultaneous viewers to test (default: %default)'''),
+        make_option('--duration', '-d',
+            dest='duration', type='int', default=60,
+            help='''Seconds to run each step (default: %default)'''),
+        make_option('--connections',
+            dest='connections', type='int', default=6,
+            help='''Connections each viewer uses at once (default: %default)'''),
+        make_option('--think-time',
+            dest='think_time', type='float', default=1.0,
+            help='''Average seconds between viewer actions (default: %default)'''),
+        make_option('--actions',
+            dest='actions', type='int', default=12,
+            help='''Zooms and pans per viewing session (default: %default)'''),
+        make_option('--standin',
+            dest='standin', default=None,
+            help='''URL of the fedora_standin server the site is using, to report
+            backend concurrency'''),
+        make_option('--seed',
+            dest='seed', type='int', default=None,
+            help='''Random seed, to repeat the same sessions'''),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) < 2:
+            raise CommandError('Specify the site url and at least one image pid')
+        base_url, pids = args[0], args[1:]
+        try:
+            steps = [int(v) for v in options['viewers'].split(',')]
+        except ValueError:
+            raise CommandError('Invalid number of viewers: %s' % options['viewers'])
+
+        load = DeepZoomLoad(base_url, pids, connections=options['connections'],
+                            think_time=options['think_time'], actions=options['actions'],
+                            seed=options['seed'])
+
+        print '%7s %9s %8s %8s %8s %7s %6s %12s' % ('viewers', 'tiles/s', 'p50', 'p95',
+            'p99', 'errors', 'hit%', 'backend avg/peak')
+        results = []
+        for viewers in steps:
+            if options['standin']:
+                self.standin_stats(options['standin'], reset=True)
+            stats = load.run(viewers, options['duration'])
+            tiles = stats.summary('tile')
+            backend = self.standin_stats(options['standin']) if options['standin'] else None
+            results.append((viewers, tiles, backend))
+            print '%7d %9.1f %8s %8s %8s %7d %6s %12s' % (viewers, tiles['per_second'],
+                self.ms(tiles['p50']), self.ms(tiles['p95']), self.ms(tiles['p99']),
+                tiles['errors'] + stats.summary('dzi')['errors'],
+                '%.1f' % (tiles['hit_ratio'] * 100) if tiles['hit_ratio'] is not None else '-',
+                '%.1f/%d' % (backend['mean_in_flight'], backend['peak_in_flight'])
+                    if backend else '-')
+
+        for previous, current in zip(results, results[1:]):
+            if current[1]['per_second'] < previous[1]['per_second'] * SATURATION_GAIN:
+                print '\nThroughput stopped increasing at %d viewers (%.1f tiles/s at %d).' % \
+                      (current[0], previous[1]['per_second'], previous[0])
+                if previous[2]:
+                    print 'The site had %.1f requests waiting on the backend on average ' \
+                          '(peak %d) at that point: about the number of requests it can ' \
+                          'handle at once.' % (previous[2]['mean_in_flight'],
+                                              previous[2]['peak_in_flight'])
+                break
+        else:
+            print '\nThroughput was still increasing at %d viewers; ' \
+                  'try more viewers to find the saturation point.' % results[-1][0]
+
+    def ms(self, seconds):
+        return '%dms' % (seconds * 1000) if seconds is not None else '-'
+
+    def standin_stats(self, url, reset=False):
+        url = '%s/standin-stats%s' % (url.rstrip('/'), '?reset=1' if reset else '')
+        try:
+            return json.loads(urllib2.urlopen(url).read())
+        except (IOError, ValueError) as err:
+            raise CommandError('Could not get stand-in server statistics from %s: %s' % (url, err))
@@ -0,0 +1,50 @@
+# file genrepo/file/management/commands/expire_uploads.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from genrepo.file.models import ResumableUpload
+from genrepo.file.uploads import remove_upload
+
+
+class Command(BaseCommand):
+    help = '''Remove resumable uploads that have not received any data
+recently, along with the partial files on disk.'''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', '-d',
+            dest='days', type='int',
+            default=getattr(settings, 'UPLOAD_EXPIRY_DAYS', 7),
+            help='''Remove uploads with no activity for this many days (default: %default)'''),
+        )
+
+    def handle(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        cutoff = datetime.now() - timedelta(days=options['days'])
+        expired = ResumableUpload.objects.filter(updated__lt=cutoff)
+        count = 0
+        for upload in expired:
+            if verbosity > 1:
+                print 'Removing upload of %s by %s' % (upload.filename, upload.user.username)
+            remove_upload(upload)
+            upload.delete()
+            count += 1
+        if verbosity:
+            print 'Removed %d expired uploads' % count
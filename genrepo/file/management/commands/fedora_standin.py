@@ -0,0 +1,66 @@
+# file genrepo/file/management/commands/fedora_standin.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from genrepo.loadtest import StandInServer
+
+
+class Command(BaseCommand):
+    help = '''Run a stand-in for Fedora and the Djatoka image service, for load
+testing deep zoom image viewing without a real repository (see deepzoom_loadtest).
+Point the site's FEDORA_ROOT at http://host:port/fedora/; every pid is treated as
+an image of the configured size, and each tile takes about the configured delay
+to generate.'''
+    args = '[host:]port'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--size',
+            dest='size', default='6000x4000',
+            help='''Size of every image, as WIDTHxHEIGHT (default: %default)'''),
+        make_option('--delay',
+            dest='delay', type='float', default=0.05,
+            help='''Average seconds to generate each tile (default: %default)'''),
+        make_option('--tile-bytes',
+            dest='tile_bytes', type='int', default=12 * 1024,
+            help='''Size of each tile returned (default: %default)'''),
+        )
+
+    def handle(self, address='8180', **options):
+        host, port = address.rsplit(':', 1) if ':' in address else ('', address)
+        try:
+            size = tuple(int(v) for v in options['size'].lower().split('x'))
+            port = int(port)
+        except ValueError:
+            raise CommandError('Invalid port or image size')
+        if len(size) != 2:
+            raise CommandError('Image size must be WIDTHxHEIGHT')
+
+        verbosity = int(options.get('verbosity', 1))
+        server = StandInServer((host, port), image_size=size, region_delay=options['delay'],
+                               tile_bytes=options['tile_bytes'], verbose=verbosity > 1)
+        print 'Fedora stand-in listening on http://%s:%d/fedora/ (Ctrl-C to stop)' % \
+              (host or 'localhost', port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stats = server.stats()
+            print '\nHandled %d requests; at most %d at once' % \
+                  (stats['requests'], stats['peak_in_flight'])
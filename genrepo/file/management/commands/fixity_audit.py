@@ -0,0 +1,103 @@
+# file genrepo/file/management/commands/fixity_audit.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from getpass import getpass
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from genrepo.fedora import Repository
+
+from genrepo.file.fixity import FixityAudit, audit_pids, skip_recent
+from genrepo.file.models import FixityCheck
+
+
+class Command(BaseCommand):
+    def get_password_option(option, opt, value, parser):
+        setattr(parser.values, option.dest, getpass())
+
+    help = '''Verify master file datastreams by streaming the content from Fedora
+and recalculating the checksum.  Results are recorded as they complete; objects
+checked within the audit interval are skipped, so an interrupted audit can simply
+be run again to pick up where it stopped.  If pids are specified, only those
+objects are checked.'''
+    args = '[pid pid ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--username', '-u',
+            dest='username',
+            action='store',
+            help='''Username to connect to fedora'''),
+        make_option('--password',
+            dest='password',
+            action='callback', callback=get_password_option,
+            help='''Prompt for password required when username used'''),
+        make_option('--workers', '-w',
+            dest='workers', type='int',
+            default=getattr(settings, 'FIXITY_AUDIT_WORKERS', 4),
+            help='''Number of objects to check in parallel (default: %default)'''),
+        make_option('--rate', '-r',
+            dest='rate', type='float',
+            default=getattr(settings, 'FIXITY_AUDIT_RATE', None),
+            help='''Maximum number of objects to check per second (default: %default)'''),
+        make_option('--interval', '-i',
+            dest='interval', type='int',
+            default=getattr(settings, 'FIXITY_AUDIT_INTERVAL', 90),
+            help='''Skip objects checked within this many days; 0 to check everything
+            (default: %default)'''),
+        )
+
+    def handle(self, *pids, **options):
+        repo_args = {}
+        if options.get('username') is not None:
+            repo_args['username'] = options.get('username')
+        if options.get('password') is not None:
+            repo_args['password'] = options.get('password')
+        repo = Repository(**repo_args)
+
+        verbosity = int(options.get('verbosity', 1))
+
+        if not pids:
+            pids = audit_pids(repo)
+            if options['interval']:
+                # skip anything checked recently, so an interrupted audit resumes
+                since = datetime.now() - timedelta(days=options['interval'])
+                if verbosity > 1:
+                    print 'Skipping objects checked since %s' % since
+                pids = skip_recent(pids, since)
+
+        totals = defaultdict(int)
+
+        def record(check):
+            check.save()
+            totals[check.status] += 1
+            if check.status != FixityCheck.OK:
+                print '%s %s: %s %s' % (check.pid, check.dsid, check.get_status_display(),
+                                        check.detail)
+            elif verbosity > 1:
+                print '%s %s: %s' % (check.pid, check.dsid, check.get_status_display())
+
+        audit = FixityAudit(repo, workers=options['workers'], rate=options['rate'])
+        audit.run(pids, record)
+
+        if verbosity:
+            print '\nChecked %d objects' % sum(totals.values())
+            for status, label in FixityCheck.STATUS_CHOICES:
+                if totals[status]:
+                    print '  %s: %d' % (label, totals[status])
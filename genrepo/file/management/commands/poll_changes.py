@@ -0,0 +1,74 @@
+# file genrepo/file/management/commands/poll_changes.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from genrepo.fedora import Repository
+from genrepo.file.changes import consume_spool, fedora_date, poll_resource_index
+
+
+class Command(BaseCommand):
+    help = '''Find objects changed in Fedora outside this site and update cached
+information and local indexes (collection hierarchy, sitemaps) for just those
+objects.  By default, the Resource Index is polled for objects modified since the
+last run; with --spool, Fedora notification messages in a spool directory are
+processed instead.  Run from cron, or with --interval to keep polling.'''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--spool',
+            dest='spool', action='store_true', default=False,
+            help='''Process notification messages in CHANGES_SPOOL_DIR instead of
+            polling the Resource Index'''),
+        make_option('--since',
+            dest='since',
+            help='''Process changes since this UTC date (e.g., 2011-06-01T00:00:00Z)
+            instead of the last run; defaults to now the first time'''),
+        make_option('--interval',
+            dest='interval', type='int', default=None,
+            help='''Keep polling, waiting this many seconds between polls'''),
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        since = None
+        if options['since']:
+            try:
+                since = fedora_date(options['since'])
+            except ValueError as err:
+                raise CommandError(err)
+        if options['spool'] and not getattr(settings, 'CHANGES_SPOOL_DIR', None):
+            raise CommandError('CHANGES_SPOOL_DIR is not configured')
+
+        repo = Repository()
+        while True:
+            if options['spool']:
+                counts = consume_spool(repo)
+            else:
+                counts = poll_resource_index(repo, since=since)
+                since = None
+            if verbosity > 1 or (verbosity and counts['changes']):
+                print '%d changes: invalidated %d objects, updated %d collections ' \
+                      'and %d sitemap entries, removed %d' % \
+                      (counts['changes'], counts.get('invalidated', 0),
+                       counts.get('collections', 0), counts.get('sitemap', 0),
+                       counts.get('removed', 0))
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
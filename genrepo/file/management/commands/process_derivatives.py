@@ -0,0 +1,103 @@
+# file genrepo/file/management/commands/process_derivatives.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from collections import defaultdict
+from getpass import getpass
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from genrepo.fedora import BackendUnavailable, Repository
+
+from genrepo.file.derivatives import pending_tasks, process_object, \
+     queue_derivatives, queue_existing
+from genrepo.file.models import DerivativeTask, init_by_cmodel, object_types
+
+
+class Command(BaseCommand):
+    def get_password_option(option, opt, value, parser):
+        setattr(parser.values, option.dest, getpass())
+
+    help = '''Generate queued derivative datastreams (e.g., web-playable copies
+of audio and video, video poster frames, audio waveforms).  Derivatives are
+queued when files are ingested;
+if pids are specified, derivatives for those objects are queued again first
+(e.g., to regenerate them with new settings).  Several copies of this command
+can be run at once to share the work.'''
+    args = '[pid pid ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--username', '-u',
+            dest='username',
+            action='store',
+            help='''Username to connect to fedora'''),
+        make_option('--password',
+            dest='password',
+            action='callback', callback=get_password_option,
+            help='''Prompt for password required when username used'''),
+        make_option('--existing',
+            dest='existing', action='store_true', default=False,
+            help='''Queue derivatives for existing objects that have never had them
+            generated (e.g., after upgrading)'''),
+        make_option('--limit', '-l',
+            dest='limit', type='int', default=None,
+            help='''Maximum number of objects to process (default: all pending)'''),
+        )
+
+    def handle(self, *pids, **options):
+        repo_args = {}
+        if options.get('username') is not None:
+            repo_args['username'] = options.get('username')
+        if options.get('password') is not None:
+            repo_args['password'] = options.get('password')
+        repo = Repository(**repo_args)
+
+        verbosity = int(options.get('verbosity', 1))
+
+        for pid in pids:
+            queue_derivatives(init_by_cmodel(pid, repo=repo))
+        if options['existing']:
+            for objtype in object_types.types:
+                if objtype.DERIVATIVES:
+                    count = queue_existing(repo, objtype)
+                    if verbosity:
+                        print 'Queued derivatives for %d existing %s objects' % \
+                              (count, objtype.__name__)
+
+        groups = pending_tasks()
+        if options['limit']:
+            groups = groups[:options['limit']]
+
+        totals = defaultdict(int)
+        for pid, tasks in groups:
+            try:
+                processed = process_object(pid, tasks, repo)
+            except BackendUnavailable as err:
+                raise CommandError('Stopping: %s' % err)
+            for task in processed:
+                totals[task.status] += 1
+                if task.status != DerivativeTask.DONE:
+                    print '%s %s: %s (attempt %d) %s' % (task.pid, task.dsid,
+                        task.get_status_display(), task.attempts, task.detail)
+                elif verbosity > 1:
+                    print '%s %s: %s' % (task.pid, task.dsid, task.get_status_display())
+
+        if verbosity:
+            print '\nProcessed %d derivatives for %d objects' % \
+                  (sum(totals.values()), len(groups))
+            for status, label in DerivativeTask.STATUS_CHOICES:
+                if totals[status]:
+                    print '  %s: %d' % (label, totals[status])
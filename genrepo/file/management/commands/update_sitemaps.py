@@ -0,0 +1,60 @@
+# file genrepo/file/management/commands/update_sitemaps.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from genrepo.fedora import Repository
+from genrepo.file.sitemaps import rebuild_index, sitemap_root, update_sitemaps
+
+
+class Command(BaseCommand):
+    help = '''Update the static sitemap files for search engine crawlers.  Only the
+sitemaps for collections whose items have changed since the last update are
+rewritten, so this can be run frequently (e.g., from cron).'''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild',
+            dest='rebuild', action='store_true', default=False,
+            help='''Regenerate the local sitemap index from Fedora first (e.g., after
+            objects were changed outside this site)'''),
+        make_option('--all',
+            dest='all', action='store_true', default=False,
+            help='''Rewrite every sitemap, whether changed or not'''),
+        make_option('--base-url',
+            dest='base_url',
+            help='''Site url to use in the sitemaps (default: SITEMAP_BASE_URL, or
+            the current Site)'''),
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        if options['rebuild']:
+            count = rebuild_index(Repository())
+            if verbosity:
+                print 'Indexed %d objects' % count
+
+        updated, removed = update_sitemaps(force=options['all'], base=options['base_url'])
+        if verbosity > 1:
+            for collection in updated:
+                print 'Updated sitemap for %s' % (collection or 'objects not in a collection')
+            for collection in removed:
+                print 'Removed sitemap for %s' % (collection or 'objects not in a collection')
+        if verbosity:
+            print 'Updated %d and removed %d collection sitemaps in %s' % \
+                  (len(updated), len(removed), sitemap_root())
@@ -0,0 +1,106 @@
+# file genrepo/file/mime.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''MIME type detection for uploaded and ingested files.
+
+Detection uses libmagic on the first few kilobytes of a file, which is
+all it needs, with a magic handle that is loaded once per thread and
+reused.  Generic results (e.g., ``application/octet-stream`` or
+``application/zip``) are refined using the type implied by the file
+extension.  Results are remembered by a hash of the header, so
+batches of similar files are only sniffed once.'''
+
+import hashlib
+import mimetypes
+import os
+import threading
+
+# number of bytes from the start of a file used to detect its type
+HEADER_SIZE = 8 * 1024
+
+# magic results that only identify a container or very general format;
+# the file extension is used for a more specific type where one is known
+GENERIC_TYPES = ('application/octet-stream', 'application/zip', 'text/plain',
+                 'application/xml', 'text/xml', 'application/x-empty')
+
+# maximum number of detection results to remember
+MEMO_SIZE = 1024
+
+_local = threading.local()
+_memo = {}
+_memo_lock = threading.Lock()
+
+
+def get_magic():
+    '''libmagic handle for the current thread; handles are not
+    thread-safe, so each thread loads its own the first time it is needed.'''
+    handle = getattr(_local, 'magic', None)
+    if handle is None:
+        import magic
+        handle = _local.magic = magic.Magic(mime=True)
+    return handle
+
+def read_header(fileobj):
+    '''Read the beginning of a file-like object for type detection,
+    leaving the file positioned at the start.'''
+    fileobj.seek(0)
+    header = fileobj.read(HEADER_SIZE)
+    fileobj.seek(0)
+    return header
+
+def extension_type(filename):
+    'MIME type implied by a filename extension, if any.'
+    if filename:
+        return mimetypes.guess_type(filename, strict=False)[0]
+
+def combine(magic_type, hint):
+    '''Choose a MIME type based on the libmagic result and the type
+    implied by the filename; the filename is only used when magic does
+    not give a specific type.'''
+    # some versions of libmagic include charset information
+    magic_type = (magic_type or '').split(';')[0].strip()
+    if hint and (not magic_type or magic_type in GENERIC_TYPES):
+        return hint
+    return magic_type or 'application/octet-stream'
+
+def detect_header(header, filename=None):
+    'Detect the MIME type for a file, given its header and filename.'
+    hint = extension_type(filename)
+    key = (hashlib.md5(header).hexdigest(), hint)
+    mimetype = _memo.get(key)
+    if mimetype is None:
+        mimetype = combine(get_magic().from_buffer(header), hint)
+        with _memo_lock:
+            if len(_memo) >= MEMO_SIZE:
+                _memo.clear()
+            _memo[key] = mimetype
+    return mimetype
+
+def detect_mimetype(fileobj, filename=None):
+    '''Detect the MIME type of a file-like object (e.g., an uploaded
+    file).  If no filename is specified, the file's ``name`` is used
+    for extension hints, if it has one.'''
+    if filename is None:
+        filename = getattr(fileobj, 'name', None)
+    return detect_header(read_header(fileobj), filename)
+
+def detect_mimetypes(paths):
+    '''Generator of (path, mimetype) for a sequence of file paths, for
+    detecting types in bulk (e.g., for a batch ingest).'''
+    for path in paths:
+        with open(path, 'rb') as fileobj:
+            header = fileobj.read(HEADER_SIZE)
+        yield path, detect_header(header, os.path.basename(path))
@@ -14,17 +14,25 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from datetime import datetime
 from rdflib import Literal
 import json
 
 from django.conf import settings
-from django.db.models import Model
+from django.contrib.auth.models import User
+from django.db.models import Model, Manager, CharField, DateTimeField, TextField, \
+     PositiveIntegerField, BigIntegerField, ForeignKey
 
 from eulfedora import rdfns
 from eulfedora.models import DigitalObject, FileDatastream
-from eulfedora.server import Repository
+from genrepo.fedora import Repository
 from eulxml import xmlmap
+from genrepo.cache import cache_key, invalidate
 from genrepo.collection.models import AccessibleObject, CollectionObject
+from genrepo.file.registry import ObjectTypeRegistry
+from genrepo.pids import next_pid
+from genrepo.rels import RelsExtReader
+from genrepo.singleflight import single_flight
 
 
 class File(Model):
@@ -36,7 +44,156 @@ class File(Model):
             # add, change, and delete are created by default
         )
 
-class FileObject(DigitalObject):
+class FixityCheck(Model):
+    '''Result of a single fixity check on the master datastream of a
+    :class:`FileObject`, as recorded by the ``fixity_audit`` command.
+    '''
+    OK = 'ok'
+    MISMATCH = 'mismatch'
+    NO_CHECKSUM = 'no checksum'
+    MISSING = 'missing'
+    ERROR = 'error'
+    STATUS_CHOICES = (
+        (OK, 'Checksum verified'),
+        (MISMATCH, 'Checksum mismatch'),
+        (NO_CHECKSUM, 'No checksum stored in Fedora'),
+        (MISSING, 'Master datastream not found'),
+        (ERROR, 'Error checking object'),
+    )
+
+    pid = CharField(max_length=255, db_index=True)
+    dsid = CharField(max_length=255, blank=True)
+    checksum_type = CharField(max_length=10, blank=True)
+    expected = CharField(max_length=128, blank=True,
+        help_text='checksum stored in Fedora')
+    computed = CharField(max_length=128, blank=True,
+        help_text='checksum calculated from the datastream content')
+    status = CharField(max_length=20, choices=STATUS_CHOICES)
+    detail = TextField(blank=True)
+    checked = DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        get_latest_by = 'checked'
+
+    def __unicode__(self):
+        return '%s/%s %s' % (self.pid, self.dsid, self.status)
+
+
+class SitemapEntryManager(Manager):
+
+    def listed(self, cmodels, collection):
+        '''Check if an object belongs in the sitemaps, given its content
+        models and collection: only publicly accessible objects in a
+        collection are listed.'''
+        return bool(collection) and AccessibleObject.PUBLIC_ACCESS_CMODEL in cmodels
+
+    def update_for(self, obj):
+        '''Add, update or remove the sitemap index entry for a
+        :class:`FileObject` that has just been saved.'''
+        rels = obj.rels
+        if self.listed(rels.cmodels, rels.collection):
+            return self.update_entry(obj.pid, rels.collection, datetime.utcnow())
+        self.filter(pid=obj.pid).delete()
+
+    def update_entry(self, pid, collection, lastmod):
+        '''Add or update the sitemap index entry for a pid, with the uri
+        or pid of its collection (if any) and its last modification.'''
+        entry, created = self.get_or_create(pid=pid, defaults={'lastmod': lastmod})
+        entry.collection = (collection or '').replace('info:fedora/', '')
+        entry.lastmod = lastmod
+        entry.save()
+        return entry
+
+
+class SitemapEntry(Model):
+    '''Local index of the objects listed in the sitemaps for search
+    engine crawlers (see :mod:`genrepo.file.sitemaps`), so that sitemaps
+    can be generated without querying Fedora; only publicly accessible
+    objects that belong to a collection are included.  Kept current when a
+    :class:`FileObject` is saved; can be regenerated from Fedora with
+    ``update_sitemaps --rebuild``.'''
+    pid = CharField(max_length=255, unique=True)
+    collection = CharField(max_length=255, blank=True, db_index=True,
+        help_text='pid of the collection the object belongs to')
+    lastmod = DateTimeField(help_text='last modified, in UTC')
+
+    objects = SitemapEntryManager()
+
+    def __unicode__(self):
+        return self.pid
+
+class ChangeFeedState(Model):
+    '''Position of a repository change feed (see
+    :mod:`genrepo.file.changes`): the latest Fedora modification date
+    processed, and the objects already processed at around that time.'''
+    name = CharField(max_length=50, unique=True)
+    high_water = CharField(max_length=30, blank=True,
+        help_text='latest modification processed, as a Fedora (UTC) date')
+    recent = TextField(blank=True,
+        help_text='JSON object of pid: modification date for changes already processed')
+    updated = DateTimeField(auto_now=True)
+
+    def get_recent(self):
+        return json.loads(self.recent) if self.recent else {}
+
+    def set_recent(self, recent):
+        self.recent = json.dumps(recent)
+
+    def __unicode__(self):
+        return '%s at %s' % (self.name, self.high_water)
+
+class ResumableUpload(Model):
+    '''A file being uploaded in chunks, to be ingested as a new
+    :class:`FileObject` once it is complete (see :mod:`genrepo.file.uploads`).
+    '''
+    user = ForeignKey(User)
+    collection = CharField(max_length=255,
+        help_text='URI of the collection the new object will belong to')
+    filename = CharField(max_length=255)
+    size = BigIntegerField(help_text='total size of the file, in bytes')
+    checksum = CharField(max_length=32, blank=True,
+        help_text='MD5 checksum of the complete file, if supplied by the client')
+    created = DateTimeField(auto_now_add=True)
+    updated = DateTimeField(auto_now=True, db_index=True)
+
+    def __unicode__(self):
+        return '%s (%d bytes)' % (self.filename, self.size)
+
+class DerivativeTask(Model):
+    '''A derivative datastream (e.g., a web-playable copy of a video)
+    waiting to be generated for a :class:`FileObject`, or the outcome of
+    generating it.  Tasks are queued at ingest and processed in the
+    background by the ``process_derivatives`` command.
+    '''
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Waiting to be generated'),
+        (RUNNING, 'Being generated'),
+        (DONE, 'Generated'),
+        (FAILED, 'Failed'),
+    )
+
+    pid = CharField(max_length=255)
+    dsid = CharField(max_length=255)
+    status = CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING,
+                       db_index=True)
+    attempts = PositiveIntegerField(default=0)
+    detail = TextField(blank=True)
+    created = DateTimeField(auto_now_add=True)
+    updated = DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('pid', 'dsid')
+        ordering = ['created']
+
+    def __unicode__(self):
+        return '%s/%s %s' % (self.pid, self.dsid, self.status)
+
+
+class FileObject(RelsExtReader, DigitalObject):
     """An opaque file for repositing on behalf of a user. Inherits the
     standard Dublin Core and RELS-EXT datastreams from
     :class:`~eulcore.fedora.models.DigitalObject`, and adds both a
@@ -45,6 +202,11 @@ class FileObject(DigitalObject):
     """
     CONTENT_MODELS = [ AccessibleObject.PUBLIC_ACCESS_CMODEL ]
     view_template = 'file/view.html'
+    # name of the icon used for this type of object in lists
+    icon = 'file'
+    # ids of datastreams generated from the master file in the background
+    # (see genrepo.file.derivatives)
+    DERIVATIVES = ()
 
     @property
     def default_pidspace(self):
@@ -52,15 +214,29 @@ class FileObject(DigitalObject):
         # dynamic property so it will always get current setting (e.g., if changed for tests)
         return getattr(settings, 'FEDORA_PIDSPACE', None)
 
+    def get_default_pid(self):
+        # use pids reserved in advance, instead of asking fedora for each one
+        return next_pid(self)
+
 
     master = FileDatastream("master", "reposited master file", defaults={
             'versionable': True,
         })
     "reposited master :class:`~eulcore.fedora.models.FileDatastream`"
 
+    @property
+    def access_copy(self):
+        '''Datastream to deliver to browsers for playback or display: the
+        web-friendly ``access`` derivative, for types that define one and
+        once it has been generated, or otherwise the master file.'''
+        access = getattr(self, 'access', None)
+        if access is not None and access.exists:
+            return access
+        return self.master
+
 
     def _get_oai_id(self):
-        return self.rels_ext.content.value(subject=self.uriref, predicate=rdfns.oai.itemID)
+        return self.rels.oai_id
     def _set_oai_id(self, value):
 	# if value is None, remove the value
         if value is None:
@@ -69,15 +245,27 @@ class FileObject(DigitalObject):
             # update/replace any oai item id (only one allowed)
             self.rels_ext.content.set((self.uriref, rdfns.oai.itemID, Literal(value)))
     def _del_oai_id(self):
-        self.rels_ext.content.remove((self.uriref, rdfns.oai.itemID, self.oai_id))
+        self.rels_ext.content.remove((self.uriref, rdfns.oai.itemID, None))
     oai_id = property(_get_oai_id, _set_oai_id, _del_oai_id)
 
+    def save(self, logMessage=None):
+        result = super(FileObject, self).save(logMessage)
+        # any cached summary for this object is now out of date
+        invalidate(self.pid)
+        # keep the local sitemap index current
+        SitemapEntry.objects.update_for(self)
+        return result
+
+    _collection = None
     @property
     def collection(self):
-        collection_uri = self.rels_ext.content.value(subject=self.uriref,
-                                                     predicate=rdfns.relsext.isMemberOfCollection)
-        if collection_uri:
-            return CollectionObject(self.api, str(collection_uri).replace('info:fedora/', ''))
+        pid = self.rels.collection
+        if pid:
+            # reuse the same collection object (and any information it has
+            # already loaded) unless the collection has changed
+            if self._collection is None or self._collection.pid != pid:
+                self._collection = CollectionObject(self.api, pid)
+            return self._collection
     
 
 class DziImage(xmlmap.XmlObject):
@@ -98,11 +286,13 @@ class ImageObject(FileObject):
     
     content_types = ('image/jpeg', 'image/jp2', 'image/gif', 'image/bmp', 'image/png', 'image/tiff')
     view_template = 'file/image.html'
+    icon = 'image'
 
     # DC & RELS-EXT inherited; override master
     master = FileDatastream("source-image", "Master TIFF image", defaults={
             'mimetype': 'image/tiff',
-            # FIXME: versioned? checksum?
+            'checksum_type': 'MD5',
+            # FIXME: versioned?
         })
 
     has_preview = True
@@ -149,40 +339,77 @@ class AudioObject(FileObject):
     CONTENT_MODELS = [ 'info:fedora/genrepo-demo:Audio-1.0', AccessibleObject.PUBLIC_ACCESS_CMODEL ]
     content_types = ('audio/mpeg',)
     view_template = 'file/audio.html'
+    icon = 'audio'
 
     master = FileDatastream("source-audio", "Master audio", defaults={
             'mimetype': 'audio/mpeg',
-            # FIXME: versioned? checksum?
+            'checksum_type': 'MD5',
+            # FIXME: versioned?
+        })
+    access = FileDatastream("access-audio", "Streaming audio (MP3)", defaults={
+            'mimetype': 'audio/mpeg',
+            'checksum_type': 'MD5',
+        })
+    waveform = FileDatastream("waveform", "Waveform peaks (JSON)", defaults={
+            'mimetype': 'application/json',
+        })
+    DERIVATIVES = ('access-audio', 'waveform')
+
+class VideoObject(FileObject):
+    CONTENT_MODELS = [ 'info:fedora/genrepo-demo:Video-1.0', AccessibleObject.PUBLIC_ACCESS_CMODEL ]
+    content_types = ('video/mp4', 'video/quicktime', 'video/mpeg', 'video/x-msvideo',
+                     'video/x-ms-wmv', 'video/x-matroska', 'video/x-flv',
+                     'video/webm', 'video/ogg', 'video/3gpp')
+    view_template = 'file/video.html'
+    icon = 'video'
+
+    master = FileDatastream("source-video", "Master video", defaults={
+            'checksum_type': 'MD5',
         })
+    access = FileDatastream("access-video", "Web video (H.264/AAC MP4)", defaults={
+            'mimetype': 'video/mp4',
+            'checksum_type': 'MD5',
+        })
+    poster = FileDatastream("poster", "Poster frame", defaults={
+            'mimetype': 'image/jpeg',
+        })
+    DERIVATIVES = ('access-video', 'poster')
+
 
-digital_object_classes = [ImageObject, EmoryImageObject, AudioObject]
+# registered object types; other apps may register additional types
+object_types = ObjectTypeRegistry(default=FileObject)
+for objtype in (ImageObject, EmoryImageObject, AudioObject, VideoObject):
+    object_types.register(objtype)
 
+# list of registered object types, in registration order
+digital_object_classes = object_types.types
 
-def init_by_cmodel(pid, request=None):
+
+def _object_type(repo, pid):
+    # get a list of content models on the object, and the type to use for them
+    cmodels = repo.risearch.get_objects('info:fedora/%s' % pid, rdfns.model.hasModel)
+    return object_types.for_cmodels(cmodels)
+
+def init_by_cmodel(pid, request=None, repo=None):
     # given a pid, initialize the appropriate type of digital object class based on content models
-    repo = Repository(request=request)
-    obj = repo.get_object(pid)
-    # get a lit of content models on the object
-    cmodels = list(repo.risearch.get_objects(obj.uri, rdfns.model.hasModel))
-    type = None
-    for objtype in digital_object_classes:
-        # if every content model for the digital object class is present, use that type
-        if all(cm in cmodels for cm in objtype.CONTENT_MODELS):
-            type = objtype
-            break
-
-    # fallback
-    if type is None:
-        type = FileObject
-
-    return repo.get_object(pid, type=type)
+    # (uses the specified repository, if any; otherwise, credentials from the request);
+    # identical lookups made at the same time share a single risearch query
+    if repo is None:
+        repo = Repository(request=request)
+    key = cache_key('object-type', pid, repo.username or 'anonymous')
+    return repo.get_object(pid, type=single_flight(key, _object_type, repo, pid))
+
+def init_by_cmodels(pids, request=None, repo=None):
+    '''Initialize objects of the appropriate types for a list of pids,
+    determining all of the types with a single Resource Index query.'''
+    if repo is None:
+        repo = Repository(request=request)
+    pids = list(pids)
+    types = object_types.for_pids(pids, repo)
+    return [repo.get_object(pid, type=types[pid]) for pid in pids]
 
     
 def object_type_from_mimetype(mimetype):
     # given a file mimetype, determine the appropriate digitalobject class to use
-    for objtype in digital_object_classes:
-        if hasattr(objtype, 'content_types') and mimetype in objtype.content_types:
-            return objtype
-
-    # if no match was found, use generic file object class
-    return FileObject
+    # (if no match is found, use generic file object class)
+    return object_types.for_mimetype(mimetype)
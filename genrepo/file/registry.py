@@ -0,0 +1,107 @@
+# file genrepo/file/registry.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Registry of :class:`~eulfedora.models.DigitalObject` types, for
+choosing the class to use for an existing object (by its content
+models) or a new one (by the mimetype of its file).
+
+Lookups go through indexes built at registration time, so the cost of
+dispatch depends on the number of types that share a content model or
+mimetype, not the total number of types registered.'''
+
+from eulfedora.rdfns import model
+
+from genrepo.util import risearch_rows
+
+
+class ObjectTypeRegistry(object):
+    '''Registry of object types.
+
+    :param default: type to use when no registered type matches
+    '''
+
+    def __init__(self, default=None):
+        self.default = default
+        self.types = []
+        # mimetype -> type
+        self._by_mimetype = {}
+        # content model -> list of (required content models, type),
+        # most specific first
+        self._by_cmodel = {}
+
+    def register(self, objtype, content_types=None):
+        '''Register an object type.  Existing objects are matched on the
+        class ``CONTENT_MODELS``: an object must have all of them, and
+        when several types match, the one requiring the most content
+        models is used (or the first registered, if that is a tie).  New
+        objects are matched on mimetype, using ``content_types`` or the
+        class attribute of the same name; the first type registered for
+        a mimetype is used.
+        '''
+        if objtype in self.types:
+            return
+        order = len(self.types)
+        self.types.append(objtype)
+        if content_types is None:
+            content_types = getattr(objtype, 'content_types', ())
+        for mimetype in content_types:
+            self._by_mimetype.setdefault(mimetype, objtype)
+
+        cmodels = frozenset(objtype.CONTENT_MODELS)
+        entry = (-len(cmodels), order, cmodels, objtype)
+        for cmodel in cmodels:
+            candidates = self._by_cmodel.setdefault(cmodel, [])
+            candidates.append(entry)
+            candidates.sort()
+
+    def for_cmodels(self, cmodels):
+        'Most specific registered type for an object with the specified content models.'
+        cmodels = frozenset(str(cm) for cm in cmodels)
+        best = None
+        for cmodel in cmodels:
+            for entry in self._by_cmodel.get(cmodel, ()):
+                # candidates are sorted, so only the first full match
+                # for each content model needs to be considered
+                if entry[2] <= cmodels:
+                    if best is None or entry < best:
+                        best = entry
+                    break
+        if best is None:
+            return self.default
+        return best[3]
+
+    def for_mimetype(self, mimetype):
+        'Type to use for a new object with a file of the specified mimetype.'
+        return self._by_mimetype.get(mimetype, self.default)
+
+    def for_pids(self, pids, repo, batch_size=100):
+        '''Determine the types for a list of existing objects with one
+        Resource Index query for every ``batch_size`` objects, so that
+        queries stay a manageable size for long lists.
+
+        :returns: dictionary of pid -> type
+        '''
+        pids = list(pids)
+        cmodels = dict((pid, set()) for pid in pids)
+        for start in xrange(0, len(pids), batch_size):
+            batch = pids[start:start + batch_size]
+            query = 'select ?obj ?cmodel where { ?obj <%s> ?cmodel . filter (%s) }' % \
+                    (model.hasModel, ' || '.join('?obj = <info:fedora/%s>' % pid for pid in batch))
+            for obj, cmodel in risearch_rows(repo, query):
+                pid = obj.replace('info:fedora/', '')
+                if pid in cmodels:
+                    cmodels[pid].add(cmodel)
+        return dict((pid, self.for_cmodels(cms)) for pid, cms in cmodels.iteritems())
@@ -0,0 +1,231 @@
+# file genrepo/file/sitemaps.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Sitemaps for search engine crawlers, so that they can find every
+publicly accessible item in a collection without walking the collection
+pages.
+
+Sitemaps are generated from the local :class:`~genrepo.file.models.SitemapEntry`
+index by the ``update_sitemaps`` command, and written as static gzip
+files to **SITEMAP_ROOT**, to be served by the web server at the root of
+the site: ``sitemap.xml.gz`` is the sitemap index, which lists a sitemap
+(of at most **SITEMAP_PAGE_SIZE** file view urls) for each collection,
+or several for large collections.  Only the sitemaps of collections with
+new, changed or removed items are rewritten.'''
+
+import gzip
+import json
+import os
+import re
+import tempfile
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import Count, Max
+
+from eulfedora.rdfns import model, relsext
+
+from genrepo.collection.models import AccessibleObject
+from genrepo.file.models import SitemapEntry
+from genrepo.util import risearch_rows
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+# most urls allowed in a single sitemap
+MAX_URLS = 50000
+# sitemap index file name
+INDEX_NAME = 'sitemap.xml.gz'
+# record of the sitemaps written for each collection
+MANIFEST_NAME = 'sitemaps.json'
+# fedora's last modification date, in the resource index
+LAST_MODIFIED = 'info:fedora/fedora-system:def/view#lastModifiedDate'
+
+
+def sitemap_root():
+    'Directory sitemaps are written to (**SITEMAP_ROOT**).'
+    return getattr(settings, 'SITEMAP_ROOT', os.path.join(settings.MEDIA_ROOT, 'sitemaps'))
+
+def base_url():
+    '''Url of the site, for urls in the sitemaps: **SITEMAP_BASE_URL**
+    if set, otherwise based on the current :class:`~django.contrib.sites.models.Site`.'''
+    url = getattr(settings, 'SITEMAP_BASE_URL', None)
+    if url is None:
+        url = 'http://%s%s' % (Site.objects.get_current().domain,
+                               getattr(settings, 'SITE_URL_PREFIX', ''))
+    return url
+
+def _w3c_date(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def _write_gzip(root, name, chunks):
+    # write to a temporary file and move it into place, so that a
+    # partially written sitemap is never served
+    tmp = tempfile.NamedTemporaryFile(dir=root, prefix='.%s.' % name, delete=False)
+    try:
+        zipped = gzip.GzipFile(filename=name[:-len('.gz')], mode='wb', fileobj=tmp)
+        for chunk in chunks:
+            zipped.write(chunk.encode('utf-8'))
+        zipped.close()
+        tmp.close()
+        os.chmod(tmp.name, 0644)
+        os.rename(tmp.name, os.path.join(root, name))
+    except:
+        tmp.close()
+        os.remove(tmp.name)
+        raise
+
+def _urlset(entries, base):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="%s">\n' % SITEMAP_NS
+    for pid, lastmod in entries:
+        yield '<url><loc>%s%s</loc><lastmod>%s</lastmod></url>\n' % \
+              (escape(base), escape(reverse('file:view', kwargs={'pid': pid})),
+               _w3c_date(lastmod))
+    yield '</urlset>\n'
+
+def _sitemap_index(sitemaps, base):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="%s">\n' % SITEMAP_NS
+    for name, lastmod in sitemaps:
+        yield '<sitemap><loc>%s/%s</loc><lastmod>%s</lastmod></sitemap>\n' % \
+              (escape(base), escape(name), lastmod)
+    yield '</sitemapindex>\n'
+
+
+def sitemap_name(collection, page):
+    'File name for a page of the sitemap for a collection.'
+    slug = re.sub(r'[^A-Za-z0-9_.-]', '-', collection)
+    return 'sitemap-%s-%d.xml.gz' % (slug, page)
+
+def write_collection(collection, root, base, page_size):
+    '''Write the sitemaps for the indexed objects in a collection.
+
+    :returns: list of sitemap file names
+    '''
+    entries = SitemapEntry.objects.filter(collection=collection).order_by('pid') \
+                                  .values_list('pid', 'lastmod')
+    count = entries.count()
+    names = []
+    for page, start in enumerate(xrange(0, max(count, 1), page_size)):
+        name = sitemap_name(collection, page + 1)
+        _write_gzip(root, name, _urlset(entries[start:start + page_size].iterator(), base))
+        names.append(name)
+    return names
+
+def collection_signatures():
+    '''Number of indexed objects and latest modification for each
+    collection; a collection's sitemaps need to be rewritten when either
+    changes.'''
+    rows = SitemapEntry.objects.order_by().values('collection') \
+                       .annotate(count=Count('id'), latest=Max('lastmod'))
+    return dict((row['collection'], {'count': row['count'], 'latest': _w3c_date(row['latest'])})
+                for row in rows)
+
+
+def update_sitemaps(force=False, root=None, base=None, page_size=None):
+    '''Rewrite the sitemaps for collections that have changed since the
+    sitemaps were last updated, remove those for collections that no
+    longer have any objects, and rewrite the sitemap index if anything
+    changed.
+
+    :param force: rewrite all sitemaps, changed or not
+    :returns: tuple of lists of collections updated and removed
+    '''
+    root = root or sitemap_root()
+    base = (base or base_url()).rstrip('/')
+    if page_size is None:
+        page_size = min(getattr(settings, 'SITEMAP_PAGE_SIZE', MAX_URLS), MAX_URLS)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+    def remove(names):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    current = collection_signatures()
+    updated = []
+    for collection, signature in sorted(current.iteritems()):
+        previous = manifest.get(collection)
+        if previous is not None and not force and \
+               previous['count'] == signature['count'] and \
+               previous['latest'] == signature['latest'] and \
+               all(os.path.exists(os.path.join(root, name)) for name in previous['files']):
+            continue
+        signature['files'] = write_collection(collection, root, base, page_size)
+        if previous is not None:
+            remove(set(previous['files']) - set(signature['files']))
+        manifest[collection] = signature
+        updated.append(collection)
+
+    removed = [collection for collection in manifest if collection not in current]
+    for collection in removed:
+        remove(manifest.pop(collection)['files'])
+
+    if updated or removed or force or not os.path.exists(os.path.join(root, INDEX_NAME)):
+        sitemaps = []
+        for collection, info in sorted(manifest.iteritems()):
+            sitemaps.extend((name, info['latest']) for name in info['files'])
+        _write_gzip(root, INDEX_NAME, _sitemap_index(sitemaps, base))
+        tmp = manifest_path + '.tmp'
+        with open(tmp, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.rename(tmp, manifest_path)
+    return updated, sorted(removed)
+
+
+def _fedora_date(value):
+    # resource index dates are UTC, e.g. 2011-06-01T12:30:10.123Z
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+@transaction.commit_on_success
+def rebuild_index(repo):
+    '''Regenerate the sitemap index from the publicly accessible
+    collection members and their modification dates in the Fedora
+    Resource Index, with a single query.
+
+    :returns: number of objects indexed
+    '''
+    query = 'select ?item ?coll ?modified where { ?item <%s> ?coll . ' \
+            '?item <%s> <%s> . ?item <%s> ?modified }' % \
+            (relsext.isMemberOfCollection, model.hasModel,
+             AccessibleObject.PUBLIC_ACCESS_CMODEL, LAST_MODIFIED)
+    existing = dict((pid, (collection, lastmod)) for pid, collection, lastmod in
+                    SitemapEntry.objects.values_list('pid', 'collection', 'lastmod'))
+    seen = set()
+    for item, coll, modified in risearch_rows(repo, query):
+        pid = item.replace('info:fedora/', '')
+        if pid in seen:
+            continue
+        seen.add(pid)
+        values = (coll.replace('info:fedora/', ''), _fedora_date(modified))
+        if pid not in existing:
+            SitemapEntry.objects.create(pid=pid, collection=values[0], lastmod=values[1])
+        elif existing[pid] != values:
+            SitemapEntry.objects.filter(pid=pid).update(collection=values[0],
+                                                        lastmod=values[1])
+    gone = [pid for pid in existing if pid not in seen]
+    for i in xrange(0, len(gone), 500):
+        SitemapEntry.objects.filter(pid__in=gone[i:i + 500]).delete()
+    return len(seen)
@@ -0,0 +1,130 @@
+# file genrepo/file/streaming.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Delivery of datastream content to browsers in chunks, with support
+for HTTP byte-range requests so that audio and video players can seek
+without downloading the whole file.'''
+
+import re
+
+from django.http import HttpResponse
+
+from genrepo.fedora import open_stream
+from genrepo.file.fixity import CHUNK_SIZE
+
+# a single byte range; requests for multiple ranges get the full content
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class UnsatisfiableRange(ValueError):
+    'Requested byte range does not overlap the content.'
+
+
+def parse_range(header, size):
+    '''Parse an HTTP Range header for content of the specified size.
+
+    :returns: tuple of (first byte, last byte), inclusive, or None if no
+        range was requested or the header is not a single byte range
+        (in which case the full content should be sent)
+    :raises: :class:`UnsatisfiableRange` if the range is outside the content
+    '''
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # suffix range: the final N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise UnsatisfiableRange(header)
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise UnsatisfiableRange(header)
+    return first, last
+
+
+def datastream_chunks(obj, dsid, start=0, length=None):
+    '''Generator of the content of a datastream, in chunks, starting at
+    the specified byte offset and optionally limited to ``length`` bytes.
+    The range is requested from Fedora; if Fedora sends the full content
+    instead, the bytes before the start are skipped.'''
+    url = 'objects/%s/datastreams/%s/content' % (obj.pid, dsid)
+    headers = {}
+    if start or length is not None:
+        last = start + length - 1 if length is not None else ''
+        headers['Range'] = 'bytes=%s-%s' % (start, last)
+    # the client may only want part of the content, in which case the
+    # response is abandoned part way through
+    response, abandon = open_stream(obj.api.opener, url, headers)
+    try:
+        if start and response.status != 206:
+            skip = start
+            while skip:
+                chunk = response.read(min(CHUNK_SIZE, skip))
+                if not chunk:
+                    break
+                skip -= len(chunk)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = response.read(CHUNK_SIZE if remaining is None
+                                  else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    finally:
+        # don't read any remaining content, but don't reuse the connection
+        # it would be left on either
+        if not response.isclosed():
+            response.close()
+            abandon()
+
+
+def stream_datastream(request, obj, ds, headers=None):
+    '''Generate a response with the content of a datastream, sent as
+    it is read from Fedora.  If the request includes a single byte range,
+    only that part of the content is sent, with a 206 status.
+
+    :param obj: :class:`~eulfedora.models.DigitalObject` the datastream
+        belongs to
+    :param ds: :class:`~eulfedora.models.DatastreamObject` to send
+    :param headers: optional dictionary of additional response headers
+    '''
+    size = ds.size
+    try:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    except UnsatisfiableRange:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if byte_range is None:
+        response = HttpResponse(datastream_chunks(obj, ds.id), mimetype=ds.mimetype)
+        response['Content-Length'] = size
+    else:
+        first, last = byte_range
+        length = last - first + 1
+        response = HttpResponse(datastream_chunks(obj, ds.id, first, length),
+                                mimetype=ds.mimetype, status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        response['Content-Length'] = length
+    response['Accept-Ranges'] = 'bytes'
+    for header, value in (headers or {}).iteritems():
+        response[header] = value
+    return response
@@ -14,24 +14,74 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from array import array
+from contextlib import contextmanager
+from cStringIO import StringIO
+from datetime import datetime
+import gzip
+import hashlib
+import json
 import os
+import random
 from mock import Mock, patch
 import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib2
 
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.http import HttpResponse
 from django.test import Client, TestCase
 from rdflib import URIRef
 
 from eulfedora.server import Repository
 from eulfedora.rdfns import relsext
-from eulfedora.util import RequestFailed, PermissionDenied
+from eulfedora.util import parse_rdf
+from eulfedora.util import AuthorizingServerConnection, RequestFailed, PermissionDenied
 from eulxml.xmlmap.dc import DublinCore
 
+from genrepo.file.fixity import file_checksum, datastream_checksum, \
+     audit_object, FixityAudit
+from genrepo.file import fixity, forms, mime
 from genrepo.file.forms import IngestForm, DublinCoreEditForm
-from genrepo.file.models import FileObject, ImageObject, \
-     init_by_cmodel, object_type_from_mimetype
+from genrepo.rels import RelsExt, parse_rels_ext, graph_rels_ext
+from genrepo.file import derivatives
+from genrepo.file.derivatives import DerivativeError, ffmpeg, queue_derivatives, \
+     queue_existing, pending_tasks, claim, process_object, reclaim_stale, waveform_peaks
+from genrepo.file.models import FileObject, ImageObject, EmoryImageObject, \
+     AudioObject, VideoObject, FixityCheck, DerivativeTask, ResumableUpload, \
+     SitemapEntry, ChangeFeedState, init_by_cmodel, object_type_from_mimetype, \
+     object_types
+from genrepo.file import uploads
+from genrepo.file.uploads import OffsetMismatch, UploadTooLarge, UploadCommitted, \
+     append_chunk, committing, current_offset, remove_upload, upload_checksum, upload_path
+from genrepo.file.streaming import parse_range, datastream_chunks, \
+     stream_datastream, UnsatisfiableRange
+from genrepo.file.registry import ObjectTypeRegistry
+from genrepo.file import sitemaps
+from genrepo.file import changes
+from genrepo.file.iiif import IIIFError, ImageInfo, image_request, info_json
+from genrepo.cache import invalidate, object_version, request_identity, get_negative, \
+     clear_negative, NOT_FOUND, DENIED
+from genrepo.collection.models import AccessibleObject, CollectionNode, CollectionObject
 from genrepo.collection.tests import ADMIN_CREDENTIALS, NONADMIN_CREDENTIALS
+from genrepo.pids import PidPool
+from genrepo.admission import admission_control, check_rate, acquire_slot, release_slot
+from genrepo.singleflight import SingleFlight
+from genrepo.fedora import BackendUnavailable, CircuitBreaker, ResilientConnection, \
+     ReplicatedConnection, ReadRoutingMiddleware, operation, open_stream, \
+     reading_from_primary, _Hedge
+from genrepo import metrics
+from genrepo.loadtest import percentile, deepzoom_session, region_params, \
+     LoadStats, StandInServer
+from genrepo.summary import CollectionSummary, DublinCoreSummary, ObjectSummary, \
+     summarize, get_summary, get_summaries, DC_FIELDS, DC_LIST_FIELDS
 
 
 class FileObjectTest(TestCase):
@@ -54,6 +104,74 @@ class FileObjectTest(TestCase):
         fileobj.oai_id = None
         self.assert_('<oai:itemID>' not in fileobj.rels_ext.content.serialize())
 
+class RelsExtTest(TestCase):
+    # tests for lightweight RELS-EXT reading in genrepo.rels
+
+    rels_xml = '''<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+    xmlns:fedora-model="info:fedora/fedora-system:def/model#"
+    xmlns:rel="info:fedora/fedora-system:def/relations-external#"
+    xmlns:oai="http://www.openarchives.org/OAI/2.0/">
+  <rdf:Description rdf:about="info:fedora/file:1">
+    <fedora-model:hasModel rdf:resource="info:fedora/emory-control:PublicAccess"/>
+    <fedora-model:hasModel rdf:resource="info:fedora/genrepo-demo:Image-1.0"/>
+    <rel:isMemberOfCollection rdf:resource="info:fedora/coll:1"/>
+    <oai:itemID>oai:info:fedora/file:1</oai:itemID>
+  </rdf:Description>
+</rdf:RDF>'''
+
+    def test_parse_rels_ext(self):
+        rels = parse_rels_ext(self.rels_xml)
+        self.assertEqual('coll:1', rels.collection)
+        self.assertEqual('oai:info:fedora/file:1', rels.oai_id)
+        self.assertEqual(('info:fedora/emory-control:PublicAccess',
+                          'info:fedora/genrepo-demo:Image-1.0'), rels.cmodels)
+        self.assertEqual(None, rels.oai_set)
+        self.assertEqual(None, rels.parent)
+        # should be equivalent to reading the rdflib graph
+        graph = parse_rdf(self.rels_xml, 'info:fedora/file:1/RELS-EXT')
+        graph_rels = graph_rels_ext(graph, URIRef('info:fedora/file:1'))
+        for field in RelsExt.__slots__:
+            self.assertEqual(getattr(rels, field) if field != 'cmodels' else set(rels.cmodels),
+                             getattr(graph_rels, field) if field != 'cmodels' else set(graph_rels.cmodels))
+
+    def test_reader(self):
+        api = Mock()
+        api.getDatastreamDissemination.return_value = (self.rels_xml, 'url')
+        obj = FileObject(api, 'file:1')
+        self.assertEqual('oai:info:fedora/file:1', obj.oai_id)
+        self.assertEqual('coll:1', obj.collection.pid)
+        # raw RELS-EXT should only be retrieved once
+        self.assertEqual(1, api.getDatastreamDissemination.call_count)
+
+        # once the graph has been loaded for editing, values come from the graph
+        obj._ds_list = {'RELS-EXT': Mock()}
+        obj.oai_id = 'oai:new-id'
+        self.assertEqual('oai:new-id', obj.oai_id)
+        self.assertEqual('coll:1', obj.rels.collection)
+        del obj.oai_id
+        self.assertEqual(None, obj.oai_id)
+        # saved values are kept, not the ones read before the change
+        obj.oai_id = 'oai:new-id'
+        count = api.getDatastreamDissemination.call_count
+        with patch('eulfedora.models.DigitalObject._save_existing'):
+            obj.save()
+        obj.dscache = {}
+        self.assertEqual('oai:new-id', obj.oai_id)
+        self.assertEqual(count, api.getDatastreamDissemination.call_count)
+
+    def test_reader_ingest(self):
+        api = Mock()
+        obj = FileObject(api)
+        obj.pid = 'file:2'
+        api.ingest.return_value = 'file:2'
+        obj.rels_ext.content.add((obj.uriref, relsext.isMemberOfCollection,
+                                  URIRef('info:fedora/coll:1')))
+        obj.save()
+        # values saved are available after ingest without reading RELS-EXT
+        self.assertEqual('coll:1', obj.rels.collection)
+        self.assertEqual(0, api.getDatastreamDissemination.call_count)
+
+
 class ModelUtilsTest(TestCase):
     # tests for utility methods declared in file.models
 
@@ -94,6 +212,2020 @@ class ModelUtilsTest(TestCase):
         
 
 
+class ObjectTypeRegistryTest(TestCase):
+    # tests for object type dispatch in genrepo.file.registry
+
+    def setUp(self):
+        self.registry = ObjectTypeRegistry(default=FileObject)
+        for objtype in (ImageObject, EmoryImageObject, AudioObject):
+            self.registry.register(objtype)
+
+    def test_for_cmodels(self):
+        public = AccessibleObject.PUBLIC_ACCESS_CMODEL
+        self.assertEqual(ImageObject, self.registry.for_cmodels(ImageObject.CONTENT_MODELS))
+        self.assertEqual(AudioObject, self.registry.for_cmodels(AudioObject.CONTENT_MODELS))
+        self.assertEqual(EmoryImageObject,
+                         self.registry.for_cmodels(EmoryImageObject.CONTENT_MODELS + [public]))
+        # partial match falls back to the default
+        self.assertEqual(FileObject, self.registry.for_cmodels([public]))
+        self.assertEqual(FileObject, self.registry.for_cmodels([]))
+        # when several types match, the most specific is used
+        both = ImageObject.CONTENT_MODELS + EmoryImageObject.CONTENT_MODELS
+        self.assertEqual(ImageObject, self.registry.for_cmodels(both))
+        # rdflib URIs from risearch are handled
+        self.assertEqual(AudioObject,
+            self.registry.for_cmodels([URIRef(cm) for cm in AudioObject.CONTENT_MODELS]))
+
+        # a newly registered, more specific type takes precedence
+        class SpecialImage(ImageObject):
+            CONTENT_MODELS = ImageObject.CONTENT_MODELS + ['info:fedora/test:Special']
+        self.registry.register(SpecialImage)
+        self.assertEqual(SpecialImage, self.registry.for_cmodels(SpecialImage.CONTENT_MODELS))
+        self.assertEqual(ImageObject, self.registry.for_cmodels(ImageObject.CONTENT_MODELS))
+
+    def test_for_mimetype(self):
+        self.assertEqual(ImageObject, self.registry.for_mimetype('image/jpeg'))
+        self.assertEqual(AudioObject, self.registry.for_mimetype('audio/mpeg'))
+        self.assertEqual(FileObject, self.registry.for_mimetype('text/plain'))
+        # types can be registered for additional mimetypes
+        self.registry.register(type('PdfObject', (FileObject,), {}), ['application/pdf'])
+        self.assertEqual('PdfObject', self.registry.for_mimetype('application/pdf').__name__)
+
+    @patch('genrepo.file.registry.risearch_rows')
+    def test_for_pids(self, mockrows):
+        mockrows.return_value = [['info:fedora/%s' % 'img:1', cm]
+                                 for cm in ImageObject.CONTENT_MODELS] + \
+                                [['info:fedora/file:1', AccessibleObject.PUBLIC_ACCESS_CMODEL]]
+        types = self.registry.for_pids(['img:1', 'file:1', 'other:1'], Mock())
+        self.assertEqual({'img:1': ImageObject, 'file:1': FileObject,
+                          'other:1': FileObject}, types)
+        # all pids should be included in a single query
+        self.assertEqual(1, mockrows.call_count)
+        query = mockrows.call_args[0][1]
+        self.assert_('<info:fedora/img:1>' in query)
+        self.assert_('<info:fedora/other:1>' in query)
+        # no query for an empty list
+        self.assertEqual({}, self.registry.for_pids([], Mock()))
+        self.assertEqual(1, mockrows.call_count)
+        # long lists are queried in batches
+        types = self.registry.for_pids(['img:1', 'file:1', 'other:1'], Mock(), batch_size=2)
+        self.assertEqual(ImageObject, types['img:1'])
+        self.assertEqual(3, mockrows.call_count)
+        query = mockrows.call_args[0][1]
+        self.assert_('<info:fedora/other:1>' in query)
+        self.assert_('<info:fedora/img:1>' not in query)
+
+
+class FixityTest(TestCase):
+    # tests for checksum & fixity audit utilities in file.fixity
+
+    ingest_fname = os.path.join(settings.BASE_DIR, 'file', 'fixtures', 'hello.txt')
+    ingest_md5sum = '746308829575e17c3331bbcb00c0898b'   # md5sum of hello.txt
+
+    def setUp(self):
+        # mock object with a master datastream served by a fake Fedora response
+        self.obj = Mock(spec=FileObject, name='MockFileObject')
+        self.obj.pid = 'pid:1'
+        self.obj.master.id = 'master'
+        self.obj.master.exists = True
+        self.obj.master.checksum_type = 'MD5'
+        self.obj.master.checksum = self.ingest_md5sum
+        @contextmanager
+        def mock_open(method, url):
+            with open(self.ingest_fname) as ingest_f:
+                yield ingest_f
+        self.obj.api = Mock()
+        self.obj.api.open = mock_open
+
+    def test_file_checksum(self):
+        with open(self.ingest_fname) as ingest_f:
+            self.assertEqual(self.ingest_md5sum, file_checksum(ingest_f))
+            # file should be rewound so it can be read again
+            self.assertEqual(0, ingest_f.tell())
+        self.assertEqual(hashlib.sha1('hello, world').hexdigest(),
+                         file_checksum(StringIO('hello, world'), 'SHA-1'))
+
+    def test_datastream_checksum(self):
+        self.assertEqual(self.ingest_md5sum,
+                         datastream_checksum(self.obj, 'master', 'MD5'))
+
+    @patch('genrepo.util.risearch_rows')
+    def test_audit_pids(self, mockrows):
+        mockrows.return_value = iter([['info:fedora/file:1'], ['info:fedora/file:2']])
+        self.assertEqual(['file:1', 'file:2'], list(fixity.audit_pids(Mock())))
+        # objects in several collections are listed once
+        self.assert_('select distinct ?item' in mockrows.call_args[0][1])
+
+    def test_skip_recent(self):
+        FixityCheck.objects.create(pid='file:2', status=FixityCheck.OK)
+        FixityCheck.objects.create(pid='file:4', status=FixityCheck.OK)
+        old = FixityCheck.objects.create(pid='file:5', status=FixityCheck.OK)
+        FixityCheck.objects.filter(pk=old.pk).update(checked=datetime(2011, 1, 1))
+        pids = ['file:%d' % i for i in range(1, 7)]
+        self.assertEqual(['file:1', 'file:3', 'file:5', 'file:6'],
+                         list(fixity.skip_recent(iter(pids), datetime(2011, 6, 1), batch_size=4)))
+
+    @patch('genrepo.file.fixity.init_by_cmodel')
+    def test_audit_object(self, mockinit):
+        mockinit.return_value = self.obj
+        check = audit_object('pid:1')
+        self.assertEqual(FixityCheck.OK, check.status)
+        self.assertEqual('pid:1', check.pid)
+        self.assertEqual('master', check.dsid)
+        self.assertEqual(self.ingest_md5sum, check.computed)
+
+        # stored checksum does not match content
+        self.obj.master.checksum = 'bogus'
+        self.assertEqual(FixityCheck.MISMATCH, audit_object('pid:1').status)
+        # no checksum stored in fedora
+        self.obj.master.checksum_type = 'DISABLED'
+        self.assertEqual(FixityCheck.NO_CHECKSUM, audit_object('pid:1').status)
+        # datastream does not exist
+        self.obj.master.exists = False
+        self.assertEqual(FixityCheck.MISSING, audit_object('pid:1').status)
+        # fedora error
+        err_resp = Mock()
+        err_resp.status = 404
+        err_resp.reason = 'Not Found'
+        mockinit.side_effect = RequestFailed(err_resp)
+        check = audit_object('pid:1')
+        self.assertEqual(FixityCheck.ERROR, check.status)
+        self.assert_('404' in check.detail)
+
+    @patch('genrepo.file.fixity.audit_object')
+    def test_audit_run(self, mockaudit):
+        mockaudit.side_effect = lambda pid, repo: FixityCheck(pid=pid, status=FixityCheck.OK)
+        pids = ['pid:%d' % i for i in range(20)]
+        results = []
+        FixityAudit(Mock(), workers=3).run(iter(pids), results.append)
+        self.assertEqual(sorted(pids), sorted(check.pid for check in results),
+            'every pid should be audited exactly once')
+
+
+class StreamingTest(TestCase):
+    # tests for ranged datastream delivery in file.streaming
+
+    content = 'abcdefghij' * 10000
+
+    def setUp(self):
+        self.obj = Mock(spec=FileObject, name='MockFileObject')
+        self.obj.pid = 'vid:1'
+        self.obj.api = Mock()
+        self.ds = Mock(name='MockDatastream')
+        self.ds.id = 'access-video'
+        self.ds.size = len(self.content)
+        self.ds.mimetype = 'video/mp4'
+        self.request = Mock()
+        self.request.META = {}
+
+    def _mock_fedora(self, mockstream, status=200):
+        # simulate a fedora that sends the full content, or the requested range
+        self.requests = []
+        self.abandoned = []
+        def mock_stream(opener, url, headers=None):
+            self.requests.append((url, headers))
+            content = StringIO(self.content)
+            if status == 206 and 'Range' in headers:
+                first, last = headers['Range'][len('bytes='):].split('-')
+                content = StringIO(self.content[int(first):int(last) + 1 if last else None])
+            response = Mock()
+            response.status = status
+            response.read = content.read
+            response.isclosed = lambda: content.tell() == len(content.getvalue())
+            return response, lambda: self.abandoned.append(url)
+        mockstream.side_effect = mock_stream
+
+    def test_parse_range(self):
+        self.assertEqual(None, parse_range(None, 100))
+        self.assertEqual(None, parse_range('', 100))
+        self.assertEqual((0, 99), parse_range('bytes=0-', 100))
+        self.assertEqual((10, 19), parse_range('bytes=10-19', 100))
+        self.assertEqual((10, 99), parse_range('bytes=10-500', 100))
+        self.assertEqual((90, 99), parse_range('bytes=-10', 100))
+        self.assertEqual((0, 99), parse_range('bytes=-500', 100))
+        # multiple or malformed ranges: send everything
+        self.assertEqual(None, parse_range('bytes=0-1,5-6', 100))
+        self.assertEqual(None, parse_range('items=0-1', 100))
+        self.assertEqual(None, parse_range('bytes=-', 100))
+        self.assertRaises(UnsatisfiableRange, parse_range, 'bytes=100-', 100)
+        self.assertRaises(UnsatisfiableRange, parse_range, 'bytes=20-10', 100)
+        self.assertRaises(UnsatisfiableRange, parse_range, 'bytes=-0', 100)
+
+    @patch('genrepo.file.streaming.open_stream')
+    def test_datastream_chunks(self, mockstream):
+        self._mock_fedora(mockstream)
+        self.assertEqual(self.content, ''.join(datastream_chunks(self.obj, 'access-video')))
+        url, headers = self.requests[-1]
+        self.assertEqual('objects/vid:1/datastreams/access-video/content', url)
+        self.assertEqual({}, headers)
+        # range not supported by fedora: content before the start is skipped
+        chunks = datastream_chunks(self.obj, 'access-video', 70000, 15)
+        self.assertEqual(self.content[70000:70015], ''.join(chunks))
+        self.assertEqual({'Range': 'bytes=70000-70014'}, self.requests[-1][1])
+        chunks = datastream_chunks(self.obj, 'access-video', 99990)
+        self.assertEqual(self.content[99990:], ''.join(chunks))
+        self.assertEqual({'Range': 'bytes=99990-'}, self.requests[-1][1])
+        # range supported by fedora
+        self.assertEqual(self.obj.api.opener, mockstream.call_args[0][0])
+        # only the content not sent by fedora was left unread
+        self.assertEqual(['objects/vid:1/datastreams/access-video/content'], self.abandoned)
+        self._mock_fedora(mockstream, status=206)
+        chunks = datastream_chunks(self.obj, 'access-video', 70000, 15)
+        self.assertEqual(self.content[70000:70015], ''.join(chunks))
+        # abandoned by the client
+        chunks = datastream_chunks(self.obj, 'access-video')
+        chunks.next()
+        chunks.close()
+        self.assertEqual(['objects/vid:1/datastreams/access-video/content'], self.abandoned)
+
+    @patch('genrepo.file.streaming.open_stream')
+    def test_stream_datastream(self, mockstream):
+        self._mock_fedora(mockstream)
+        response = stream_datastream(self.request, self.obj, self.ds)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('bytes', response['Accept-Ranges'])
+        self.assertEqual(str(len(self.content)), response['Content-Length'])
+        self.assertEqual('video/mp4', response['Content-Type'])
+        self.assertEqual(self.content, response.content)
+
+        self.request.META['HTTP_RANGE'] = 'bytes=100-199'
+        response = stream_datastream(self.request, self.obj, self.ds,
+                                     headers={'Content-Disposition': 'inline'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('bytes 100-199/%d' % len(self.content), response['Content-Range'])
+        self.assertEqual('100', response['Content-Length'])
+        self.assertEqual('inline', response['Content-Disposition'])
+        self.assertEqual(self.content[100:200], response.content)
+
+        self.request.META['HTTP_RANGE'] = 'bytes=200000-'
+        response = stream_datastream(self.request, self.obj, self.ds)
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */%d' % len(self.content), response['Content-Range'])
+
+
+class DerivativesTest(TestCase):
+    # tests for background derivative generation in file.derivatives
+
+    def setUp(self):
+        self.obj = Mock(spec=VideoObject, name='MockVideoObject')
+        self.obj.pid = 'vid:1'
+        self.obj.DERIVATIVES = VideoObject.DERIVATIVES
+        self.obj.master.id = 'source-video'
+        self.obj.api = Mock()
+        @contextmanager
+        def mock_open(method, url):
+            yield StringIO('video content')
+        self.obj.api.open = mock_open
+
+    def test_video_type(self):
+        self.assertEqual(VideoObject, object_type_from_mimetype('video/mp4'))
+        self.assertEqual(VideoObject, object_type_from_mimetype('video/quicktime'))
+        self.assertEqual(VideoObject, object_types.for_cmodels(VideoObject.CONTENT_MODELS))
+        self.assertEqual('file/video.html', VideoObject.view_template)
+
+    def test_queue_derivatives(self):
+        queue_derivatives(self.obj)
+        tasks = DerivativeTask.objects.filter(pid='vid:1')
+        self.assertEqual(set(VideoObject.DERIVATIVES), set(t.dsid for t in tasks))
+        self.assert_(all(t.status == DerivativeTask.PENDING for t in tasks))
+        # queueing again resets existing tasks
+        tasks.update(status=DerivativeTask.FAILED, attempts=3)
+        queue_derivatives(self.obj)
+        tasks = DerivativeTask.objects.filter(pid='vid:1')
+        self.assertEqual(2, tasks.count())
+        self.assert_(all(t.status == DerivativeTask.PENDING and t.attempts == 0
+                         for t in tasks))
+        # nothing to queue for types without derivatives
+        fileobj = Mock(spec=FileObject, pid='file:1', DERIVATIVES=())
+        queue_derivatives(fileobj)
+        self.assertEqual(0, DerivativeTask.objects.filter(pid='file:1').count())
+
+    def test_pending_tasks(self):
+        queue_derivatives(self.obj)
+        DerivativeTask.objects.create(pid='vid:2', dsid='poster')
+        DerivativeTask.objects.create(pid='vid:3', dsid='poster', attempts=3)
+        groups = pending_tasks()
+        self.assertEqual(['vid:1', 'vid:2'], [pid for pid, tasks in groups])
+        self.assertEqual(2, len(groups[0][1]))
+        # a task can only be claimed once
+        task = groups[1][1][0]
+        self.assert_(claim(task))
+        self.assertFalse(claim(DerivativeTask.objects.get(pk=task.pk)))
+
+    @patch('genrepo.file.derivatives.init_by_cmodel')
+    def test_process_object(self, mockinit):
+        mockinit.return_value = self.obj
+        queue_derivatives(self.obj)
+        masters = []
+        def generate(obj, master, workdir):
+            masters.append(open(master).read())
+        def fail(obj, master, workdir):
+            raise DerivativeError('bad video')
+        with patch.dict(derivatives.GENERATORS, {'access-video': generate, 'poster': fail}):
+            tasks = process_object('vid:1', pending_tasks()[0][1])
+        self.assertEqual(2, len(tasks))
+        # master is downloaded for the generators to use
+        self.assertEqual(['video content'], masters)
+        self.obj.save.assert_called_once_with('generated derivatives: access-video')
+        access = DerivativeTask.objects.get(pid='vid:1', dsid='access-video')
+        self.assertEqual(DerivativeTask.DONE, access.status)
+        # failed task goes back in the queue, until too many attempts
+        poster = DerivativeTask.objects.get(pid='vid:1', dsid='poster')
+        self.assertEqual(DerivativeTask.PENDING, poster.status)
+        self.assertEqual(1, poster.attempts)
+        self.assertEqual('bad video', poster.detail)
+        settings.DERIVATIVE_MAX_ATTEMPTS = 2
+        try:
+            with patch.dict(derivatives.GENERATORS, {'poster': fail}):
+                process_object('vid:1', pending_tasks()[0][1])
+        finally:
+            del settings.DERIVATIVE_MAX_ATTEMPTS
+        poster = DerivativeTask.objects.get(pid='vid:1', dsid='poster')
+        self.assertEqual(DerivativeTask.FAILED, poster.status)
+        self.assertEqual([], pending_tasks())
+
+        # errors saving to fedora are recorded
+        queue_derivatives(self.obj)
+        err_resp = Mock()
+        err_resp.status = 500
+        err_resp.reason = 'Internal Server Error'
+        err_resp.read.return_value = 'server error'
+        self.obj.save.side_effect = RequestFailed(err_resp)
+        with patch.dict(derivatives.GENERATORS, {'access-video': generate, 'poster': generate}):
+            process_object('vid:1', pending_tasks()[0][1])
+        for task in DerivativeTask.objects.filter(pid='vid:1'):
+            self.assertEqual(DerivativeTask.PENDING, task.status)
+            self.assert_(task.detail.startswith('Could not save to Fedora'))
+
+    @patch('genrepo.file.derivatives.init_by_cmodel')
+    def test_process_object_errors(self, mockinit):
+        mockinit.return_value = self.obj
+        queue_derivatives(self.obj)
+        def fail(obj, master, workdir):
+            raise OSError(28, 'No space left on device')
+        # unexpected errors from a generator fail just that task
+        with patch.dict(derivatives.GENERATORS, {'access-video': Mock(), 'poster': fail}):
+            process_object('vid:1', pending_tasks()[0][1])
+        poster = DerivativeTask.objects.get(pid='vid:1', dsid='poster')
+        self.assertEqual(DerivativeTask.PENDING, poster.status)
+        self.assert_('No space left' in poster.detail)
+        self.assertEqual(DerivativeTask.DONE,
+                         DerivativeTask.objects.get(pid='vid:1', dsid='access-video').status)
+        # other errors return every task to the queue
+        mockinit.side_effect = IOError('connection reset')
+        process_object('vid:1', pending_tasks()[0][1])
+        poster = DerivativeTask.objects.get(pid='vid:1', dsid='poster')
+        self.assertEqual(DerivativeTask.PENDING, poster.status)
+        self.assertEqual(2, poster.attempts)
+        self.assertEqual('Unexpected error: connection reset', poster.detail)
+        # unavailable fedora stops processing
+        mockinit.side_effect = BackendUnavailable('Fedora is down')
+        self.assertRaises(BackendUnavailable, process_object, 'vid:1', pending_tasks()[0][1])
+        poster = DerivativeTask.objects.get(pid='vid:1', dsid='poster')
+        self.assertEqual(DerivativeTask.FAILED, poster.status)
+
+    def test_reclaim_stale(self):
+        task = DerivativeTask.objects.create(pid='vid:2', dsid='poster')
+        self.assert_(claim(task))
+        self.assertEqual(0, reclaim_stale())
+        self.assertEqual([], pending_tasks())
+        # running too long
+        DerivativeTask.objects.filter(pk=task.pk).update(updated=datetime(2011, 1, 1))
+        groups = pending_tasks()
+        self.assertEqual(['vid:2'], [pid for pid, tasks in groups])
+        self.assertEqual(1, groups[0][1][0].attempts)
+        self.assert_(claim(groups[0][1][0]))
+
+    def test_audio_type(self):
+        self.assertEqual(('access-audio', 'waveform'), AudioObject.DERIVATIVES)
+        for dsid in AudioObject.DERIVATIVES + VideoObject.DERIVATIVES:
+            self.assert_(dsid in derivatives.GENERATORS)
+
+    def test_access_copy(self):
+        access_copy = FileObject.access_copy.fget
+        # types without an access copy use the master
+        fileobj = Mock(spec=['master'])
+        self.assertEqual(fileobj.master, access_copy(fileobj))
+        # types with an access copy fall back to the master until it is generated
+        audio = Mock(spec=['master', 'access'])
+        audio.access.exists = False
+        self.assertEqual(audio.master, access_copy(audio))
+        audio.access.exists = True
+        self.assertEqual(audio.access, access_copy(audio))
+
+    def test_waveform_peaks(self):
+        samples = array('h', [0, 256, -512, 1024] * 5 + [32767, -32768])
+        tmp = tempfile.NamedTemporaryFile()
+        tmp.write(samples.tostring())
+        tmp.flush()
+        block, peaks = waveform_peaks(tmp.name, 10)
+        self.assertEqual(3, block)
+        self.assertEqual(16, len(peaks))
+        self.assertEqual([-2, 1, 0, 4], peaks[:4])
+        # values are scaled to 8 bits
+        self.assertEqual([-2, 127, -128, -128], peaks[-4:])
+        # blocks continue across chunks, including chunks of an odd size
+        self.assertEqual((block, peaks), waveform_peaks(tmp.name, 10, chunk_size=4))
+        self.assertEqual((block, peaks), waveform_peaks(tmp.name, 10, chunk_size=5))
+        # fewer samples than points
+        block, peaks = waveform_peaks(tmp.name, 1000)
+        self.assertEqual(1, block)
+        self.assertEqual(44, len(peaks))
+
+    def test_queue_existing(self):
+        repo = Mock()
+        objs = [Mock(pid='audio:%d' % i, DERIVATIVES=AudioObject.DERIVATIVES)
+                for i in range(3)]
+        repo.get_objects_with_cmodel.return_value = objs
+        DerivativeTask.objects.create(pid='audio:1', dsid='waveform', status=DerivativeTask.DONE)
+        self.assertEqual(2, queue_existing(repo, AudioObject))
+        repo.get_objects_with_cmodel.assert_called_with(AudioObject.CONTENT_MODELS[0],
+                                                        type=AudioObject)
+        self.assertEqual(4, DerivativeTask.objects.filter(status=DerivativeTask.PENDING).count())
+        self.assertEqual(DerivativeTask.DONE,
+                         DerivativeTask.objects.get(pid='audio:1').status)
+
+    @patch('genrepo.file.derivatives.subprocess')
+    def test_ffmpeg(self, mocksubprocess):
+        mocksubprocess.Popen.return_value.communicate.return_value = ('', 'line 1\nerror!')
+        mocksubprocess.Popen.return_value.returncode = 0
+        ffmpeg('-i', 'in.mov', 'out.mp4')
+        args = mocksubprocess.Popen.call_args[0][0]
+        self.assertEqual('ffmpeg', args[0])
+        self.assertEqual(['-i', 'in.mov', 'out.mp4'], args[-3:])
+        mocksubprocess.Popen.return_value.returncode = 1
+        self.assertRaises(DerivativeError, ffmpeg, '-i', 'in.mov', 'out.mp4')
+
+
+class ResumableUploadTest(TestCase):
+    # tests for chunked, resumable uploads in file.uploads and the upload views
+    fixtures = ['users']
+
+    content = 'abcdefghij' * 10000
+    content_md5 = hashlib.md5(content).hexdigest()
+
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+        settings.UPLOAD_DIR = self.upload_dir
+        self.user = User.objects.get(username=ADMIN_CREDENTIALS['username'])
+        self.upload = ResumableUpload.objects.create(user=self.user, filename='big.tif',
+            collection='info:fedora/coll:1', size=len(self.content))
+        self.client = Client()
+
+    def tearDown(self):
+        del settings.UPLOAD_DIR
+        shutil.rmtree(self.upload_dir)
+        uploads._digests.clear()
+
+    def test_append_chunk(self):
+        self.assertEqual(0, current_offset(self.upload))
+        self.assertEqual(60000, append_chunk(self.upload, 0, StringIO(self.content), 60000))
+        self.assertEqual(60000, current_offset(self.upload))
+        # chunks must start where the last one ended
+        try:
+            append_chunk(self.upload, 50000, StringIO(self.content[50000:]), 50000)
+            self.fail('OffsetMismatch should be raised')
+        except OffsetMismatch as err:
+            self.assertEqual(60000, err.offset)
+        self.assertRaises(UploadTooLarge, append_chunk, self.upload, 60000,
+                          StringIO(self.content), 50000)
+        # an interrupted chunk keeps the data received
+        self.assertEqual(70000, append_chunk(self.upload, 60000,
+                                             StringIO(self.content[60000:70000]), 40000))
+        # a different process continues the upload without the checksum state
+        uploads._digests.clear()
+        append_chunk(self.upload, 70000, StringIO(self.content[70000:]), 30000)
+        self.assertEqual(self.content, open(upload_path(self.upload)).read())
+        self.assertEqual(self.content_md5, upload_checksum(self.upload))
+
+        remove_upload(self.upload)
+        self.assertFalse(os.path.exists(upload_path(self.upload)))
+
+    @patch('genrepo.file.uploads.hashlib')
+    def test_incremental_checksum(self, mockhashlib):
+        # checksum is only calculated once, as chunks are received
+        mockhashlib.md5.side_effect = hashlib.md5
+        for offset in range(0, len(self.content), 25000):
+            append_chunk(self.upload, offset, StringIO(self.content[offset:]), 25000)
+        self.assertEqual(self.content_md5, upload_checksum(self.upload))
+        self.assertEqual(1, mockhashlib.md5.call_count)
+
+    @patch('genrepo.file.forms.CollectionObject')
+    @patch('genrepo.file.forms.accessible')
+    def test_start_upload(self, mockaccessible, mockcoll):
+        mockaccessible.return_value = [Mock(pid='coll:1', label='Collection 1')]
+        start_url = reverse('file:start-upload')
+        response = self.client.post(start_url, {'collection': 'info:fedora/coll:1',
+                                    'filename': 'big.tif', 'size': 100})
+        self.assertEqual(302, response.status_code,
+                         'anonymous user should be redirected to login')
+        self.client.login(**ADMIN_CREDENTIALS)
+        response = self.client.post(start_url, {'collection': 'info:fedora/coll:1',
+                                    'filename': 'big.tif'})
+        self.assertEqual(400, response.status_code)
+        self.assert_('size' in json.loads(response.content)['errors'])
+        response = self.client.post(start_url, {'collection': 'info:fedora/coll:1',
+                                    'filename': 'big.tif', 'size': 100,
+                                    'md5': self.content_md5.upper()})
+        self.assertEqual(201, response.status_code)
+        upload = ResumableUpload.objects.get(pk=json.loads(response.content)['id'])
+        self.assert_(response['Location'].endswith(reverse('file:upload', args=[upload.pk])))
+        self.assertEqual(self.content_md5, upload.checksum)
+        self.assertEqual(self.user, upload.user)
+        self.assertEqual('0', response['Upload-Offset'])
+
+    @patch('genrepo.file.views._ingest_file')
+    def test_upload_views(self, mockingest):
+        self.client.login(**ADMIN_CREDENTIALS)
+        upload_url = reverse('file:upload', args=[self.upload.pk])
+        commit_url = reverse('file:commit-upload', args=[self.upload.pk])
+        response = self.client.put(upload_url, self.content[:60000],
+                                   content_type='application/octet-stream',
+                                   HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content)
+        self.assertEqual((60000, 100000), (data['offset'], data['size']))
+        # offset query
+        response = self.client.get(upload_url)
+        self.assertEqual('60000', response['Upload-Offset'])
+        # chunk at the wrong offset
+        response = self.client.put(upload_url, self.content[50000:],
+                                   content_type='application/octet-stream',
+                                   HTTP_UPLOAD_OFFSET='50000')
+        self.assertEqual(409, response.status_code)
+        self.assertEqual('60000', response['Upload-Offset'])
+        # commit before the upload is complete
+        response = self.client.post(commit_url)
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(0, mockingest.call_count)
+
+        self.client.put(upload_url, self.content[60000:],
+                        content_type='application/octet-stream',
+                        HTTP_UPLOAD_OFFSET='60000')
+        mockingest.return_value = Mock(pid='file:1')
+        response = self.client.post(commit_url)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('file:1', json.loads(response.content)['pid'])
+        args = mockingest.call_args[0]
+        self.assertEqual(('big.tif', 'info:fedora/coll:1', self.content_md5), args[2:])
+        # upload is removed once the object is created
+        self.assertFalse(ResumableUpload.objects.filter(pk=self.upload.pk).exists())
+        self.assertFalse(os.path.exists(upload_path(self.upload)))
+
+        # uploads are only available to the user who started them
+        other = ResumableUpload.objects.create(user=User.objects.get(username='nobody'),
+            filename='other.tif', collection='info:fedora/coll:1', size=10)
+        response = self.client.get(reverse('file:upload', args=[other.pk]))
+        self.assertEqual(404, response.status_code)
+
+    @patch('genrepo.file.views._ingest_file')
+    def test_commit_checksum_mismatch(self, mockingest):
+        self.client.login(**ADMIN_CREDENTIALS)
+        self.upload.checksum = hashlib.md5('something else').hexdigest()
+        self.upload.save()
+        append_chunk(self.upload, 0, StringIO(self.content), len(self.content))
+        response = self.client.post(reverse('file:commit-upload', args=[self.upload.pk]))
+        self.assertEqual(400, response.status_code)
+        self.assert_('Checksum mismatch' in json.loads(response.content)['error'])
+        self.assertEqual(0, mockingest.call_count)
+        # abandon the upload
+        response = self.client.delete(reverse('file:upload', args=[self.upload.pk]))
+        self.assertEqual(204, response.status_code)
+        self.assertFalse(ResumableUpload.objects.filter(pk=self.upload.pk).exists())
+
+    @patch('genrepo.file.views._ingest_file')
+    def test_commit_once(self, mockingest):
+        self.client.login(**ADMIN_CREDENTIALS)
+        append_chunk(self.upload, 0, StringIO(self.content), len(self.content))
+        # a second commit while the first is ingesting waits, then finds
+        # the upload gone
+        results = []
+        def commit_again():
+            try:
+                with committing(self.upload):
+                    results.append('committed')
+            except UploadCommitted:
+                results.append('gone')
+        second = threading.Thread(target=commit_again)
+        def ingest(*args):
+            second.start()
+            second.join(0.2)
+            self.assert_(second.is_alive())
+            return Mock(pid='file:1')
+        mockingest.side_effect = ingest
+        response = self.client.post(reverse('file:commit-upload', args=[self.upload.pk]))
+        self.assertEqual(201, response.status_code)
+        second.join()
+        self.assertEqual(['gone'], results)
+        self.assertEqual(1, mockingest.call_count)
+        # the file is gone before the lock is requested
+        self.assertRaises(UploadCommitted, committing(self.upload).__enter__)
+
+
+class MimeDetectionTest(TestCase):
+    # tests for MIME type detection in genrepo.file.mime
+
+    ingest_fname = os.path.join(settings.BASE_DIR, 'file', 'fixtures', 'hello.txt')
+
+    def setUp(self):
+        mime._memo.clear()
+
+    def test_combine(self):
+        # specific magic result is used regardless of extension
+        self.assertEqual('image/tiff', mime.combine('image/tiff', 'image/jpeg'))
+        # generic magic result is refined by extension
+        self.assertEqual('text/csv', mime.combine('text/plain; charset=us-ascii', 'text/csv'))
+        self.assertEqual('application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+            mime.combine('application/zip',
+                         'application/vnd.openxmlformats-officedocument.wordprocessingml.document'))
+        self.assertEqual('application/octet-stream', mime.combine('', None))
+
+    def test_detect_mimetype(self):
+        with open(self.ingest_fname) as ingest_f:
+            self.assertEqual('text/plain', mime.detect_mimetype(ingest_f))
+            # file should be left at the start so it can be read again
+            self.assertEqual(0, ingest_f.tell())
+
+    @patch('genrepo.file.mime.get_magic')
+    def test_memo(self, mockmagic):
+        mockmagic.return_value.from_buffer.return_value = 'image/png'
+        self.assertEqual('image/png', mime.detect_header('header', 'one.png'))
+        self.assertEqual('image/png', mime.detect_header('header', 'two.png'))
+        # same header and extension should only be sniffed once
+        self.assertEqual(1, mockmagic.return_value.from_buffer.call_count)
+        mime.detect_header('other header', 'three.png')
+        self.assertEqual(2, mockmagic.return_value.from_buffer.call_count)
+
+    def test_detect_mimetypes(self):
+        results = list(mime.detect_mimetypes([self.ingest_fname, self.ingest_fname]))
+        self.assertEqual([(self.ingest_fname, 'text/plain')] * 2, results)
+
+    def test_magic_per_thread(self):
+        handles = []
+        thread = threading.Thread(target=lambda: handles.append(mime.get_magic()))
+        thread.start()
+        thread.join()
+        self.assert_(mime.get_magic() is mime.get_magic())
+        self.assert_(handles[0] is not mime.get_magic())
+
+
+class DublinCoreEditFormTest(TestCase):
+
+    @patch('genrepo.file.forms.DublinCore')
+    def test_dcmi_type_options(self, mockdc):
+        mockdc.return_value.dcmi_types = ['Image', 'Text']
+        with patch.object(forms, '_dcmi_type_options', new=None):
+            self.assertEqual([(None, ''), ('Image', 'Image'), ('Text', 'Text')],
+                             forms.dcmi_type_options())
+            # vocabulary should only be loaded once
+            forms.dcmi_type_options()
+            self.assertEqual(1, mockdc.call_count)
+
+
+class ObjectSummaryTest(TestCase):
+    # tests for cached object summaries in genrepo.summary
+
+    def setUp(self):
+        self.anon = Mock()
+        self.anon.user.is_authenticated.return_value = False
+        self.user = Mock()
+        self.user.user.is_authenticated.return_value = True
+        self.user.user.username = 'someone'
+        # simulate summarizing objects without accessing fedora
+        self.coll = CollectionSummary('coll:1', 'A Collection', object_version('coll:1'))
+        self.obj = Mock(spec=FileObject, name='MockFileObject')
+
+    def _summary(self, pid, collection=None):
+        return ObjectSummary(pid, 'label for %s' % pid, None, None, (), collection,
+                             'text/plain', 12, 'text/plain', False, 'file/view.html', None)
+
+    # creation & modification dates are not available until an object is saved
+    @patch.object(FileObject, 'created', new='2011-01-01')
+    @patch.object(FileObject, 'modified', new='2011-01-02')
+    @patch('genrepo.summary.DigitalObject')
+    def test_summarize(self, mockdigobj):
+        mockdigobj.return_value.label = 'A Collection'
+        repo = Repository()
+        fileobj = repo.get_object('file:1', type=FileObject, create=True)
+        fileobj.label = 'some file'
+        fileobj.dc.content.title = 'some file'
+        fileobj.dc.content.creator_list = ['You', 'Me']
+        fileobj.rels_ext.content.add((fileobj.uriref, relsext.isMemberOfCollection,
+                                      URIRef('info:fedora/coll:1')))
+        summary = summarize(fileobj)
+        self.assertEqual('file:1', summary.pid)
+        self.assertEqual('info:fedora/file:1', summary.uri)
+        self.assertEqual('some file', summary.label)
+        self.assertEqual('2011-01-02', summary.modified)
+        self.assertEqual((AccessibleObject.PUBLIC_ACCESS_CMODEL,), summary.cmodels)
+        self.assertEqual('coll:1', summary.collection.pid)
+        self.assertEqual('A Collection', summary.collection.label)
+        self.assertEqual('some file', summary.dc.title)
+        self.assertEqual(('You', 'Me'), summary.dc.creator_list)
+        self.assertEqual('file/view.html', summary.view_template)
+        # no master file
+        self.assertEqual(None, summary.access_mimetype)
+
+    def test_summarize_access_copy(self):
+        video = Mock(spec=VideoObject, name='MockVideoObject')
+        video.pid = 'vid:1'
+        video.rels.cmodels = VideoObject.CONTENT_MODELS
+        video.rels.collection = None
+        video.master.exists = True
+        video.master.mimetype = 'video/quicktime'
+        video.access_copy.mimetype = 'video/mp4'
+        video.dc.content = DublinCore()
+        summary = summarize(video)
+        self.assertEqual('video/quicktime', summary.mimetype)
+        # the type of the copy delivered to browsers, as streamed by file:stream
+        self.assertEqual('video/mp4', summary.access_mimetype)
+
+    @patch('genrepo.file.views.get_summary')
+    def test_video_view(self, mocksummary):
+        dc = DublinCoreSummary(*([None] * len(DC_FIELDS) + [()] * len(DC_LIST_FIELDS)))
+        summary = self._summary('vid:1')._replace(cmodels=tuple(VideoObject.CONTENT_MODELS),
+            mimetype='video/quicktime', access_mimetype='video/quicktime',
+            view_template='file/video.html', dc=dc)
+        mocksummary.return_value = summary
+        stream_url = reverse('file:stream', kwargs={'pid': 'vid:1'})
+        response = self.client.get(reverse('file:view', kwargs={'pid': 'vid:1'}))
+        self.assertContains(response, '<source src="%s" type="video/quicktime"/>' % stream_url)
+        mocksummary.return_value = summary._replace(access_mimetype='video/mp4')
+        response = self.client.get(reverse('file:view', kwargs={'pid': 'vid:1'}))
+        self.assertContains(response, '<source src="%s" type="video/mp4"/>' % stream_url)
+        # type omitted if unknown
+        mocksummary.return_value = summary._replace(access_mimetype=None)
+        response = self.client.get(reverse('file:view', kwargs={'pid': 'vid:1'}))
+        self.assertContains(response, '<source src="%s"/>' % stream_url)
+
+    @patch('genrepo.file.models.init_by_cmodel')
+    @patch('genrepo.summary.summarize')
+    def test_get_summary(self, mocksummarize, mockinit):
+        mockinit.return_value = self.obj
+        mocksummarize.side_effect = lambda obj: self._summary('file:1', self.coll)
+
+        summary = get_summary('file:1', self.anon)
+        self.assertEqual('file:1', summary.pid)
+        self.assertEqual(1, mockinit.call_count)
+        # second request should be answered from the cache
+        self.assertEqual(summary, get_summary('file:1', self.anon))
+        self.assertEqual(1, mockinit.call_count)
+        # different credentials are cached separately
+        get_summary('file:1', self.user)
+        self.assertEqual(2, mockinit.call_count)
+        # saving the object invalidates the cached summary
+        invalidate('file:1')
+        get_summary('file:1', self.anon)
+        self.assertEqual(3, mockinit.call_count)
+        # so does modifying the collection it belongs to
+        invalidate('coll:1')
+        get_summary('file:1', self.anon)
+        self.assertEqual(4, mockinit.call_count)
+
+    @patch('genrepo.file.models.init_by_cmodel')
+    @patch('genrepo.summary.summarize')
+    def test_negative_results(self, mocksummarize, mockinit):
+        mockinit.return_value = self.obj
+        mocksummarize.side_effect = lambda obj: self._summary('file:1')
+        err_resp = Mock()
+        err_resp.status = 404
+        err_resp.reason = 'Not Found'
+        self.obj.getProfile.side_effect = RequestFailed(err_resp)
+
+        self.assertEqual(None, get_summary('file:1', self.anon))
+        self.assertEqual(NOT_FOUND, get_negative('file:1', 'anonymous'))
+        # repeated requests should not go back to fedora
+        self.assertEqual(None, get_summary('file:1', self.anon))
+        self.assertEqual(1, mockinit.call_count)
+        # objects that do not exist do not exist for anyone
+        self.assertEqual(NOT_FOUND, get_negative('file:1', 'user:someone'))
+
+        # object created: negative result is discarded
+        self.obj.getProfile.side_effect = None
+        invalidate('file:1')
+        self.assertEqual('file:1', get_summary('file:1', self.anon).pid)
+
+        # permission denied
+        err_resp.status = 401
+        err_resp.reason = 'Unauthorized'
+        self.obj.getProfile.side_effect = PermissionDenied(err_resp)
+        self.assertEqual(None, get_summary('file:2', self.anon))
+        self.assertEqual(DENIED, get_negative('file:2', 'anonymous'))
+        # but permission denied is not shared with other users
+        self.assertEqual(None, get_negative('file:2', 'user:someone'))
+        # access policy changed
+        clear_negative()
+        self.assertEqual(None, get_negative('file:2', 'anonymous'))
+
+        # other errors may be temporary and should not be cached
+        err_resp.status = 500
+        err_resp.reason = 'Internal Server Error'
+        err_resp.read.return_value = 'server error'
+        self.obj.getProfile.side_effect = RequestFailed(err_resp)
+        self.assertEqual(None, get_summary('file:3', self.anon))
+        self.assertEqual(None, get_negative('file:3', 'anonymous'))
+
+    @patch('genrepo.file.models.object_types')
+    @patch('genrepo.summary.Repository')
+    @patch('genrepo.summary.summarize')
+    def test_get_summaries(self, mocksummarize, mockrepo, mocktypes):
+        def get_object(pid, **kwargs):
+            self.obj.pid = pid
+            return self.obj
+        getobj = mockrepo.return_value.get_object
+        getobj.side_effect = get_object
+        mocksummarize.side_effect = lambda obj: self._summary(obj.pid, self.coll)
+        mocktypes.for_pids.side_effect = lambda pids, repo: dict((pid, ImageObject) for pid in pids)
+        with patch('genrepo.file.models.init_by_cmodel', new=get_object):
+            get_summary('item:2', self.anon)
+        summaries = get_summaries(['item:1', 'item:2', 'item:3'], self.anon)
+        self.assertEqual(['item:1', 'item:2', 'item:3'], [s.pid for s in summaries])
+        # types of the uncached items are determined with a single query
+        mocktypes.for_pids.assert_called_once_with(['item:1', 'item:3'], mockrepo.return_value)
+        self.assertEqual(2, getobj.call_count)
+        getobj.assert_called_with('item:3', type=ImageObject)
+
+        # nothing to load when everything is cached
+        get_summaries(['item:1', 'item:2'], self.anon)
+        self.assertEqual(1, mocktypes.for_pids.call_count)
+
+        # inaccessible objects are skipped
+        err_resp = Mock()
+        err_resp.status = 404
+        err_resp.reason = 'Not Found'
+        self.obj.getProfile.side_effect = RequestFailed(err_resp)
+        summaries = get_summaries(['item:1', 'item:4'], self.anon)
+        self.assertEqual(['item:1'], [s.pid for s in summaries])
+        # and are not included in later queries
+        get_summaries(['item:1', 'item:4'], self.anon)
+        self.assertEqual(2, mocktypes.for_pids.call_count)
+
+        # collection versions and negative results are checked a list at
+        # a time, rather than for each item
+        get = cache.get
+        def get_many(keys):
+            # without calling the (counted) get for each key
+            values = ((key, get(key)) for key in keys)
+            return dict((key, value) for key, value in values if value is not None)
+        with patch.object(cache, 'get', wraps=get) as mockget:
+            with patch.object(cache, 'get_many', side_effect=get_many) as mockgetmany:
+                summaries = get_summaries(['item:1', 'item:2', 'item:3', 'item:4'], self.anon)
+        self.assertEqual(3, len(summaries))
+        self.assertEqual(1, mockget.call_count)
+        self.assertEqual(4, mockgetmany.call_count)
+
+    @patch('genrepo.file.models.init_by_cmodel')
+    @patch('genrepo.summary.summarize')
+    def test_public_summary(self, mocksummarize, mockinit):
+        mockinit.return_value = self.obj
+        public = self._summary('file:1')._replace(
+            cmodels=(AccessibleObject.PUBLIC_ACCESS_CMODEL,))
+        mocksummarize.return_value = public
+
+        self.assertEqual(public, get_summary('file:1', self.user))
+        self.assertEqual(1, mockinit.call_count)
+        # summaries of public objects are shared by everyone
+        self.assertEqual(public, get_summary('file:1', self.anon))
+        self.assertEqual(public, get_summaries(['file:1'], self.anon)[0])
+        self.assertEqual(1, mockinit.call_count)
+        # until the object changes
+        invalidate('file:1')
+        get_summary('file:1', self.anon)
+        self.assertEqual(2, mockinit.call_count)
+
+        # summaries of restricted objects are not shared
+        mocksummarize.return_value = self._summary('file:2')
+        get_summary('file:2', self.user)
+        get_summary('file:2', self.anon)
+        self.assertEqual(4, mockinit.call_count)
+
+    def test_request_identity(self):
+        self.assertEqual('anonymous', request_identity(None))
+        self.assertEqual('anonymous', request_identity(self.anon))
+        self.user._cache_identity = None
+        self.user.user.is_superuser = False
+        self.user.user.groups.values_list.return_value = ['Editor', 'Admin']
+        self.assertEqual('user:someone', request_identity(self.user))
+
+        # users whose groups are all roles share cached information
+        settings.CACHE_ROLE_GROUPS = ['Admin', 'Editor']
+        try:
+            self.user._cache_identity = None
+            self.assertEqual('role:Admin,Editor', request_identity(self.user))
+            # any other group means the user could have different access
+            self.user._cache_identity = None
+            self.user.user.groups.values_list.return_value = ['Editor', 'Special']
+            self.assertEqual('user:someone', request_identity(self.user))
+            # as does no group at all
+            self.user._cache_identity = None
+            self.user.user.groups.values_list.return_value = []
+            self.assertEqual('user:someone', request_identity(self.user))
+        finally:
+            del settings.CACHE_ROLE_GROUPS
+
+    def test_icon(self):
+        summary = self._summary('file:1')
+        self.assertEqual('file', summary.icon)
+        summary = summary._replace(cmodels=tuple(ImageObject.CONTENT_MODELS))
+        self.assertEqual('image', summary.icon)
+        summary = summary._replace(cmodels=tuple(AudioObject.CONTENT_MODELS))
+        self.assertEqual('audio', summary.icon)
+
+
+class PidPoolTest(TestCase):
+    # tests for pids reserved in advance, in genrepo.pids
+
+    def setUp(self):
+        self.api = Mock()
+        self.count = 0
+        def next_pid(numPIDs=1, namespace=None):
+            pids = ''.join('<pid>%s:%d</pid>' % (namespace, self.count + i + 1)
+                           for i in range(numPIDs))
+            self.count += numPIDs
+            return '<pidList>%s</pidList>' % pids, 'http://fedora/objects/nextPID'
+        self.api.getNextPID.side_effect = next_pid
+
+    @patch('genrepo.pids.threading.Thread')
+    def test_next_pid(self, mockthread):
+        # run background refills immediately
+        mockthread.side_effect = lambda target, args: Mock(start=lambda: target(*args))
+        pool = PidPool(size=8)
+        self.assertEqual('test:1', pool.next_pid(self.api, 'test'))
+        # a block is reserved with a single request
+        self.api.getNextPID.assert_called_once_with(numPIDs=8, namespace='test')
+        self.assertEqual(7, pool.available('test'))
+        self.assertEqual(['test:2', 'test:3', 'test:4', 'test:5', 'test:6'],
+                         [pool.next_pid(self.api, 'test') for i in range(5)])
+        self.assertEqual(1, self.api.getNextPID.call_count)
+        self.assertEqual(0, mockthread.call_count)
+        # the next block is reserved in the background before the pool runs out
+        self.assertEqual('test:7', pool.next_pid(self.api, 'test'))
+        self.assertEqual(1, mockthread.call_count)
+        self.assertEqual(9, pool.available('test'))
+        self.assertEqual(['test:8', 'test:9', 'test:10'],
+                         [pool.next_pid(self.api, 'test') for i in range(3)])
+        # namespaces are pooled separately
+        self.assertEqual('other:17', pool.next_pid(self.api, 'other'))
+
+    @patch('genrepo.pids.threading.Thread')
+    def test_refill_failure(self, mockthread):
+        threads = []
+        mockthread.side_effect = lambda target, args: threads.append((target, args)) or Mock()
+        pool = PidPool(size=8)
+        for i in range(7):
+            pool.next_pid(self.api, 'test')
+        self.assertEqual(1, len(threads))
+        # only one refill at a time
+        pool.next_pid(self.api, 'test')
+        self.assertEqual(1, len(threads))
+        # the refill uses the object's api, so a failure (e.g., timeout) is
+        # logged and another refill can start
+        self.assertEqual(self.api, threads[0][1][0])
+        self.api.getNextPID.side_effect = BackendUnavailable('timed out')
+        target, args = threads[0]
+        target(*args)
+        self.assertEqual({}, pool._refilling)
+        # a refill that never finishes is eventually replaced
+        pool._add('test', ['test:100', 'test:101'])
+        pool.next_pid(self.api, 'test')
+        self.assertEqual(2, len(threads))
+        later = time.time() + 120
+        with patch('genrepo.pids.time.time') as mocktime:
+            mocktime.return_value = later
+            pool._add('test', ['test:102'])
+            pool.next_pid(self.api, 'test')
+        self.assertEqual(3, len(threads))
+
+    def test_no_pool(self):
+        pool = PidPool(size=1)
+        self.assertEqual('test:1', pool.next_pid(self.api, 'test'))
+        self.assertEqual('test:2', pool.next_pid(self.api, 'test'))
+        self.assertEqual(2, self.api.getNextPID.call_count)
+        self.assertEqual(0, pool.available('test'))
+
+    @patch('genrepo.pids.os.getpid')
+    def test_fork(self, mockgetpid):
+        mockgetpid.return_value = 100
+        pool = PidPool(size=20)
+        pool.next_pid(self.api, 'test')
+        self.assertEqual(19, pool.available('test'))
+        # a forked process does not use the parent's pids
+        mockgetpid.return_value = 101
+        self.assertEqual(0, pool.available('test'))
+        self.assertEqual('test:21', pool.next_pid(self.api, 'test'))
+
+    def test_default_pid(self):
+        settings.PID_POOL_SIZE = 1
+        try:
+            obj = FileObject(self.api, create=True)
+            self.assertEqual('%s:1' % settings.FEDORA_PIDSPACE, obj.get_default_pid())
+            self.api.getNextPID.assert_called_with(numPIDs=1,
+                                                   namespace=settings.FEDORA_PIDSPACE)
+        finally:
+            del settings.PID_POOL_SIZE
+
+
+class SingleFlightTest(TestCase):
+    # tests for coalescing identical requests in genrepo.singleflight
+
+    def setUp(self):
+        self.group = SingleFlight()
+        self.calls = 0
+        self.release = threading.Event()
+
+    def _slow(self, value):
+        self.calls += 1
+        self.release.wait()
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def _concurrent(self, key, value, count=5):
+        results = []
+        def call():
+            try:
+                results.append(self.group.do(key, self._slow, value))
+            except Exception as err:
+                results.append(err)
+        threads = [threading.Thread(target=call) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        # wait for all of the calls to be waiting on the first
+        while self.calls < 1:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_do(self):
+        results = self._concurrent('key', 'tile data')
+        self.assertEqual(['tile data'] * 5, results)
+        self.assertEqual(1, self.calls)
+        self.assertEqual(0, self.group.in_flight())
+        # later calls are not affected by earlier ones
+        self.assertEqual('more data', self.group.do('key', self._slow, 'more data'))
+        self.assertEqual(2, self.calls)
+
+    def test_error(self):
+        err = RequestFailed(Mock(status=500, reason='Internal Server Error',
+                                 read=lambda: 'djatoka error'))
+        results = self._concurrent('key', err)
+        self.assertEqual([err] * 5, results)
+        self.assertEqual(1, self.calls)
+        self.assertEqual(0, self.group.in_flight())
+
+    def test_across_processes(self):
+        settings.SINGLE_FLIGHT_TIMEOUT = 2
+        self.release.set()
+        try:
+            # another process is making the same call
+            cache.add('key:lock', 1)
+            timer = threading.Timer(0.1, cache.set, ['key:result', ('from elsewhere',)])
+            timer.start()
+            self.assertEqual('from elsewhere', self.group.do('key', self._slow, 'here'))
+            self.assertEqual(0, self.calls)
+            # the result is available briefly to later calls
+            self.assertEqual('from elsewhere', self.group.do('key', self._slow, 'here'))
+
+            # other process fails: call is made here instead
+            cache.add('key2:lock', 1)
+            threading.Timer(0.1, cache.delete, ['key2:lock']).start()
+            self.assertEqual('here', self.group.do('key2', self._slow, 'here'))
+            self.assertEqual(1, self.calls)
+            # and the result shared
+            self.assertEqual(('here',), cache.get('key2:result'))
+            self.assertEqual(None, cache.get('key2:lock'))
+        finally:
+            del settings.SINGLE_FLIGHT_TIMEOUT
+            cache.delete_many(['key:result', 'key2:result'])
+
+    @patch('genrepo.file.views.init_by_cmodel')
+    def test_image_region(self, mockinit):
+        mockinit.return_value.get_region.return_value = ('tile data', 'http://fedora/region')
+        response = Client().get(reverse('file:image-region', args=['img:1']),
+                                {'svc.level': '3', 'svc.region': '0,0,256,256'})
+        self.assertEqual('tile data', response.content)
+        mockinit.return_value.get_region.assert_called_with({'level': '3',
+                                                             'region': '0,0,256,256'})
+
+
+class AdmissionControlTest(TestCase):
+    # tests for rate limits and concurrency limits in genrepo.admission
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        if hasattr(settings, 'ADMISSION_CONTROL'):
+            del settings.ADMISSION_CONTROL
+
+    def test_check_rate(self):
+        # 3 requests at once, then 1 per second
+        for i in range(3):
+            self.assertEqual(0, check_rate('test', 'ip:1.2.3.4', 1, 3, now=300.0))
+        self.assertEqual(3, check_rate('test', 'ip:1.2.3.4', 1, 3, now=300.0))
+        # other clients are not affected
+        self.assertEqual(0, check_rate('test', 'ip:5.6.7.8', 1, 3, now=300.0))
+        # in the next window, the previous one still counts until it has slid out
+        self.assertEqual(2, check_rate('test', 'ip:1.2.3.4', 1, 3, now=303.0))
+        self.assertEqual(0, check_rate('test', 'ip:1.2.3.4', 1, 3, now=305.25))
+        self.assertEqual(0, check_rate('test', 'ip:1.2.3.4', 1, 3, now=312.0))
+
+    def test_acquire_slot(self):
+        first = acquire_slot('test', 2)
+        second = acquire_slot('test', 2)
+        self.assertNotEqual(None, first)
+        self.assertNotEqual(first, second)
+        self.assertEqual(None, acquire_slot('test', 2))
+        release_slot(first)
+        self.assertEqual(first, acquire_slot('test', 2))
+        # queued until a slot is released
+        threading.Timer(0.1, release_slot, [second]).start()
+        self.assertEqual(second, acquire_slot('test', 2, queue_timeout=2))
+
+    @patch('genrepo.file.views.init_by_cmodel')
+    def test_limited_view(self, mockinit):
+        mockinit.return_value.get_region.return_value = ('tile data', 'http://fedora/region')
+        url = reverse('file:image-region', args=['img:1'])
+        client = Client()
+        # not limited unless configured
+        for i in range(5):
+            self.assertEqual(200, client.get(url, {'svc.level': i}).status_code)
+
+        settings.ADMISSION_CONTROL = {'image': {'rate': 1, 'burst': 2}}
+        self.assertEqual(200, client.get(url, {'svc.level': 1}).status_code)
+        self.assertEqual(200, client.get(url, {'svc.level': 2}).status_code)
+        response = client.get(url, {'svc.level': 3})
+        self.assertEqual(429, response.status_code)
+        self.assert_(int(response['Retry-After']) >= 1)
+        # other clients are not affected
+        response = client.get(url, {'svc.level': 3}, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(200, response.status_code)
+
+        settings.ADMISSION_CONTROL = {'image': {'concurrency': 1}}
+        slot = acquire_slot('image', 1)
+        response = client.get(url, {'svc.level': 4})
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('1', response['Retry-After'])
+        release_slot(slot)
+        self.assertEqual(200, client.get(url, {'svc.level': 4}).status_code)
+        # slot is released after the request
+        self.assertNotEqual(None, acquire_slot('image', 1))
+
+    def test_streamed_response(self):
+        settings.ADMISSION_CONTROL = {'download': {'concurrency': 1}}
+        @admission_control('download')
+        def view(request):
+            return HttpResponse(iter(['chunk 1', 'chunk 2']))
+        request = Mock()
+        response = view(request)
+        # slot is held until the content has been sent
+        self.assertEqual(None, acquire_slot('download', 1))
+        self.assertEqual('chunk 1chunk 2', ''.join(response))
+        slot = acquire_slot('download', 1)
+        self.assertNotEqual(None, slot)
+        release_slot(slot)
+        # or until the response is closed
+        response = view(request)
+        self.assertEqual('chunk 1', iter(response).next())
+        self.assertEqual(None, acquire_slot('download', 1))
+        response.close()
+        self.assertNotEqual(None, acquire_slot('download', 1))
+
+
+class SitemapTest(TestCase):
+    # tests for sitemap generation in genrepo.file.sitemaps
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for i in range(5):
+            SitemapEntry.objects.create(pid='file:%d' % i, collection='coll:1',
+                                        lastmod=datetime(2011, 6, 1 + i))
+        SitemapEntry.objects.create(pid='file:10', collection='coll:2',
+                                    lastmod=datetime(2011, 7, 1, 12, 30))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _read(self, name):
+        return gzip.open(os.path.join(self.root, name)).read()
+
+    def _update(self, **kwargs):
+        return sitemaps.update_sitemaps(root=self.root, base='http://example.com/', **kwargs)
+
+    def test_update_sitemaps(self):
+        updated, removed = self._update(page_size=3)
+        self.assertEqual(['coll:1', 'coll:2'], updated)
+        self.assertEqual([], removed)
+        index = self._read('sitemap.xml.gz')
+        self.assert_('<loc>http://example.com/sitemap-coll-1-1.xml.gz</loc>' in index)
+        self.assert_('<loc>http://example.com/sitemap-coll-1-2.xml.gz</loc>' in index)
+        self.assert_('<loc>http://example.com/sitemap-coll-2-1.xml.gz</loc>' \
+                     '<lastmod>2011-07-01T12:30:00+00:00</lastmod>' in index)
+        first = self._read('sitemap-coll-1-1.xml.gz')
+        self.assertEqual(3, first.count('<url>'))
+        url = reverse('file:view', kwargs={'pid': 'file:0'})
+        self.assert_('<url><loc>http://example.com%s</loc>' \
+                     '<lastmod>2011-06-01T00:00:00+00:00</lastmod></url>' % url in first)
+        self.assertEqual(2, self._read('sitemap-coll-1-2.xml.gz').count('<url>'))
+
+        # nothing changed
+        self.assertEqual(([], []), self._update(page_size=3))
+        # only changed collections are rewritten, and unused pages removed
+        SitemapEntry.objects.filter(pid__in=['file:3', 'file:4']) \
+                            .update(collection='coll:2', lastmod=datetime(2011, 8, 1))
+        self.assertEqual((['coll:1', 'coll:2'], []), self._update(page_size=3))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'sitemap-coll-1-2.xml.gz')))
+        self.assert_('sitemap-coll-1-2' not in self._read('sitemap.xml.gz'))
+        SitemapEntry.objects.filter(pid='file:10').update(lastmod=datetime(2011, 9, 1))
+        self.assertEqual((['coll:2'], []), self._update(page_size=3))
+        SitemapEntry.objects.filter(collection='coll:2').delete()
+        self.assertEqual(([], ['coll:2']), self._update(page_size=3))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'sitemap-coll-2-1.xml.gz')))
+        self.assertEqual(1, self._read('sitemap.xml.gz').count('<sitemap>'))
+
+    def test_update_for(self):
+        obj = Mock()
+        obj.pid = 'file:20'
+        obj.rels.collection = 'coll:3'
+        obj.rels.cmodels = (AccessibleObject.PUBLIC_ACCESS_CMODEL,)
+        SitemapEntry.objects.update_for(obj)
+        entry = SitemapEntry.objects.get(pid='file:20')
+        self.assertEqual('coll:3', entry.collection)
+        self.assert_(entry.lastmod > datetime(2011, 12, 1))
+        # objects not in a collection are not listed
+        obj.rels.collection = None
+        SitemapEntry.objects.update_for(obj)
+        self.assertFalse(SitemapEntry.objects.filter(pid='file:20').exists())
+        # nor are objects that are not publicly accessible
+        obj.rels.collection = 'coll:3'
+        SitemapEntry.objects.update_for(obj)
+        obj.rels.cmodels = ('info:fedora/genrepo-demo:Image-1.0',)
+        SitemapEntry.objects.update_for(obj)
+        self.assertFalse(SitemapEntry.objects.filter(pid='file:20').exists())
+
+    @patch('genrepo.file.sitemaps.risearch_rows')
+    def test_rebuild_index(self, mockrows):
+        mockrows.return_value = [
+            ['info:fedora/file:0', 'info:fedora/coll:1', '2011-06-01T00:00:00.000Z'],
+            ['info:fedora/file:1', 'info:fedora/coll:2', '2011-10-01T08:00:00.5Z'],
+            ['info:fedora/file:30', 'info:fedora/coll:2', '2011-10-02T08:00:00Z'],
+        ]
+        self.assertEqual(3, sitemaps.rebuild_index(Mock()))
+        # only publicly accessible objects are indexed
+        self.assert_(AccessibleObject.PUBLIC_ACCESS_CMODEL in mockrows.call_args[0][1])
+        self.assertEqual(['file:0', 'file:1', 'file:30'],
+                         list(SitemapEntry.objects.order_by('pid').values_list('pid', flat=True)))
+        entry = SitemapEntry.objects.get(pid='file:1')
+        self.assertEqual('coll:2', entry.collection)
+        self.assertEqual(datetime(2011, 10, 1, 8), entry.lastmod)
+
+
+NOTIFICATION = '''<entry xmlns="http://www.w3.org/2005/Atom">
+  <id>urn:uuid:4a7b3c10-2b4c-4d1e-9f5a-7c8d9e0f1a2b</id>
+  <updated>%(date)s</updated>
+  <author><name>fedoraAdmin</name></author>
+  <title type="text">%(method)s</title>
+  <category term="%(pid)s" scheme="fedora-types:pid" label="xsd:string"/>
+  <summary type="text">%(pid)s</summary>
+</entry>'''
+
+class ChangeFeedTest(TestCase):
+    # tests for the repository change feed in genrepo.file.changes
+
+    def setUp(self):
+        self.repo = Mock()
+        coll = Mock()
+        coll.pid = 'coll:1'
+        coll.label = 'Collection 1'
+        coll.oai_set = 'coll1'
+        coll.parent = None
+        self.repo.get_object.return_value = coll
+        self.modified = []
+        self.info = {
+            'file:1': ([AccessibleObject.PUBLIC_ACCESS_CMODEL], 'info:fedora/coll:1'),
+            'coll:1': ([CollectionObject.COLLECTION_CONTENT_MODEL], None),
+        }
+        self.spool = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool)
+
+    def _rows(self, repo, query):
+        # simulated resource index
+        if changes.LAST_MODIFIED in query:
+            return [['info:fedora/%s' % pid, date] for pid, date in self.modified]
+        rows = []
+        for pid, (cmodels, coll) in self.info.iteritems():
+            if '<info:fedora/%s>' % pid in query:
+                rows.extend(['info:fedora/%s' % pid, cmodel, coll or ''] for cmodel in cmodels)
+        return rows
+
+    def test_dates(self):
+        self.assertEqual(datetime(2011, 6, 1, 12, 30, 10, 120000),
+                         changes.fedora_date('2011-06-01T12:30:10.12Z'))
+        self.assertEqual(datetime(2011, 6, 1, 12, 30, 10), changes.fedora_date('2011-06-01T12:30:10Z'))
+        self.assertRaises(ValueError, changes.fedora_date, '2011-06-01')
+        self.assertEqual('2011-06-01T12:30:10.120Z',
+                         changes.format_date(datetime(2011, 6, 1, 12, 30, 10, 120000)))
+
+    @patch('genrepo.file.changes.invalidate')
+    @patch('genrepo.file.changes.risearch_rows')
+    def test_apply_changes(self, mockrows, mockinvalidate):
+        mockrows.side_effect = self._rows
+        modified = datetime(2011, 6, 1, 12)
+        counts = changes.apply_changes([changes.Change('file:1', modified, False),
+                                        changes.Change('coll:1', modified, False),
+                                        changes.Change('file:1', datetime(2011, 6, 1), False)],
+                                       self.repo)
+        self.assertEqual({'invalidated': 2, 'collections': 1, 'sitemap': 1, 'removed': 0}, counts)
+        self.assertEqual(set(['file:1', 'coll:1']),
+                         set(args[0][0] for args in mockinvalidate.call_args_list))
+        entry = SitemapEntry.objects.get(pid='file:1')
+        self.assertEqual(('coll:1', modified), (entry.collection, entry.lastmod))
+        self.assertEqual('Collection 1', CollectionNode.objects.get(pid='coll:1').label)
+        self.assertEqual(CollectionObject, self.repo.get_object.call_args[1]['type'])
+
+        # objects not publicly accessible are not listed
+        self.info['file:2'] = (['info:fedora/genrepo-demo:Image-1.0'], 'info:fedora/coll:1')
+        counts = changes.apply_changes([changes.Change('file:2', modified, False)], self.repo)
+        self.assertEqual(0, counts['sitemap'])
+        self.assertFalse(SitemapEntry.objects.filter(pid='file:2').exists())
+        # removed from its collection
+        self.info['file:1'] = (self.info['file:1'][0], None)
+        counts = changes.apply_changes([changes.Change('file:1', modified, False)], self.repo)
+        self.assertEqual(1, counts['removed'])
+        self.assertFalse(SitemapEntry.objects.filter(pid='file:1').exists())
+        # purged
+        self.info['file:1'] = (self.info['file:1'][0], 'info:fedora/coll:1')
+        changes.apply_changes([changes.Change('file:1', modified, False)], self.repo)
+        counts = changes.apply_changes([changes.Change('file:1', modified, True),
+                                        changes.Change('coll:1', modified, True)], self.repo)
+        self.assertEqual(2, counts['removed'])
+        self.assertFalse(SitemapEntry.objects.filter(pid='file:1').exists())
+        self.assertFalse(CollectionNode.objects.filter(pid='coll:1').exists())
+
+    @patch('genrepo.file.changes.invalidate')
+    @patch('genrepo.file.changes.risearch_rows')
+    def test_poll_resource_index(self, mockrows, mockinvalidate):
+        mockrows.side_effect = self._rows
+        self.modified = [('file:1', '2011-06-01T12:00:00.5Z'), ('coll:1', '2011-06-01T12:00:01Z')]
+        counts = changes.poll_resource_index(self.repo, since=datetime(2011, 6, 1), batch_size=1)
+        self.assertEqual(2, counts['changes'])
+        self.assertEqual(1, counts['sitemap'])
+        self.assert_("> '2011-05-31T23:58:00.000Z'" in mockrows.call_args_list[0][0][1])
+        state = ChangeFeedState.objects.get(name=changes.RISEARCH_FEED)
+        self.assertEqual('2011-06-01T12:00:01.000Z', state.high_water)
+        self.assertEqual({'file:1': '2011-06-01T12:00:00.500Z', 'coll:1': '2011-06-01T12:00:01.000Z'},
+                         state.get_recent())
+
+        # changes already processed are skipped; the overlap finds late arrivals
+        self.modified.insert(0, ('file:2', '2011-06-01T11:59:30Z'))
+        self.modified.append(('file:1', '2011-06-01T12:05:00Z'))
+        mockinvalidate.reset_mock()
+        counts = changes.poll_resource_index(self.repo)
+        self.assertEqual(2, counts['changes'])
+        self.assertEqual(set(['file:1', 'file:2']),
+                         set(args[0][0] for args in mockinvalidate.call_args_list))
+        self.assert_("> '2011-06-01T11:58:01.000Z'" in mockrows.call_args_list[-2][0][1])
+        state = ChangeFeedState.objects.get(name=changes.RISEARCH_FEED)
+        self.assertEqual('2011-06-01T12:05:00.000Z', state.high_water)
+        # older changes are forgotten
+        self.assertEqual(['file:1'], state.get_recent().keys())
+
+    @patch('genrepo.file.changes.invalidate')
+    @patch('genrepo.file.changes.risearch_rows')
+    def test_consume_spool(self, mockrows, mockinvalidate):
+        mockrows.side_effect = self._rows
+        SitemapEntry.objects.create(pid='file:3', collection='coll:1', lastmod=datetime(2011, 1, 1))
+        messages = [('modifyDatastreamByValue', 'file:1'), ('getDatastream', 'file:2'),
+                    ('purgeObject', 'file:3')]
+        for i, (method, pid) in enumerate(messages):
+            with open(os.path.join(self.spool, '%03d.xml' % i), 'w') as message:
+                message.write(NOTIFICATION % {'method': method, 'pid': pid,
+                                              'date': '2011-06-01T12:00:00.000Z'})
+        with open(os.path.join(self.spool, '004.xml'), 'w') as message:
+            message.write('not a notification')
+        # a notification without a date is also discarded
+        with open(os.path.join(self.spool, '005.xml'), 'w') as message:
+            message.write(re.sub(r'<updated>.*</updated>', '', NOTIFICATION % \
+                {'method': 'modifyObject', 'pid': 'file:2', 'date': ''}))
+        self.assertEqual(None, changes.parse_notification(NOTIFICATION % \
+            {'method': 'getObjectXML', 'pid': 'file:1', 'date': '2011-06-01T12:00:00Z'}))
+
+        counts = changes.consume_spool(self.repo, self.spool)
+        self.assertEqual(2, counts['changes'])
+        self.assertEqual(1, counts['sitemap'])
+        self.assertEqual(1, counts['removed'])
+        self.assertEqual(['file:1'], list(SitemapEntry.objects.values_list('pid', flat=True)))
+        self.assertEqual([], os.listdir(self.spool))
+
+
+class IIIFTest(TestCase):
+    # tests for IIIF image requests in genrepo.file.iiif
+
+    info = ImageInfo(6000, 4000, 6)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_image_request(self):
+        # equivalent requests have the same canonical form
+        canonical, params = image_request(self.info, 'full', 'max', '0', 'default', 'jpg')
+        self.assertEqual('full/full/0/default.jpg', canonical)
+        self.assertEqual({'region': '0,0,4000,6000', 'level': '6', 'rotate': '0',
+                          'format': 'image/jpeg'}, params)
+        for region, size in (('0,0,6000,4000', 'full'), ('pct:0,0,100,100', '6000,'),
+                             ('0,0,9000,9000', ',4000'), ('full', 'pct:100')):
+            self.assertEqual(canonical, image_request(self.info, region, size, '0.0',
+                                                      'color', 'jpg')[0])
+
+        canonical, params = image_request(self.info, 'pct:50,50,25,25', '!300,300',
+                                          '90', 'default', 'png')
+        self.assertEqual('3000,2000,1500,1000/300,/90/default.png', canonical)
+        # decoded at the smallest level larger than 300x200, then scaled
+        self.assertEqual({'region': '2000,3000,250,375', 'level': '4', 'rotate': '90',
+                          'format': 'image/png', 'scale': '300,200'}, params)
+        self.assertEqual('3000,2000,1500,1000/300,/90/default.png',
+                         image_request(self.info, '3000,2000,1500,1000', ',200',
+                                       '90', 'default', 'png')[0])
+        # a tile at an exact level needs no scaling
+        canonical, params = image_request(self.info, '1024,1024,1024,1024', '256,',
+                                          '0', 'default', 'jpg')
+        self.assertEqual('1024,1024,1024,1024/256,/0/default.jpg', canonical)
+        self.assertEqual({'region': '1024,1024,256,256', 'level': '4', 'rotate': '0',
+                          'format': 'image/jpeg'}, params)
+        self.assertEqual('full/600,600/0/default.jpg',
+                         image_request(self.info, 'full', '600,600', '0', 'default', 'jpg')[0])
+        self.assertEqual('1000,0,4000,4000/full/0/default.jpg',
+                         image_request(self.info, 'square', 'full', '0', 'default', 'jpg')[0])
+
+    def test_invalid_request(self):
+        for args, status in (
+                (('bogus', 'full', '0', 'default', 'jpg'), 400),
+                (('7000,0,10,10', 'full', '0', 'default', 'jpg'), 400),
+                (('full', '!100,', '0', 'default', 'jpg'), 400),
+                (('full', '0,', '0', 'default', 'jpg'), 400),
+                (('full', 'full', 'x', 'default', 'jpg'), 400),
+                (('full', '7000,', '0', 'default', 'jpg'), 501),
+                (('full', 'full', '45', 'default', 'jpg'), 501),
+                (('full', 'full', '!0', 'default', 'jpg'), 501),
+                (('full', 'full', '0', 'gray', 'jpg'), 501),
+                (('full', 'full', '0', 'default', 'tif'), 501)):
+            try:
+                image_request(self.info, *args)
+                self.fail('%s should not be accepted' % '/'.join(args))
+            except IIIFError as err:
+                self.assertEqual(status, err.status, '%s: %s' % ('/'.join(args), err))
+
+    def test_info_json(self):
+        data = info_json(ImageInfo(1000, 600, 2), 'http://example.com/files/img:1/iiif')
+        self.assertEqual('http://example.com/files/img:1/iiif', data['@id'])
+        self.assertEqual((1000, 600), (data['width'], data['height']))
+        self.assertEqual([{'width': 250, 'height': 150}, {'width': 500, 'height': 300}],
+                         data['sizes'])
+        self.assertEqual([1, 2, 4], data['tiles'][0]['scaleFactors'])
+
+    @patch('genrepo.file.views.get_summary')
+    @patch('genrepo.file.views.init_by_cmodel')
+    def test_iiif_views(self, mockinit, mocksummary):
+        mocksummary.return_value = Mock(pid='img:1', cmodels=ImageObject.CONTENT_MODELS)
+        img = mockinit.return_value
+        img.image_metadata = {'width': '6000', 'height': '4000', 'levels': '6'}
+        img.get_region.return_value = ('image data', 'http://fedora/region')
+        with patch('genrepo.file.models.init_by_cmodel', new=mockinit):
+            response = self.client.get(reverse('file:iiif-info', kwargs={'pid': 'img:1'}))
+            self.assertEqual(200, response.status_code)
+            data = json.loads(response.content)
+            self.assertEqual('http://testserver/files/img:1/iiif', data['@id'])
+            self.assertEqual(6000, data['width'])
+            self.assertEqual('*', response['Access-Control-Allow-Origin'])
+            self.assert_('public' in response['Cache-Control'])
+
+            url = reverse('file:iiif-image', kwargs={'pid': 'img:1', 'region': 'full',
+                'size': 'max', 'rotation': '0', 'quality': 'default', 'format': 'jpg'})
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('image data', response.content)
+            self.assertEqual('image/jpeg', response['Content-Type'])
+            self.assertEqual('<http://testserver/files/img:1/iiif/full/full/0/default.jpg>;'
+                             'rel="canonical"', response['Link'])
+            # an equivalent request is served from the cache
+            response = self.client.get(url.replace('/full/max/', '/pct:0,0,100,100/6000,/'))
+            self.assertEqual('image data', response.content)
+            self.assertEqual(1, img.get_region.call_count)
+            # image information is cached too: one object for the metadata, one for the region
+            self.assertEqual(2, mockinit.call_count)
+
+            response = self.client.get(url.replace('/0/', '/45/'))
+            self.assertEqual(501, response.status_code)
+
+            mocksummary.return_value = Mock(pid='file:1', cmodels=FileObject.CONTENT_MODELS)
+            response = self.client.get(url)
+            self.assertEqual(404, response.status_code)
+            mocksummary.return_value = None
+            response = self.client.get(url)
+            self.assertEqual(404, response.status_code)
+
+
+class FedoraResilienceTest(TestCase):
+    # tests for timeouts, circuit breakers and retries in genrepo.fedora
+
+    def setUp(self):
+        settings.FEDORA_RETRIES = 2
+        self.conn = ResilientConnection('http://fedora:8080/fedora/')
+        self.responses = []
+        self.conn._connect_and_request = Mock(side_effect=self._respond)
+        self.timeouts = []
+
+    def tearDown(self):
+        for name in ('FEDORA_RETRIES', 'FEDORA_BREAKER', 'FEDORA_HEDGE', 'FEDORA_TIMEOUTS'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+
+    def _respond(self, method, url, body, headers):
+        self.timeouts.append(self.conn.thread_local.timeout)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def _response(self, status, content=''):
+        response = Mock()
+        response.status = status
+        response.reason = 'reason'
+        response.read.return_value = content
+        response.msg.gettype.return_value = 'text/plain'
+        return response
+
+    def test_operation(self):
+        base = 'http://fedora:8080/fedora'
+        self.assertEqual('risearch', operation(base + '/risearch?type=triples'))
+        self.assertEqual('dissemination',
+                         operation(base + '/objects/img:1/methods/djatoka:jp2SDef/getRegion'))
+        self.assertEqual('content', operation(base + '/objects/file:1/datastreams/FILE/content'))
+        self.assertEqual('default', operation(base + '/objects/file:1'))
+
+    @patch('genrepo.fedora.time.sleep')
+    def test_retries(self, mocksleep):
+        settings.FEDORA_TIMEOUTS = {'default': 5, 'risearch': 3}
+        # idempotent reads are retried after connection errors and 503s
+        self.responses = [socket.timeout('timed out'), self._response(503),
+                          self._response(200, 'ok')]
+        response = self.conn.request('GET', '/fedora/risearch')
+        self.assertEqual(200, response.status)
+        self.assertEqual([3, 3, 3], self.timeouts)
+        self.assertEqual(2, mocksleep.call_count)
+        counts = self.conn.metrics()['risearch']
+        self.assertEqual(3, counts['requests'])
+        self.assertEqual(2, counts['retries'])
+        self.assertEqual(2, counts['errors'])
+
+        # other errors are not retried
+        self.responses = [self._response(404)]
+        self.assertRaises(RequestFailed, self.conn.request, 'GET', '/fedora/objects/foo:1')
+        self.responses = [self._response(401)]
+        self.assertRaises(PermissionDenied, self.conn.request, 'GET', '/fedora/objects/foo:1')
+        self.assertEqual([5, 5], self.timeouts[3:])
+        # nor are writes
+        self.responses = [self._response(503)]
+        self.assertRaises(RequestFailed, self.conn.request, 'POST', '/fedora/objects/foo:1')
+
+        # failures after the last retry are reported as unavailable
+        self.responses = [socket.error('refused')] * 3
+        self.assertRaises(BackendUnavailable, self.conn.request, 'GET', '/fedora/objects/foo:1')
+        self.assertEqual([], self.responses)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker('test', window=30, min_requests=4, error_rate=0.5,
+                                 reset_timeout=10)
+        with patch('genrepo.fedora.time.time') as mocktime:
+            mocktime.return_value = 100.0
+            for failed in (True, False, True):
+                self.assert_(breaker.allow())
+                breaker.record(failed)
+            self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+            breaker.record(True)
+            self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+            self.assertFalse(breaker.allow())
+            self.assertEqual(10, breaker.retry_after())
+
+            # a single trial request once the timeout has passed
+            mocktime.return_value = 110.0
+            self.assert_(breaker.allow())
+            self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+            self.assertFalse(breaker.allow())
+            breaker.record(True)
+            self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+            self.assertEqual(2, breaker.times_opened)
+
+            mocktime.return_value = 120.0
+            self.assert_(breaker.allow())
+            breaker.record(False)
+            self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+            self.assert_(breaker.allow())
+
+    def test_short_circuit(self):
+        settings.FEDORA_RETRIES = 0
+        settings.FEDORA_BREAKER = {'min_requests': 2, 'reset_timeout': 60}
+        self.responses = [self._response(500), self._response(500)]
+        for i in range(2):
+            self.assertRaises(RequestFailed, self.conn.request, 'GET', '/fedora/objects/foo:1')
+        try:
+            self.conn.request('GET', '/fedora/objects/foo:1')
+            self.fail('request should not be made while the breaker is open')
+        except BackendUnavailable as err:
+            self.assertEqual(60, err.retry_after)
+        self.assertEqual(2, self.conn._connect_and_request.call_count)
+        metrics = self.conn.metrics()['default']
+        self.assertEqual(1, metrics['short_circuited'])
+        self.assertEqual('open', metrics['breaker']['state'])
+        # other kinds of requests are not affected
+        self.responses = [self._response(200)]
+        self.conn.request('GET', '/fedora/risearch')
+
+    def test_hedged_read(self):
+        settings.FEDORA_HEDGE = {'dissemination': 0.05}
+        url = '/fedora/objects/img:1/methods/djatoka:jp2SDef/getRegion'
+        slow = threading.Event()
+        threads = []
+        def respond(method, url, body, headers):
+            threads.append(threading.current_thread())
+            if not slow.is_set():
+                # first request is slow
+                slow.set()
+                time.sleep(0.5)
+                return self._response(200, 'slow')
+            return self._response(200, 'fast')
+        self.conn._connect_and_request = Mock(side_effect=respond)
+        content, url = self.conn.read('objects/img:1/methods/djatoka:jp2SDef/getRegion')
+        self.assertEqual('fast', content)
+        metrics = self.conn.metrics()['dissemination']
+        self.assertEqual(1, metrics['hedged'])
+        self.assertEqual(1, metrics['hedge_wins'])
+        # the first request is made by the calling thread, the hedge by another
+        self.assertEqual(threading.current_thread(), threads[0])
+        self.assertNotEqual(threading.current_thread(), threads[1])
+
+        # fast reads are not hedged
+        slow.set()
+        content, url = self.conn.read('objects/img:1/methods/djatoka:jp2SDef/getRegion')
+        self.assertEqual('fast', content)
+        self.assertEqual(1, self.conn.metrics()['dissemination']['hedged'])
+
+        # no hedge when every hedge thread is busy
+        slow.clear()
+        self.conn._hedge_pool.idle = 0
+        content, url = self.conn.read('objects/img:1/methods/djatoka:jp2SDef/getRegion')
+        self.assertEqual('slow', content)
+        metrics = self.conn.metrics()['dissemination']
+        self.assertEqual(1, metrics['hedged'])
+        self.assertEqual(1, metrics['hedge_skipped'])
+
+    def test_hedge_cuts_off_read(self):
+        # a hedge that finishes first shuts down the socket of the original read
+        hedge = _Hedge()
+        original, server = socket.socketpair()
+        connection = Mock()
+        connection.sock = original
+        self.assert_(hedge.register(connection))
+        hedge.finish_hedge('fast', None)
+        self.assertEqual('', original.recv(10))
+        self.assert_(hedge.finish_original())
+        # too late to start the original read
+        self.assertFalse(hedge.register(connection))
+        original.close()
+        server.close()
+
+    @patch('genrepo.file.views.init_by_cmodel')
+    def test_unavailable_response(self, mockinit):
+        mockinit.return_value.get_region.side_effect = BackendUnavailable('down', 12)
+        response = Client().get(reverse('file:image-region', args=['img:1']))
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('12', response['Retry-After'])
+
+
+class FedoraRoutingTest(TestCase):
+    # tests for read replica routing in genrepo.fedora
+
+    primary = 'http://fedora:8080/fedora/'
+    replica_urls = ['http://mirror1:8080/fedora/', 'http://mirror2:8080/fedora/']
+
+    def setUp(self):
+        self.conn = ReplicatedConnection(self.primary, self.replica_urls)
+        self.requests = []
+        self.statuses = {}
+        for connection in [self.conn.primary] + [r.connection for r in self.conn.replicas]:
+            connection._connect_and_request = Mock(side_effect=self._respond)
+            connection.thread_local.connection = Mock()
+        for replica in self.conn.replicas:
+            # no background health checks
+            replica.last_checked = time.time()
+        ReadRoutingMiddleware().process_request(self._request())
+
+    def tearDown(self):
+        ReadRoutingMiddleware().process_response(self._request(), None)
+
+    def _request(self):
+        request = Mock()
+        request.session = {}
+        return request
+
+    def _respond(self, method, url, body, headers):
+        self.requests.append((method, url))
+        for prefix, status in self.statuses.iteritems():
+            if url.startswith(prefix):
+                if isinstance(status, Exception):
+                    raise status
+                break
+        else:
+            status = 200
+        response = Mock()
+        response.status = status
+        response.reason = 'reason'
+        response.read.return_value = 'content'
+        return response
+
+    def test_read_from_replicas(self):
+        content, url = self.conn.read('objects/a:1')
+        self.assertEqual('content', content)
+        # the primary url is reported
+        self.assertEqual(self.primary + 'objects/a:1', url)
+        with self.conn.open('GET', 'objects/a:2') as response:
+            self.assertEqual(200, response.status)
+        # reads go to each replica in turn
+        self.assertEqual([('GET', self.replica_urls[0] + 'objects/a:1'),
+                          ('GET', self.replica_urls[1] + 'objects/a:2')], self.requests)
+        self.assertFalse(reading_from_primary())
+
+    def test_writes(self):
+        self.conn.open('POST', 'objects/nextPID', '').__enter__()
+        self.conn.read('objects/a:1/datastreams/DC', data='content')
+        self.assertEqual([('POST', self.primary + 'objects/nextPID'),
+                          ('POST', self.primary + 'objects/a:1/datastreams/DC')],
+                         self.requests)
+        # reads after a write go to the primary
+        self.assertTrue(reading_from_primary())
+        self.conn.read('objects/a:1')
+        self.assertEqual(('GET', self.primary + 'objects/a:1'), self.requests[-1])
+        response, abandon = open_stream(AuthorizingServerConnection(self.conn),
+                                        'objects/a:1/datastreams/DC/content')
+        self.assertEqual(('GET', self.primary + 'objects/a:1/datastreams/DC/content'),
+                         self.requests[-1])
+        abandon()
+        self.conn.primary.thread_local.connection.close.assert_called_with()
+
+    def test_fallback(self):
+        # not replicated yet
+        self.statuses[self.replica_urls[0]] = 404
+        content, url = self.conn.read('objects/a:1')
+        self.assertEqual(('GET', self.primary + 'objects/a:1'), self.requests[-1])
+        # replica failing
+        settings.FEDORA_RETRIES = 0
+        try:
+            self.statuses[self.replica_urls[1]] = socket.error('connection refused')
+            with self.conn.open('GET', 'objects/a:1') as response:
+                self.assertEqual(200, response.status)
+            self.assertEqual(('GET', self.primary + 'objects/a:1'), self.requests[-1])
+        finally:
+            del settings.FEDORA_RETRIES
+        status = self.conn.metrics()['replicas']
+        self.assertEqual(1, status[self.replica_urls[0]]['fallbacks'])
+        self.assertEqual(1, status[self.replica_urls[1]]['fallbacks'])
+        # not found anywhere
+        self.statuses[self.primary] = 404
+        self.assertRaises(RequestFailed, self.conn.read, 'objects/a:1')
+        # other errors are not retried on the primary
+        self.statuses[self.replica_urls[1]] = 401
+        self.assertRaises(PermissionDenied, self.conn.read, 'objects/a:1')
+
+    def test_health_check(self):
+        replica = self.conn.replicas[0]
+        self.statuses[self.replica_urls[0]] = 503
+        replica.check()
+        self.assertFalse(replica.healthy)
+        self.assertEqual(('GET', self.replica_urls[0] + 'describe?xml=true'), self.requests[-1])
+        # unhealthy replicas are skipped
+        self.conn.read('objects/a:1')
+        self.conn.read('objects/a:2')
+        self.assertEqual(('GET', self.replica_urls[1] + 'objects/a:1'), self.requests[-2])
+        self.assertEqual(('GET', self.replica_urls[1] + 'objects/a:2'), self.requests[-1])
+        open_stream(AuthorizingServerConnection(self.conn, 'user', 'pass'),
+                    'objects/a:3/datastreams/DC/content', {'Range': 'bytes=0-9'})
+        self.assertEqual(('GET', self.replica_urls[1] + 'objects/a:3/datastreams/DC/content'),
+                         self.requests[-1])
+        headers = self.conn.replicas[1].connection._connect_and_request.call_args[0][3]
+        self.assertEqual('bytes=0-9', headers['Range'])
+        self.assert_('Authorization' in headers)
+        del self.statuses[self.replica_urls[0]]
+        replica.check()
+        self.assertTrue(replica.healthy)
+        # a health check is started when one is due
+        replica.last_checked = 0
+        with patch('genrepo.fedora.threading.Thread') as mockthread:
+            self.assertTrue(replica.available())
+            self.assertEqual(replica.check, mockthread.call_args[1]['target'])
+            mockthread.return_value.start.assert_called_with()
+
+    def test_middleware(self):
+        middleware = ReadRoutingMiddleware()
+        request = self._request()
+        middleware.process_request(request)
+        self.conn.read('objects/a:1')
+        middleware.process_response(request, None)
+        self.assertEqual({}, request.session)
+        # a write makes the session read from the primary for a while
+        middleware.process_request(request)
+        self.conn.open('DELETE', 'objects/a:1').__enter__()
+        middleware.process_response(request, None)
+        self.assertFalse(reading_from_primary())
+        self.assert_(request.session[middleware.SESSION_KEY] > time.time() + 20)
+        middleware.process_request(request)
+        self.assertTrue(reading_from_primary())
+        # but not other sessions
+        middleware.process_request(self._request())
+        self.assertFalse(reading_from_primary())
+
+
+class MetricsTest(TestCase):
+    # tests for application metrics in genrepo.metrics
+
+    def setUp(self):
+        metrics._reset()
+        self.tmpdir = tempfile.mkdtemp(prefix='genrepo-metrics-')
+
+    def tearDown(self):
+        metrics._reset()
+        shutil.rmtree(self.tmpdir)
+        if hasattr(settings, 'METRICS_DIR'):
+            del settings.METRICS_DIR
+
+    def test_render_text(self):
+        metrics.increment('genrepo_requests_total', (('view', 'file:view'), ('status', '2xx')))
+        metrics.increment('genrepo_requests_total', (('view', 'file:view'), ('status', '2xx')))
+        metrics.observe('genrepo_request_seconds', 0.02, (('view', 'file:view'),))
+        metrics.observe('genrepo_request_seconds', 3, (('view', 'file:view'),))
+        metrics.observe('genrepo_request_seconds', 100, (('view', 'file:view'),))
+        metrics.cache_result('summary', False, 3)
+        text = metrics.render_text(metrics.snapshot())
+        self.assert_('# TYPE genrepo_requests_total counter' in text)
+        self.assert_('# HELP genrepo_request_seconds ' in text)
+        self.assert_('genrepo_requests_total{view="file:view",status="2xx"} 2\n' in text)
+        # buckets are cumulative
+        self.assert_('genrepo_request_seconds_bucket{view="file:view",le="0.01"} 0\n' in text)
+        self.assert_('genrepo_request_seconds_bucket{view="file:view",le="0.025"} 1\n' in text)
+        self.assert_('genrepo_request_seconds_bucket{view="file:view",le="5"} 2\n' in text)
+        self.assert_('genrepo_request_seconds_bucket{view="file:view",le="+Inf"} 3\n' in text)
+        self.assert_('genrepo_request_seconds_count{view="file:view"} 3\n' in text)
+        self.assert_('genrepo_request_seconds_sum{view="file:view"} 103.02\n' in text)
+        self.assert_('genrepo_cache_requests_total{cache="summary",result="miss"} 3\n' in text)
+
+    def test_finished_threads(self):
+        def record():
+            metrics.increment('genrepo_ingest_files_total')
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+        metrics.increment('genrepo_ingest_files_total')
+        key = ('genrepo_ingest_files_total', ())
+        self.assertEqual(2, metrics.snapshot()['counters'][key])
+        # counts from the finished thread are kept once it is forgotten
+        self.assertEqual(1, len(metrics._stores))
+        self.assertEqual(2, metrics.snapshot()['counters'][key])
+
+    def test_middleware(self):
+        middleware = metrics.MetricsMiddleware()
+        request = Mock()
+        request.path_info = reverse('file:view', kwargs={'pid': 'test:1'})
+        response = Mock()
+        response.status_code = 200
+        middleware.process_request(request)
+        middleware.process_response(request, response)
+        request.path_info = '/no/such/page'
+        response.status_code = 404
+        middleware.process_request(request)
+        middleware.process_response(request, response)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(1, counters[('genrepo_requests_total',
+                                      (('view', 'file:view'), ('status', '2xx')))])
+        self.assertEqual(1, counters[('genrepo_requests_total',
+                                      (('view', 'unmatched'), ('status', '4xx')))])
+
+    def test_collect(self):
+        settings.METRICS_DIR = self.tmpdir
+        key = ('genrepo_ingest_bytes_total', ())
+        metrics.increment('genrepo_ingest_bytes_total', value=10)
+        # snapshots from a running process and one that has exited
+        running = metrics._empty()
+        running['counters'][key] = 100
+        metrics._write(os.path.join(self.tmpdir, 'process-%d.json' % os.getppid()),
+                       running, pid=os.getppid())
+        exited = metrics._empty()
+        exited['counters'][key] = 1000
+        dead_pid = 2 ** 22 + 1
+        metrics._write(os.path.join(self.tmpdir, 'process-%d.json' % dead_pid),
+                       exited, pid=dead_pid)
+        self.assertEqual(1110, metrics.collect()['counters'][key])
+        # exited process is folded into the retired totals
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'process-%d.json' % dead_pid)))
+        self.assert_(os.path.exists(os.path.join(self.tmpdir, metrics.RETIRED_NAME)))
+        self.assertEqual(1110, metrics.collect()['counters'][key])
+
+    def test_export(self):
+        request = Mock()
+        request.META = {'REMOTE_ADDR': '10.0.0.1'}
+        self.assertEqual(403, metrics.export(request).status_code)
+        request.META = {'REMOTE_ADDR': '127.0.0.1'}
+        metrics.increment('genrepo_ingest_files_total')
+        response = metrics.export(request)
+        self.assertEqual(200, response.status_code)
+        self.assert_('genrepo_ingest_files_total 1\n' in response.content)
+
+
+class LoadTestTest(TestCase):
+    # tests for deep zoom load testing in genrepo.loadtest
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(1, percentile(values, 0))
+        self.assertEqual(None, percentile([], 50))
+
+    def test_region_params(self):
+        # full resolution of a 6000x4000 image is level 13; djatoka level 6
+        params = region_params(6000, 4000, 13, 0, 0)
+        self.assertEqual('6', params['svc.level'])
+        self.assertEqual('0,0,257,257', params['svc.region'])
+        # tiles after the first overlap the previous one
+        self.assertEqual('255,255,258,258', region_params(6000, 4000, 13, 1, 1)['svc.region'])
+        # positions are in full resolution coordinates at lower levels
+        params = region_params(6000, 4000, 12, 1, 0)
+        self.assertEqual('5', params['svc.level'])
+        self.assertEqual('0,510,257,258', params['svc.region'])
+        # last tile is cut off at the edge of the image
+        self.assertEqual('0,5887,257,113', region_params(6000, 4000, 13, 23, 0)['svc.region'])
+
+    def test_deepzoom_session(self):
+        bursts = deepzoom_session(6000, 4000, actions=20, rng=random.Random(1))
+        # home view: the whole image fits in the viewport at level 10 (750x500)
+        self.assertEqual(6, len(bursts[0]))
+        self.assertEqual(set(['3']), set(p['svc.level'] for p in bursts[0]))
+        # tiles are only requested once per session
+        tiles = [(p['svc.level'], p['svc.region']) for burst in bursts for p in burst]
+        self.assertEqual(len(tiles), len(set(tiles)))
+        self.assert_(len(bursts) > 1)
+        # the same random sequence generates the same session
+        self.assertEqual(bursts, deepzoom_session(6000, 4000, actions=20, rng=random.Random(1)))
+
+    def test_stats(self):
+        stats = LoadStats()
+        for i in range(10):
+            stats.record('tile', i / 10.0, 200, 100, 'HIT' if i < 3 else 'MISS from proxy')
+        stats.record('tile', 5, 500)
+        stats.record('dzi', 0.1, 200)
+        stats.finish()
+        tiles = stats.summary('tile')
+        self.assertEqual(10, tiles['requests'])
+        self.assertEqual(1, tiles['errors'])
+        self.assertEqual(0.4, tiles['p50'])
+        self.assertEqual(0.9, tiles['p99'])
+        self.assertEqual(0.3, tiles['hit_ratio'])
+        self.assertEqual(1000, stats.bytes)
+        self.assertEqual(None, LoadStats().summary()['hit_ratio'])
+
+    def test_standin_server(self):
+        server = StandInServer(('127.0.0.1', 0), image_size=(300, 200),
+                               region_delay=0, tile_bytes=100)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base = 'http://127.0.0.1:%d/fedora/' % server.server_address[1]
+        try:
+            meta = json.loads(urllib2.urlopen(base +
+                'objects/img:1/methods/genrepo-demo:DjatokaImageService/getMetadata').read())
+            self.assertEqual('300', meta['width'])
+            tile = urllib2.urlopen(base + 'objects/img:1/methods/' +
+                'genrepo-demo:DjatokaImageService/getRegion?level=1').read()
+            self.assertEqual(100, len(tile))
+            # content models for the object type
+            repo = Repository(base)
+            cmodels = list(repo.risearch.get_objects('info:fedora/img:1',
+                                                     'info:fedora/fedora-system:def/model#hasModel'))
+            self.assertEqual(ImageObject, object_types.for_cmodels(cmodels))
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, base + 'describe')
+
+            stats = json.loads(urllib2.urlopen(base + 'standin-stats?reset=1').read())
+            self.assertEqual(4, stats['requests'])
+            self.assertEqual(0, stats['in_flight'])
+            self.assertEqual(1, stats['peak_in_flight'])
+            self.assertEqual(0, server.stats()['requests'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
 
 class FileViewsTest(TestCase):
     fixtures =  ['users']   # re-using collection users fixture & credentials
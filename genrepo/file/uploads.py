@@ -0,0 +1,224 @@
+# file genrepo/file/uploads.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Resumable uploads, for files too large to send reliably in a single
+request.
+
+A file is sent as a series of chunks, each appended to a file on local
+disk (in **UPLOAD_DIR**), and then committed, at which point it is
+ingested exactly as if it had been submitted through the ingest form.
+If the connection fails, the client asks how much has been received
+and continues from there.  The protocol:
+
+``POST`` to ``file:start-upload`` with ``collection``, ``filename``, ``size``
+and optionally ``md5``
+    start an upload; responds 201 with the *upload url* in the
+    ``Location`` header
+``GET`` *upload url*
+    current offset (number of bytes received) as JSON and in the
+    ``Upload-Offset`` header
+``PUT`` *upload url*, with the offset of the chunk in ``Upload-Offset``
+    append the request body; responds 409 with the current offset if the
+    chunk does not start where the previous one ended
+``POST`` *upload url* ``commit/``
+    ingest the completed file; responds 201 with the url of the new object
+``DELETE`` *upload url*
+    abandon the upload
+
+The MD5 checksum of the file is calculated as chunks arrive, so no
+extra pass over the file is needed at commit.  The checksum state is
+kept in memory; if a chunk is received by a different process than the
+one before it, the checksum of the data received so far is recalculated
+from disk first.
+
+Chunks and commits lock the upload's file, so chunks received at the
+same time are not interleaved and an upload committed twice at the same
+time (e.g., by a client retrying) is only ingested once.'''
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+from genrepo.file.fixity import CHUNK_SIZE
+
+# maximum number of uploads to keep checksum state for, per process
+MAX_DIGESTS = 100
+
+# upload id -> (number of bytes hashed, md5 object)
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+class OffsetMismatch(Exception):
+    '''A chunk does not start at the end of the data already received.
+
+    :param offset: current offset of the upload
+    '''
+    def __init__(self, offset):
+        super(OffsetMismatch, self).__init__('upload is at offset %d' % offset)
+        self.offset = offset
+
+class UploadTooLarge(Exception):
+    'A chunk would make the file larger than the size declared for the upload.'
+
+class UploadCommitted(Exception):
+    'The upload has already been committed (or abandoned) by another request.'
+
+
+def upload_dir():
+    '''Directory where partial uploads are stored (**UPLOAD_DIR**, by
+    default a subdirectory of the system temporary directory).'''
+    path = getattr(settings, 'UPLOAD_DIR', None) or \
+           os.path.join(tempfile.gettempdir(), 'genrepo-uploads')
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(path):
+                raise
+    return path
+
+def upload_path(upload):
+    'Path to the local file for a :class:`~genrepo.file.models.ResumableUpload`.'
+    return os.path.join(upload_dir(), 'upload-%d' % upload.pk)
+
+def current_offset(upload):
+    'Number of bytes of an upload received so far.'
+    try:
+        return os.path.getsize(upload_path(upload))
+    except OSError:
+        return 0
+
+
+@contextmanager
+def _locked(path):
+    # exclusive lock on the upload file, so that chunks for the same
+    # upload received at the same time are not interleaved
+    with open(path, 'ab') as upfile:
+        fcntl.flock(upfile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield upfile
+        finally:
+            fcntl.flock(upfile.fileno(), fcntl.LOCK_UN)
+
+@contextmanager
+def committing(upload):
+    '''Lock an upload while it is committed, so that it cannot be
+    committed again (or have chunks added) until the lock is released.
+    The upload should be removed with :func:`remove_upload` before then.
+
+    :returns: the upload file, open for reading
+    :raises: :class:`UploadCommitted` if the upload was removed, before
+        or while waiting for the lock
+    '''
+    path = upload_path(upload)
+    try:
+        upfile = open(path, 'rb')
+    except IOError:
+        raise UploadCommitted()
+    with upfile:
+        fcntl.flock(upfile.fileno(), fcntl.LOCK_EX)
+        try:
+            try:
+                current = os.path.samestat(os.fstat(upfile.fileno()), os.stat(path))
+            except OSError:
+                current = False
+            if not current:
+                raise UploadCommitted()
+            yield upfile
+        finally:
+            fcntl.flock(upfile.fileno(), fcntl.LOCK_UN)
+
+def _digest(upload, path, offset):
+    # md5 of the first offset bytes of the upload, using the in-memory
+    # state if it is current, or recalculating it from the file
+    with _digests_lock:
+        hashed, digest = _digests.get(upload.pk, (None, None))
+    if hashed != offset:
+        digest = hashlib.md5()
+        with open(path, 'rb') as upfile:
+            remaining = offset
+            while remaining:
+                chunk = upfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+    return digest
+
+def _remember(upload, offset, digest):
+    with _digests_lock:
+        if len(_digests) >= MAX_DIGESTS and upload.pk not in _digests:
+            _digests.clear()
+        _digests[upload.pk] = (offset, digest)
+
+def append_chunk(upload, offset, stream, length):
+    '''Append a chunk of data to an upload.
+
+    :param upload: :class:`~genrepo.file.models.ResumableUpload`
+    :param offset: position in the file where the chunk starts, which
+        must be the number of bytes already received
+    :param stream: file-like object to read the chunk from (e.g., the
+        request)
+    :param length: number of bytes to read from the stream
+    :returns: the new offset
+    :raises: :class:`OffsetMismatch`, :class:`UploadTooLarge`
+    '''
+    path = upload_path(upload)
+    with _locked(path) as upfile:
+        current = os.fstat(upfile.fileno()).st_size
+        if offset != current:
+            raise OffsetMismatch(current)
+        if current + length > upload.size:
+            raise UploadTooLarge('%d bytes would exceed the upload size of %d' % \
+                                 (current + length, upload.size))
+        digest = _digest(upload, path, current)
+        remaining = length
+        try:
+            while remaining:
+                chunk = stream.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                upfile.write(chunk)
+                digest.update(chunk)
+                remaining -= len(chunk)
+        finally:
+            # keep whatever was received, even if the connection failed
+            upfile.flush()
+            offset = current + length - remaining
+            _remember(upload, offset, digest)
+    return offset
+
+def upload_checksum(upload):
+    'MD5 checksum of the data received for an upload.'
+    path = upload_path(upload)
+    return _digest(upload, path, current_offset(upload)).hexdigest()
+
+def remove_upload(upload):
+    '''Remove the local file and checksum state for an upload (after it
+    has been committed or abandoned); the database record is not deleted.'''
+    with _digests_lock:
+        _digests.pop(upload.pk, None)
+    try:
+        os.remove(upload_path(upload))
+    except OSError:
+        pass
@@ -16,20 +16,23 @@
 
 from django.conf.urls.defaults import *
 
-from genrepo.file.models import FileObject
-
 urlpatterns = patterns('genrepo.file.views',
     url(r'^ingest/$', 'ingest_form', name='ingest'),
+    url(r'^upload/$', 'start_upload', name='start-upload'),
+    url(r'^upload/(?P<id>\d+)/$', 'upload_chunk', name='upload'),
+    url(r'^upload/(?P<id>\d+)/commit/$', 'commit_upload', name='commit-upload'),
+    url(r'^(?P<pid>[^/]+)/(?P<dsid>(DC|RELS-EXT))/$', 'raw_datastream', name='raw-ds'),
     url(r'^(?P<pid>[^/]+)/$', 'view_metadata', name='view'),
     url(r'^(?P<pid>[^/]+)/edit/$', 'edit_metadata', name='edit'),
     url(r'^(?P<pid>[^/]+)/master/$', 'download_file', name='download'),
+    url(r'^(?P<pid>[^/]+)/stream/$', 'stream_access_copy', name='stream'),
+    url(r'^(?P<pid>[^/]+)/poster/$', 'poster', name='poster'),
+    url(r'^(?P<pid>[^/]+)/waveform/$', 'waveform', name='waveform'),
     url(r'^(?P<pid>[^/]+)/preview/$', 'preview', name='preview'),
     url(r'^(?P<pid>[^/]+)/dzi/$', 'image_dzi', name='dzi'),
     url(r'^(?P<pid>[^/]+)/image-region/$', 'image_region', name='image-region'),
-)
-
-# use eulfedora view for raw datastream access
-urlpatterns += patterns('eulfedora.views',
-    url(r'^(?P<pid>[^/]+)/(?P<dsid>(DC|RELS-EXT))/$', 'raw_datastream',
-        {'type': FileObject}, name='raw-ds'),
+    url(r'^(?P<pid>[^/]+)/iiif/$', 'iiif_base', name='iiif'),
+    url(r'^(?P<pid>[^/]+)/iiif/info\.json$', 'iiif_info', name='iiif-info'),
+    url(r'^(?P<pid>[^/]+)/iiif/(?P<region>[^/]+)/(?P<size>[^/]+)/(?P<rotation>[^/]+)/'
+        r'(?P<quality>[^/.]+)\.(?P<format>[^/.]+)$', 'iiif_image', name='iiif-image'),
 )
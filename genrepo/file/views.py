@@ -14,25 +14,45 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import magic
+import json
+import os
+import time
+from urllib import urlencode
+
 from rdflib import URIRef
 
 from django.conf import settings
 from django.contrib import messages
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponse
-from django.shortcuts import render
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, \
+     HttpResponseRedirect
+from django.shortcuts import render, get_object_or_404
 
 from eulcommon.djangoextras.auth.decorators import permission_required_with_403
 from eulcommon.djangoextras.http import HttpResponseSeeOtherRedirect
 from eulfedora.models import DigitalObjectSaveFailure
 from eulfedora.rdfns import relsext
-from eulfedora.server import Repository
-from eulfedora.views import raw_datastream
+from genrepo.fedora import Repository
+from eulfedora import views as fedora_views
 from eulfedora.util import RequestFailed, PermissionDenied
 
-from genrepo.file.forms import IngestForm, DublinCoreEditForm
-from genrepo.file.models import FileObject, ImageObject, object_type_from_mimetype, init_by_cmodel
+from genrepo.admission import admission_control
+from genrepo.cache import cache_key, request_identity, PUBLIC
+from genrepo.file.derivatives import queue_derivatives
+from genrepo.file.fixity import file_checksum
+from genrepo.file.iiif import IIIFError, image_identity, image_info, image_request, \
+     info_json, FORMATS
+from genrepo.file.forms import IngestForm, DublinCoreEditForm, UploadForm
+from genrepo.file.mime import detect_mimetype
+from genrepo.file.models import FileObject, ImageObject, ResumableUpload, \
+     object_type_from_mimetype, init_by_cmodel
+from genrepo.file.streaming import stream_datastream
+from genrepo.metrics import cache_result, increment
+from genrepo.file.uploads import OffsetMismatch, UploadTooLarge, UploadCommitted, \
+     append_chunk, committing, current_offset, remove_upload, upload_checksum, upload_path
+from genrepo.singleflight import single_flight
+from genrepo.summary import get_summary
 
 @permission_required_with_403('file.add_file')
 def ingest_form(request):
@@ -42,26 +62,8 @@ def ingest_form(request):
     if request.method == 'POST':
         form = IngestForm(request.POST, request.FILES)
         if form.is_valid():
-            # use mime magic to determine type of object to create
-            m = magic.Magic(mime=True)
-            mimetype = m.from_file(request.FILES['file'].temporary_file_path())
-            objtype = object_type_from_mimetype(mimetype)
-            # initialize a connection to the repository and create a new object
-            repo = Repository(request=request)
-            fobj = repo.get_object(type=objtype)
-            # set file mimetype in dc:format
-            # TODO: file checksum?
-            st = (fobj.uriref, relsext.isMemberOfCollection, 
-                  URIRef(form.cleaned_data['collection']))
-            fobj.rels_ext.content.add(st)
-            fobj.master.content = request.FILES['file']
-            fobj.master.mimetype = mimetype
-            # pre-populate the object label and dc:title with the uploaded filename
-            fobj.label = fobj.dc.content.title = request.FILES['file'].name
-            # also use the original filename as the file datastream label
-            fobj.master.label = request.FILES['file'].name
-            fobj.save('ingesting user content')
-
+            fobj = _ingest_file(request, request.FILES['file'], request.FILES['file'].name,
+                                form.cleaned_data['collection'])
             messages.success(request, 'Successfully ingested <a href="%s"><b>%s</b></a>' % \
                              (reverse('file:view', args=[fobj.pid]), fobj.pid))
             return HttpResponseSeeOtherRedirect(reverse('site-index'))
@@ -74,6 +76,139 @@ def ingest_form(request):
         form = IngestForm(initial=initial_data)
     return render(request, 'file/ingest.html', {'form': form})
 
+def _ingest_file(request, fileobj, filename, collection, checksum=None):
+    '''Create a new object for an uploaded file, as the appropriate type
+    for the file's mimetype, in the specified collection.  If the MD5
+    checksum of the file is not specified, it is calculated.'''
+    # use mime magic and the filename to determine type of object to create
+    mimetype = detect_mimetype(fileobj, filename)
+    objtype = object_type_from_mimetype(mimetype)
+    # initialize a connection to the repository and create a new object
+    repo = Repository(request=request)
+    fobj = repo.get_object(type=objtype)
+    # set file mimetype in dc:format
+    st = (fobj.uriref, relsext.isMemberOfCollection, URIRef(collection))
+    fobj.rels_ext.content.add(st)
+    fobj.master.content = fileobj
+    fobj.master.mimetype = mimetype
+    # checksum the upload, so Fedora can verify the content it receives
+    # and fixity audits have a stored value to check against
+    fobj.master.checksum = checksum or file_checksum(fileobj)
+    # pre-populate the object label and dc:title with the uploaded filename
+    fobj.label = fobj.dc.content.title = filename
+    # also use the original filename as the file datastream label
+    fobj.master.label = filename
+    started = time.time()
+    fobj.save('ingesting user content')
+    size = getattr(fileobj, 'size', None)
+    if size is None:
+        size = os.fstat(fileobj.fileno()).st_size
+    increment('genrepo_ingest_files_total')
+    increment('genrepo_ingest_bytes_total', value=size)
+    increment('genrepo_ingest_seconds_total', value=time.time() - started)
+    # generate web copies etc. in the background
+    queue_derivatives(fobj)
+    return fobj
+
+def _json_response(data, status=200):
+    return HttpResponse(json.dumps(data), mimetype='application/json', status=status)
+
+def _upload_status(upload, status=200):
+    offset = current_offset(upload)
+    response = _json_response({'id': upload.pk, 'offset': offset, 'size': upload.size},
+                              status)
+    response['Upload-Offset'] = offset
+    return response
+
+@permission_required_with_403('file.add_file')
+def start_upload(request):
+    '''Start a resumable upload (see :mod:`genrepo.file.uploads` for
+    the protocol).  On a valid POST, responds with status 201 and the
+    url for the new upload.'''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    form = UploadForm(request.POST)
+    if not form.is_valid():
+        return _json_response({'errors': form.errors}, status=400)
+    upload = ResumableUpload.objects.create(user=request.user,
+        collection=form.cleaned_data['collection'],
+        filename=form.cleaned_data['filename'], size=form.cleaned_data['size'],
+        checksum=(form.cleaned_data['md5'] or '').lower())
+    # create the (empty) local file, so the upload directory is checked now
+    open(upload_path(upload), 'ab').close()
+    response = _upload_status(upload, status=201)
+    response['Location'] = reverse('file:upload', args=[upload.pk])
+    return response
+
+@permission_required_with_403('file.add_file')
+def upload_chunk(request, id):
+    '''A resumable upload: GET (or HEAD) for the offset to continue from,
+    PUT to append a chunk starting at the offset in the ``Upload-Offset``
+    header, DELETE to abandon the upload.'''
+    upload = get_object_or_404(ResumableUpload, pk=id, user=request.user)
+    if request.method in ('GET', 'HEAD'):
+        return _upload_status(upload)
+
+    elif request.method == 'PUT':
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (KeyError, ValueError):
+            return _json_response({'error': 'Upload-Offset and Content-Length are required'},
+                                  status=400)
+        try:
+            append_chunk(upload, offset, request, length)
+        except OffsetMismatch:
+            return _upload_status(upload, status=409)
+        except UploadTooLarge as err:
+            return _json_response({'error': str(err)}, status=413)
+        # record the activity, so the upload isn't expired
+        upload.save()
+        return _upload_status(upload)
+
+    elif request.method == 'DELETE':
+        remove_upload(upload)
+        upload.delete()
+        return HttpResponse(status=204)
+
+    return HttpResponseNotAllowed(['GET', 'HEAD', 'PUT', 'DELETE'])
+
+@permission_required_with_403('file.add_file')
+def commit_upload(request, id):
+    '''Ingest the file for a completed resumable upload, as for the
+    ingest form.  Responds with status 201 and the url of the new object.'''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    upload = get_object_or_404(ResumableUpload, pk=id, user=request.user)
+    try:
+        # only one request at a time can commit the upload
+        with committing(upload) as fileobj:
+            if current_offset(upload) != upload.size:
+                return _upload_status(upload, status=409)
+            checksum = upload_checksum(upload)
+            if upload.checksum and upload.checksum != checksum:
+                return _json_response({'error': 'Checksum mismatch: received %s, expected %s' % \
+                                       (checksum, upload.checksum)}, status=400)
+            try:
+                fobj = _ingest_file(request, fileobj, upload.filename, upload.collection,
+                                    checksum)
+            except (DigitalObjectSaveFailure, RequestFailed) as rf:
+                # leave the upload in place, so the commit can be retried
+                if isinstance(rf, PermissionDenied):
+                    msg = 'You don\'t have permission to create objects in the repository.'
+                else:
+                    msg = 'There was an error communicating with the repository.'
+                return _json_response({'error': msg}, status=getattr(rf, 'code', 500))
+            remove_upload(upload)
+            upload.delete()
+    except UploadCommitted:
+        # committed by another request in the meantime
+        raise Http404
+    url = reverse('file:view', args=[fobj.pid])
+    response = _json_response({'pid': fobj.pid, 'url': url}, status=201)
+    response['Location'] = url
+    return response
+
 @permission_required_with_403('file.change_file')
 def edit_metadata(request, pid):
     """View to edit the metadata for an existing
@@ -145,40 +280,120 @@ EXTRA_ENV = {
 }
 
 def view_metadata(request, pid):
-    # init the appropriate type (image, file) according to the cmodel
-    obj = init_by_cmodel(pid, request)
+    # display from the cached object summary, which is generated from
+    # the appropriate type (image, file) according to the cmodel
+    obj = get_summary(pid, request)
     # if the object doesn't exist or user doesn't have sufficient
     # permissions to know that it exists, 404
-    if not obj.exists:
+    if obj is None:
         raise Http404 
 
-    template = getattr(obj, 'view_template', 'file/view.html')
+    template = obj.view_template or 'file/view.html'
     env = EXTRA_ENV.copy()
     env.update(obj=obj)
     return render(request, template, env)
 
+# Image views are often requested by many viewers at once (e.g., when an
+# image is shared widely); identical requests made at the same time with
+# the same access share a single call to fedora (see genrepo.singleflight)
+
+def _preview_image(request, pid):
+    data, url = init_by_cmodel(pid, request).get_preview_image()
+    return data
+
+@admission_control('image')
 def preview(request, pid):
     # image preview of an object
     # currently only supported for image objects
-    obj = init_by_cmodel(pid, request)
-    return HttpResponse(obj.get_preview_image(), mimetype='image/jpeg')
+    key = cache_key('preview', pid, request_identity(request))
+    return HttpResponse(single_flight(key, _preview_image, request, pid),
+                        mimetype='image/jpeg')
     # TODO: error handling, unit tests...
 
+def _dzi(request, pid):
+    img = init_by_cmodel(pid, request=request)
+    return img.deepzoom_info().serialize(pretty=True)
+
 def image_dzi(request, pid):
     # DZI xml image information  required by SeaDragon for deepzom
     # should be one of the image cmodels
-    img = init_by_cmodel(pid, request=request)
-    return HttpResponse(img.deepzoom_info().serialize(pretty=True), mimetype='text/xml')
+    key = cache_key('dzi', pid, request_identity(request))
+    return HttpResponse(single_flight(key, _dzi, request, pid), mimetype='text/xml')
     # TODO: error handling, unit tests...
 
+def _region(request, pid, params):
+    data, url = init_by_cmodel(pid, request).get_region(params)
+    return data
+
+@admission_control('image')
 def image_region(request, pid):
     # expose djatoka getRegion method for use in seadragon deep zoom functionality
-    img = init_by_cmodel(pid, request)
     # convert svc.param format used by djatoka to param format used by fedora disseminator
     params = dict((k.replace('svc.', ''),v) for k,v in request.GET.iteritems())
-    return HttpResponse(img.get_region(params), mimetype='image/jpeg')
+    key = cache_key('region', pid, '%s %s' % (request_identity(request),
+                                               urlencode(sorted(params.items()))))
+    return HttpResponse(single_flight(key, _region, request, pid, params),
+                        mimetype='image/jpeg')
     # TODO: error handling, unit tests...
 
+def _iiif_response(response, public):
+    # IIIF viewers are often on other sites
+    response['Access-Control-Allow-Origin'] = '*'
+    if public:
+        response['Cache-Control'] = 'public, max-age=%d' % \
+            getattr(settings, 'IIIF_MAX_AGE', 24 * 60 * 60)
+    return response
+
+def iiif_base(request, pid):
+    # the base IIIF url for an image redirects to its image information
+    return HttpResponseSeeOtherRedirect(reverse('file:iiif-info', kwargs={'pid': pid}))
+
+def iiif_info(request, pid):
+    '''IIIF Image API information (``info.json``) for an
+    :class:`~genrepo.file.models.ImageObject`.'''
+    summary = get_summary(pid, request)
+    info = image_info(summary, request) if summary is not None else None
+    if info is None:
+        raise Http404
+    base = request.build_absolute_uri(reverse('file:iiif', kwargs={'pid': pid})).rstrip('/')
+    data = info_json(info, base)
+    response = HttpResponse(json.dumps(data), mimetype='application/json')
+    response['Link'] = '<%s>;rel="profile"' % data['profile'][0]
+    return _iiif_response(response, image_identity(summary, request) == PUBLIC)
+
+def _iiif_image(request, pid, params, key):
+    data, url = init_by_cmodel(pid, request).get_region(params)
+    if len(data) <= getattr(settings, 'IIIF_CACHE_MAX_SIZE', 256 * 1024):
+        cache.set(key, data, getattr(settings, 'IIIF_CACHE_TIMEOUT', 60 * 60))
+    return data
+
+@admission_control('image')
+def iiif_image(request, pid, region, size, rotation, quality, format):
+    '''IIIF Image API image request for an
+    :class:`~genrepo.file.models.ImageObject`, served by Djatoka.
+    Requests are normalized, so equivalent requests share a single
+    cached copy, keyed on the canonical form of the request.'''
+    summary = get_summary(pid, request)
+    info = image_info(summary, request) if summary is not None else None
+    if info is None:
+        raise Http404
+    try:
+        canonical, params = image_request(info, region, size, rotation, quality, format)
+    except IIIFError as err:
+        return HttpResponse(str(err), mimetype='text/plain', status=err.status)
+
+    identity = image_identity(summary, request)
+    key = cache_key('iiif', pid, '%s %s' % (identity, canonical))
+    data = cache.get(key)
+    cache_result('iiif', data is not None)
+    if data is None:
+        data = single_flight(key, _iiif_image, request, pid, params, key)
+    response = HttpResponse(data, mimetype=FORMATS[format])
+    response['Link'] = '<%s>;rel="canonical"' % request.build_absolute_uri(
+        reverse('file:iiif', kwargs={'pid': pid}) + canonical)
+    return _iiif_response(response, identity == PUBLIC)
+
+@admission_control('download')
 def download_file(request, pid):
     '''Download the master file datastream associated with a
     :class:`~genrepo.file.models.FileObject`'''
@@ -190,5 +405,47 @@ def download_file(request, pid):
     } 
     # use generic raw datastream view from eulcore
     # - use the datastream id and digital object type returned by cmodel init
-    return raw_datastream(request, pid, obj.master.id, type=obj.__class__,
-                          repo=repo, headers=extra_headers)
+    return fedora_views.raw_datastream(request, pid, obj.master.id, type=obj.__class__,
+                                       repo=repo, headers=extra_headers)
+
+def stream_access_copy(request, pid):
+    '''Stream the web-friendly copy of a file (e.g., the H.264 version
+    of a video), for playback in the browser.  Supports byte-range
+    requests, so players can seek without downloading the whole file.'''
+    obj = init_by_cmodel(pid, request)
+    try:
+        ds = obj.access_copy
+        if not ds.exists:
+            raise Http404
+        return stream_datastream(request, obj, ds)
+    except PermissionDenied:
+        # don't reveal that restricted objects exist
+        raise Http404
+    except RequestFailed as rf:
+        if rf.code == 404:
+            raise Http404
+        raise
+
+def _derivative(request, pid, name):
+    # serve a derivative datastream, for types of object that have it
+    repo = Repository(request=request)
+    obj = init_by_cmodel(pid, repo=repo)
+    ds = getattr(obj, name, None)
+    if ds is None:
+        raise Http404
+    return fedora_views.raw_datastream(request, pid, ds.id, type=obj.__class__,
+                                       repo=repo)
+
+def poster(request, pid):
+    '''Still image to display for a video before it is played.'''
+    return _derivative(request, pid, 'poster')
+
+def waveform(request, pid):
+    '''Precomputed waveform peaks (JSON) for an audio file.'''
+    return _derivative(request, pid, 'waveform')
+
+def raw_datastream(request, pid, dsid):
+    '''Access raw DC or RELS-EXT datastream content for a
+    :class:`~genrepo.file.models.FileObject` .'''
+    # use generic raw datastream view from eulfedora
+    return fedora_views.raw_datastream(request, pid, dsid, type=FileObject)
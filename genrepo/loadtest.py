@@ -0,0 +1,471 @@
+# file genrepo/loadtest.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Load testing with simulated deep zoom viewing sessions.
+
+Seadragon requests image tiles in bursts: everything visible at the
+home view when an image is opened, then the newly visible tiles at the
+next level each time the viewer zooms in or pans.  :func:`deepzoom_session`
+generates a plausible sequence of such bursts for an image, and
+:class:`DeepZoomLoad` replays sessions from a number of simultaneous
+viewers against a running site, the way browsers would (several
+persistent connections per viewer, pauses between actions, tiles
+already loaded in the session not requested again), collecting
+:class:`LoadStats`.
+
+:class:`StandInServer` answers the requests the site makes to Fedora
+and Djatoka for deep zoom images, with a configurable delay for each
+tile, so the site can be tested without a real repository.  It also
+counts how many requests it is handling at once, which shows how many
+site workers are busy waiting on the backend.'''
+
+import BaseHTTPServer
+from collections import defaultdict
+import httplib
+import json
+import math
+import Queue
+import random
+import re
+import SocketServer
+import threading
+import time
+from urllib import urlencode
+from urlparse import urlparse, parse_qs
+
+from eulxml.xmlmap import load_xmlobject_from_string
+
+from genrepo.collection.models import AccessibleObject
+from genrepo.file.models import DziImage
+
+# deep zoom tile size and overlap, as generated by ImageObject.deepzoom_info
+TILE_SIZE = 256
+TILE_OVERLAP = 1
+# number of resolution levels djatoka provides below the full image
+DJATOKA_LEVELS = 6
+
+
+def percentile(values, pct):
+    'Value at the specified percentile of a sorted list (nearest rank), or None if empty.'
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def max_level(width, height):
+    'Highest deep zoom level (full resolution) for an image of the specified size.'
+    return int(math.ceil(math.log(max(width, height, 1), 2)))
+
+def home_level(width, height, viewport):
+    'Deep zoom level at which the whole image fits in the viewport.'
+    top = max_level(width, height)
+    level = top
+    while level > 0 and (width * 2 ** (level - top) > viewport[0] or
+                         height * 2 ** (level - top) > viewport[1]):
+        level -= 1
+    return level
+
+def visible_tiles(width, height, level, center, viewport, tilesize=TILE_SIZE):
+    '''Tiles at a deep zoom level that are visible in a viewport
+    centered on the specified point (in full resolution coordinates),
+    closest to the center first, as Seadragon requests them.
+
+    :returns: list of (column, row)
+    '''
+    scale = 2.0 ** (level - max_level(width, height))
+    level_size = (int(math.ceil(width * scale)), int(math.ceil(height * scale)))
+    ranges = []
+    for axis in (0, 1):
+        middle = center[axis] * scale
+        start = max(0, middle - viewport[axis] / 2.0)
+        end = min(level_size[axis], middle + viewport[axis] / 2.0)
+        ranges.append(range(int(start // tilesize), int(max(start, end - 1) // tilesize) + 1))
+    middle = (center[0] * scale / tilesize, center[1] * scale / tilesize)
+    tiles = [(col, row) for col in ranges[0] for row in ranges[1]]
+    tiles.sort(key=lambda t: (t[0] + 0.5 - middle[0]) ** 2 + (t[1] + 0.5 - middle[1]) ** 2)
+    return tiles
+
+def region_params(width, height, level, col, row, tilesize=TILE_SIZE,
+                  overlap=TILE_OVERLAP, levels=DJATOKA_LEVELS):
+    '''Djatoka getRegion parameters for a deep zoom tile, in the form the
+    Seadragon viewer sends them to the image region view.  The region
+    position is in full resolution coordinates and its size in pixels
+    at the requested level.'''
+    top = max_level(width, height)
+    scale = 2.0 ** (level - top)
+    level_size = (int(math.ceil(width * scale)), int(math.ceil(height * scale)))
+    region = []
+    for index, size in ((row, level_size[1]), (col, level_size[0])):
+        start = index * tilesize - (overlap if index else 0)
+        end = min((index + 1) * tilesize + overlap, size)
+        region.append((int(start / scale), end - start))
+    return {
+        'svc.format': 'image/jpeg',
+        'svc.rotate': '0',
+        'svc.level': str(level - (top - levels)),
+        'svc.region': '%d,%d,%d,%d' % (region[0][0], region[1][0], region[0][1], region[1][1]),
+    }
+
+def deepzoom_session(width, height, actions=12, viewport=(1024, 768),
+                     levels=DJATOKA_LEVELS, rng=random):
+    '''Generate the tile requests for one simulated viewing session:
+    the home view, followed by a series of zooms and pans (mostly
+    zooming in on a detail and looking around it, as people do).  Tiles
+    are only requested the first time they are visible in a session,
+    since the browser keeps them.
+
+    :returns: list of bursts, each a list of getRegion parameter dictionaries
+    '''
+    top = max_level(width, height)
+    lowest = max(top - levels, 0)
+    level = max(home_level(width, height, viewport), lowest)
+    home = level
+    center = [width / 2.0, height / 2.0]
+    seen = set()
+    bursts = []
+    for step in xrange(actions + 1):
+        if step:
+            scale = 2.0 ** (level - top)
+            choice = rng.random()
+            if choice < 0.5 and level < top:
+                # zoom in on something near the middle of the view
+                for axis in (0, 1):
+                    center[axis] += rng.uniform(-0.25, 0.25) * viewport[axis] / scale
+                level += 1
+            elif choice < 0.8 or level <= home:
+                for axis in (0, 1):
+                    center[axis] += rng.uniform(-0.5, 0.5) * viewport[axis] / scale
+            else:
+                level -= 1
+            center = [min(max(center[0], 0), width), min(max(center[1], 0), height)]
+        burst = []
+        for col, row in visible_tiles(width, height, level, center, viewport):
+            if (level, col, row) not in seen:
+                seen.add((level, col, row))
+                burst.append(region_params(width, height, level, col, row, levels=levels))
+        if burst:
+            bursts.append(burst)
+    return bursts
+
+
+class LoadStats(object):
+    '''Thread-safe collection of response times, by kind of request
+    (e.g., ``tile`` or ``dzi``), with the cache status reported by any
+    cache in front of the site in the ``X-Cache`` response header.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.cache = defaultdict(int)
+        self.bytes = 0
+        self.start = time.time()
+        self.end = None
+
+    def record(self, kind, latency, status, size=0, cache_status=None):
+        with self._lock:
+            if status == 200:
+                self.latencies[kind].append(latency)
+                self.bytes += size
+            else:
+                self.errors[kind] += 1
+            if cache_status:
+                self.cache['hit' if 'HIT' in cache_status.upper() else 'miss'] += 1
+
+    def finish(self):
+        self.end = time.time()
+
+    def summary(self, kind='tile'):
+        '''Summary for one kind of request, as a dictionary with
+        ``requests``, ``errors``, ``per_second``, ``p50``, ``p95``,
+        ``p99`` and ``max`` (in seconds), and ``hit_ratio`` (None if no
+        responses reported a cache status).'''
+        with self._lock:
+            times = sorted(self.latencies[kind])
+            errors = self.errors[kind]
+            cached = self.cache['hit'] + self.cache['miss']
+            hit_ratio = float(self.cache['hit']) / cached if cached else None
+        elapsed = (self.end or time.time()) - self.start
+        return {
+            'requests': len(times), 'errors': errors,
+            'per_second': len(times) / elapsed if elapsed else 0.0,
+            'p50': percentile(times, 50), 'p95': percentile(times, 95),
+            'p99': percentile(times, 99), 'max': times[-1] if times else None,
+            'hit_ratio': hit_ratio,
+        }
+
+
+class _Connection(object):
+    # persistent http connection to the site, like a browser keeps;
+    # reconnects if the server closes it
+    def __init__(self, host, port, timeout):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.conn = None
+
+    def get(self, path):
+        '''Request a path and read the response.
+
+        :returns: tuple of status, body, and ``X-Cache`` header (or None)
+        '''
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request('GET', path)
+                response = self.conn.getresponse()
+                body = response.read()
+                if response.getheader('connection', '').lower() == 'close':
+                    self.close()
+                return response.status, body, response.getheader('x-cache')
+            except (httplib.HTTPException, IOError):
+                self.close()
+                # a persistent connection may have been closed by the server
+                # while idle; only give up if a fresh connection fails too
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class DeepZoomLoad(object):
+    '''Simulated deep zoom viewers for a running site.
+
+    :param base_url: url of the site (e.g., ``http://localhost:8000/``)
+    :param pids: pids of the images to view; each session picks one at random
+    :param connections: connections each viewer uses at once to load a
+        burst of tiles (browsers use about 6 per host)
+    :param think_time: average pause between viewer actions, in seconds
+    :param actions: number of zooms and pans per session
+    :param timeout: socket timeout for each request, in seconds
+    '''
+
+    def __init__(self, base_url, pids, connections=6, think_time=1.0, actions=12,
+                 timeout=60, seed=None):
+        url = urlparse(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.prefix = url.path.rstrip('/')
+        self.pids = list(pids)
+        self.connections = connections
+        self.think_time = think_time
+        self.actions = actions
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def dzi_path(self, pid):
+        return '%s/files/%s/dzi/' % (self.prefix, pid)
+
+    def region_path(self, pid, params):
+        return '%s/files/%s/image-region/?%s' % (self.prefix, pid, urlencode(sorted(params.items())))
+
+    def _fetch(self, conn, kind, path, stats):
+        start = time.time()
+        try:
+            status, body, cache_status = conn.get(path)
+        except (httplib.HTTPException, IOError):
+            status, body, cache_status = None, '', None
+        stats.record(kind, time.time() - start, status, len(body), cache_status)
+        return status, body
+
+    def _burst(self, conns, pid, burst, stats):
+        # load a burst of tiles using all of the viewer's connections at once
+        tiles = Queue.Queue()
+        for params in burst:
+            tiles.put(params)
+        def load(conn):
+            while True:
+                try:
+                    params = tiles.get_nowait()
+                except Queue.Empty:
+                    return
+                self._fetch(conn, 'tile', self.region_path(pid, params), stats)
+        threads = [threading.Thread(target=load, args=(conn,))
+                   for conn in conns[:len(burst)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def session(self, stats, deadline, conns):
+        'Run one viewing session, stopping early at the deadline.'
+        with self._rng_lock:
+            pid = self.rng.choice(self.pids)
+            rng = random.Random(self.rng.random())
+        status, body = self._fetch(conns[0], 'dzi', self.dzi_path(pid), stats)
+        if status != 200:
+            return
+        dzi = load_xmlobject_from_string(body, DziImage)
+        for burst in deepzoom_session(dzi.width, dzi.height, self.actions, rng=rng):
+            if time.time() >= deadline:
+                return
+            self._burst(conns, pid, burst, stats)
+            time.sleep(self.think_time * rng.uniform(0.5, 1.5))
+
+    def run(self, viewers, duration):
+        '''Run sessions from the specified number of simultaneous viewers
+        for the specified number of seconds.
+
+        :returns: :class:`LoadStats`
+        '''
+        stats = LoadStats()
+        deadline = time.time() + duration
+        def viewer():
+            conns = [_Connection(self.host, self.port, self.timeout)
+                     for i in xrange(self.connections)]
+            try:
+                while time.time() < deadline:
+                    self.session(stats, deadline, conns)
+            finally:
+                for conn in conns:
+                    conn.close()
+        threads = [threading.Thread(target=viewer) for i in xrange(viewers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats.finish()
+        return stats
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers the Fedora and Djatoka requests the site makes for deep
+    zoom images: every pid is an image of the server's configured size.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    region_re = re.compile(r'/objects/([^/]+)/methods/[^/]+/(getRegion|getMetadata)$')
+    profile_re = re.compile(r'/objects/([^/]+)$')
+    spo_re = re.compile(r'^<(info:fedora/[^>]+)> <[^>]*hasModel> \*$')
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        args = dict((k, v[0]) for k, v in parse_qs(url.query).iteritems())
+        if url.path.endswith('/standin-stats'):
+            # not counted in the statistics
+            return self._send(json.dumps(server.stats(reset='reset' in args)),
+                              'application/json')
+        server.started()
+        start = time.time()
+        try:
+            match = self.region_re.search(url.path)
+            if match and match.group(2) == 'getMetadata':
+                return self._send(json.dumps({
+                    'identifier': match.group(1), 'imagefile': match.group(1),
+                    'width': str(server.image_size[0]), 'height': str(server.image_size[1]),
+                    'dwtLevels': str(DJATOKA_LEVELS), 'levels': str(DJATOKA_LEVELS),
+                    'compositingLayerCount': '1'}), 'application/json')
+            if match:
+                # decoding time varies; model it as the configured delay +/- 50%
+                time.sleep(server.region_delay * random.uniform(0.5, 1.5))
+                return self._send(server.tile, 'image/jpeg')
+            if url.path.endswith('/risearch'):
+                match = self.spo_re.match(args.get('query', ''))
+                triples = ''
+                if match:
+                    for cmodel in ('info:fedora/genrepo-demo:Image-1.0',
+                                   AccessibleObject.PUBLIC_ACCESS_CMODEL):
+                        triples += '<%s> <info:fedora/fedora-system:def/model#hasModel> <%s> .\n' % \
+                                   (match.group(1), cmodel)
+                return self._send(triples, 'text/plain')
+            match = self.profile_re.search(url.path)
+            if match:
+                return self._send(PROFILE_TEMPLATE % {'pid': match.group(1)}, 'text/xml')
+            self._send('Not Found', 'text/plain', 404)
+        finally:
+            server.finished(time.time() - start)
+
+    def _send(self, body, mimetype, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', mimetype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+PROFILE_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<objectProfile xmlns="http://www.fedora.info/definitions/1/0/access/" pid="%(pid)s">
+<objLabel>Load test image %(pid)s</objLabel><objOwnerId>genrepo</objOwnerId>
+<objCreateDate>2011-01-01T00:00:00.000Z</objCreateDate>
+<objLastModDate>2011-01-01T00:00:00.000Z</objLastModDate>
+<objState>A</objState></objectProfile>'''
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Threaded stand-in for Fedora with the Djatoka image service.
+
+    :param address: (host, port) to listen on
+    :param image_size: (width, height) reported for every image
+    :param region_delay: average time to generate a tile, in seconds
+    :param tile_bytes: size of the tile returned for every region
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, image_size=(6000, 4000), region_delay=0.05,
+                 tile_bytes=12 * 1024, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandInHandler)
+        self.image_size = image_size
+        self.region_delay = region_delay
+        # not a valid image, but the site only passes it along
+        self.tile = '\xff\xd8\xff\xe0' + '\0' * max(tile_bytes - 6, 0) + '\xff\xd9'
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.busy_time = 0.0
+        self.since = time.time()
+
+    def started(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def finished(self, elapsed):
+        with self._lock:
+            self.in_flight -= 1
+            self.busy_time += elapsed
+
+    def stats(self, reset=False):
+        '''Requests handled since the last reset, with the current and
+        peak number handled at once, and the average number handled at
+        once (total time spent handling requests over elapsed time).'''
+        with self._lock:
+            elapsed = time.time() - self.since
+            stats = {'requests': self.requests, 'in_flight': self.in_flight,
+                     'peak_in_flight': self.peak_in_flight,
+                     'mean_in_flight': self.busy_time / elapsed if elapsed else 0.0,
+                     'seconds': elapsed}
+            if reset:
+                # requests already in progress are still in progress
+                in_flight = self.in_flight
+                self._reset()
+                self.in_flight = self.peak_in_flight = in_flight
+        return stats
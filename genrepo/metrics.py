@@ -0,0 +1,394 @@
+# file genrepo/metrics.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Application metrics, served in the Prometheus text format by
+:func:`export`, so that slow responses can be traced to the site
+itself, Fedora, the Resource Index or Djatoka.
+
+:class:`MetricsMiddleware` records the time taken by each request, by
+url name (e.g., ``file:view``); :class:`genrepo.fedora.ResilientConnection`
+records the time taken by each Fedora request, by kind of operation
+(see :func:`genrepo.fedora.operation`; Djatoka requests are
+disseminations), along with retries, hedged reads and circuit breaker
+states; ingest and the shared cache record bytes ingested and cache
+hits and misses.
+
+Recording a value never waits on a lock: each thread records into its
+own counters, which are only read to take a snapshot.  If
+**METRICS_DIR** is set, each process writes a snapshot of its metrics
+there every **METRICS_FLUSH_INTERVAL** seconds (default 10), from a
+background thread, and :func:`export` adds up the snapshots of all the
+processes (those of processes that have exited are kept, so counters
+do not go backwards).  Without it, only the metrics of the process
+handling the request are reported.'''
+
+from bisect import bisect_left
+import atexit
+import errno
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from urlparse import urlsplit
+
+from django.conf import settings
+from django.core.urlresolvers import resolve
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# type and description of each metric
+METRICS = {
+    'genrepo_requests_total': ('counter',
+        'Requests handled, by url name and status class.'),
+    'genrepo_request_seconds': ('histogram',
+        'Time to handle requests, until the response is returned (not including '
+        'streamed content), by url name.'),
+    'genrepo_upstream_request_seconds': ('histogram',
+        'Time for Fedora to respond to requests, by server and kind of operation.'),
+    'genrepo_fedora_events_total': ('counter',
+        'Fedora requests, errors, retries, short-circuited requests and hedged reads, '
+        'by server and kind of operation.'),
+    'genrepo_fedora_breaker_open': ('gauge',
+        'Number of processes with the circuit breaker open, by server and kind of '
+        'operation.'),
+    'genrepo_cache_requests_total': ('counter',
+        'Cache lookups, by cache and result (hit or miss).'),
+    'genrepo_ingest_files_total': ('counter', 'Files ingested.'),
+    'genrepo_ingest_bytes_total': ('counter', 'Bytes of files ingested.'),
+    'genrepo_ingest_seconds_total': ('counter',
+        'Time spent sending ingested files to Fedora.'),
+}
+
+SNAPSHOT_PREFIX = 'process-'
+RETIRED_NAME = 'retired.json'
+
+
+def _empty():
+    return {'counters': {}, 'histograms': {}, 'gauges': {}}
+
+# metrics recorded by the current thread
+_local = threading.local()
+# (thread, metrics) for every thread that has recorded something
+_stores = []
+# metrics recorded by threads that have finished
+_retired = _empty()
+_lock = threading.Lock()
+# process the snapshot thread was started in
+_process = None
+
+
+def _store():
+    store = getattr(_local, 'store', None)
+    if store is None:
+        store = _local.store = _empty()
+        with _lock:
+            _stores.append((threading.current_thread(), store))
+    return store
+
+def increment(name, labels=(), value=1):
+    '''Add to a counter.
+
+    :param labels: tuple of (label, value) pairs, always in the same order
+    '''
+    counters = _store()['counters']
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+def observe(name, value, labels=()):
+    'Record a value (e.g., a time in seconds) in a histogram.'
+    histograms = _store()['histograms']
+    key = (name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+        # count in each bucket, the count above the last bucket, and the sum
+        histogram = histograms[key] = [0] * (len(BUCKETS) + 2)
+    histogram[bisect_left(BUCKETS, value)] += 1
+    histogram[-1] += value
+
+def cache_result(cache, hit, count=1):
+    'Record hits or misses for a cache.'
+    increment('genrepo_cache_requests_total',
+              (('cache', cache), ('result', 'hit' if hit else 'miss')), count)
+
+
+def _merge(target, source):
+    for key, value in source['counters'].iteritems():
+        target['counters'][key] = target['counters'].get(key, 0) + value
+    for key, histogram in source['histograms'].iteritems():
+        current = target['histograms'].get(key)
+        if current is None:
+            target['histograms'][key] = list(histogram)
+        else:
+            for i, value in enumerate(histogram):
+                current[i] += value
+    for key, value in source.get('gauges', {}).iteritems():
+        target['gauges'][key] = target['gauges'].get(key, 0) + value
+
+def _copy(store):
+    # copying a dict is atomic, so this is safe while the thread records more
+    return {'counters': dict(store['counters']),
+            'histograms': dict((key, list(histogram)) for key, histogram
+                               in dict(store['histograms']).iteritems())}
+
+def _fedora_gauges():
+    # import here to avoid a circular import
+    from genrepo.fedora import metrics as fedora_metrics
+    gauges = {}
+    def add(backend, operations):
+        for op, counts in operations.iteritems():
+            if op != 'replicas' and 'breaker' in counts:
+                gauges[('genrepo_fedora_breaker_open', (('backend', backend), ('operation', op)))] = \
+                    int(counts['breaker']['state'] == 'open')
+    current = fedora_metrics()
+    add(urlsplit(settings.FEDORA_ROOT).netloc, current)
+    for url, status in current.get('replicas', {}).iteritems():
+        add(urlsplit(url).netloc, status['operations'])
+    return gauges
+
+def snapshot():
+    '''Metrics recorded by this process, as a dictionary of
+    ``counters``, ``histograms`` and ``gauges``, each keyed on (name,
+    labels).'''
+    total = _empty()
+    with _lock:
+        live = []
+        for thread, store in _stores:
+            if thread.is_alive():
+                live.append((thread, store))
+                _merge(total, _copy(store))
+            else:
+                _merge(_retired, _copy(store))
+        _stores[:] = live
+        _merge(total, _retired)
+    total['gauges'] = _fedora_gauges()
+    return total
+
+
+def _reset():
+    # discard metrics inherited from a parent process
+    global _local, _retired
+    with _lock:
+        del _stores[:]
+        _retired = _empty()
+        _local = threading.local()
+
+def _snapshot_dir():
+    return getattr(settings, 'METRICS_DIR', None)
+
+def _to_json(metrics):
+    return dict((kind, [[name, labels, value] for (name, labels), value in values.iteritems()])
+                for kind, values in metrics.iteritems())
+
+def _from_json(data):
+    return dict((kind, dict(((name, tuple(tuple(label) for label in labels)), value)
+                            for name, labels, value in data.get(kind, [])))
+                for kind in ('counters', 'histograms', 'gauges'))
+
+def _write(path, metrics, **extra):
+    data = _to_json(metrics)
+    data.update(extra)
+    tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.tmp-', delete=False)
+    try:
+        json.dump(data, tmp)
+        tmp.close()
+        os.rename(tmp.name, path)
+    except:
+        tmp.close()
+        os.remove(tmp.name)
+        raise
+
+def write_snapshot():
+    'Write the metrics of this process to **METRICS_DIR**.'
+    directory = _snapshot_dir()
+    if directory:
+        _write(os.path.join(directory, '%s%d.json' % (SNAPSHOT_PREFIX, os.getpid())),
+               snapshot(), pid=os.getpid())
+
+def _write_snapshots():
+    interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot()
+        except Exception:
+            logger.exception('Failed to write metrics snapshot')
+
+def start_snapshots():
+    '''Start writing snapshots of this process's metrics, if configured
+    and not already started; also discards metrics inherited from the
+    parent, in a forked process.  Called by :class:`MetricsMiddleware`.'''
+    global _process
+    pid = os.getpid()
+    if _process == pid:
+        return
+    with _lock:
+        if _process == pid:
+            return
+        forked = _process is not None
+        _process = pid
+    if forked:
+        _reset()
+    if _snapshot_dir():
+        thread = threading.Thread(target=_write_snapshots)
+        thread.daemon = True
+        thread.start()
+
+@atexit.register
+def _write_final_snapshot():
+    if _process == os.getpid():
+        try:
+            write_snapshot()
+        except Exception:
+            pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+def collect():
+    '''Metrics for all processes: this process, the snapshots written by
+    other running processes, and the totals of processes that have
+    exited (which are folded into a single file when found).'''
+    total = snapshot()
+    directory = _snapshot_dir()
+    if not directory or not os.path.isdir(directory):
+        return total
+    own = '%s%d.json' % (SNAPSHOT_PREFIX, os.getpid())
+    with open(os.path.join(directory, '.lock'), 'a') as lockfile:
+        # only needed to combine the snapshots of exited processes
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        retired_path = os.path.join(directory, RETIRED_NAME)
+        retired = _empty()
+        if os.path.exists(retired_path):
+            with open(retired_path) as retired_file:
+                retired = _from_json(json.load(retired_file))
+        changed = False
+        for name in sorted(os.listdir(directory)):
+            if not name.startswith(SNAPSHOT_PREFIX) or name == own:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                with open(path) as snapshot_file:
+                    data = json.load(snapshot_file)
+            except (IOError, ValueError):
+                continue
+            metrics = _from_json(data)
+            if data.get('pid') and _alive(data['pid']):
+                _merge(total, metrics)
+            else:
+                # gauges describe running processes only
+                metrics['gauges'] = {}
+                _merge(retired, metrics)
+                os.remove(path)
+                changed = True
+        if changed:
+            _write(retired_path, retired)
+    _merge(total, retired)
+    return total
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def render_text(metrics):
+    'Format metrics (as returned by :func:`collect`) in the Prometheus text format.'
+    series = {}
+    for kind in ('counters', 'histograms', 'gauges'):
+        for (name, labels), value in metrics[kind].iteritems():
+            series.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in sorted(series):
+        kind, description = METRICS.get(name, ('untyped', None))
+        if description:
+            lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in sorted(series[name], key=lambda item: item[0]):
+            if kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, _labels(labels, [('le', bound)]),
+                                                     cumulative))
+                lines.append('%s_sum%s %s' % (name, _labels(labels), _number(value[-1])))
+                lines.append('%s_count%s %d' % (name, _labels(labels), cumulative))
+            else:
+                lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+    return '\n'.join(lines) + '\n'
+
+def export(request):
+    '''Metrics for all processes, in the Prometheus text format; only
+    available to addresses listed in **METRICS_ALLOWED_IPS** (default:
+    localhost).'''
+    if request.META.get('REMOTE_ADDR') not in \
+           getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1',)):
+        return HttpResponseForbidden()
+    return HttpResponse(render_text(collect()),
+                        mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def url_name(path):
+    '''Name of the url pattern a path matches, with its namespace (e.g.,
+    ``file:view``), to label request metrics.'''
+    try:
+        match = resolve(path)
+    except Http404:
+        return 'unmatched'
+    if match.url_name:
+        if match.namespace:
+            return '%s:%s' % (match.namespace, match.url_name)
+        return match.url_name
+    return '%s.%s' % (match.func.__module__, getattr(match.func, '__name__', 'view'))
+
+
+class MetricsMiddleware(object):
+    '''Record the number of requests and the time taken to handle them,
+    by url name.  Should be first in **MIDDLEWARE_CLASSES**, so that the
+    time taken by other middleware is included.'''
+
+    def process_request(self, request):
+        start_snapshots()
+        request._metrics_start = time.time()
+
+    def process_response(self, request, response):
+        started = getattr(request, '_metrics_start', None)
+        if started is not None:
+            view = url_name(request.path_info)
+            observe('genrepo_request_seconds', time.time() - started, (('view', view),))
+            increment('genrepo_requests_total',
+                      (('view', view), ('status', '%dxx' % (response.status_code // 100))))
+        return response
@@ -0,0 +1,156 @@
+# file genrepo/pids.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Pids reserved in advance for new objects.
+
+Fedora assigns pids for new objects one request at a time.  A
+:class:`PidPool` reserves them in blocks of **PID_POOL_SIZE** with a
+single getNextPID request, hands them out locally, and reserves the next
+block in the background when it runs low, so creating an object does
+not wait on Fedora for a pid.
+
+Fedora never hands out a reserved pid again, so every process can
+safely keep its own pool; pids still unused when a process exits are
+simply skipped.  A pool inherited by a forked process is discarded, so
+the parent and child never use the same pids.'''
+
+from collections import deque
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from eulfedora.util import parse_xml_object
+from eulfedora.xml import NewPids
+
+logger = logging.getLogger(__name__)
+
+# seconds after which a background refill that has not finished is
+# assumed stuck, and another may be started
+REFILL_TIMEOUT = 60
+
+
+def reserve_pids(api, count, namespace=None):
+    '''Reserve the specified number of pids with a single Fedora request.
+
+    :param api: :class:`~eulfedora.api.REST_API` to use
+    :returns: list of pids
+    '''
+    data, url = api.getNextPID(numPIDs=count, namespace=namespace)
+    return parse_xml_object(NewPids, data, url).pids
+
+
+class PidPool(object):
+    '''Thread-safe pool of reserved pids, by pid namespace.
+
+    :param size: number of pids to reserve at a time; defaults to
+        **PID_POOL_SIZE** (20).  With a size of 1, every pid is requested
+        from Fedora when it is needed, as without a pool.
+    '''
+
+    def __init__(self, size=None):
+        self._size = size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pids = {}
+        # namespace -> time a background refill started
+        self._refilling = {}
+        self._owner = os.getpid()
+
+    @property
+    def size(self):
+        if self._size is not None:
+            return self._size
+        return getattr(settings, 'PID_POOL_SIZE', 20)
+
+    def _pool(self, namespace):
+        # pids for a namespace; must be called with the lock held
+        if os.getpid() != self._owner:
+            # pids reserved by the parent process are the parent's to use
+            self._reset()
+        return self._pids.setdefault(namespace, deque())
+
+    def next_pid(self, api, namespace=None):
+        '''Get a pid for a new object, reserving more from Fedora if
+        the pool for the namespace is empty or running low.
+
+        :param api: :class:`~eulfedora.api.ApiFacade` of the new object,
+            whose credentials are used to reserve pids
+        '''
+        size = self.size
+        if size <= 1:
+            return reserve_pids(api, 1, namespace)[0]
+
+        with self._lock:
+            pids = self._pool(namespace)
+            pid = pids.popleft() if pids else None
+            refill = pid is not None and len(pids) < max(size // 4, 1) and \
+                     time.time() - self._refilling.get(namespace, 0) > REFILL_TIMEOUT
+            if refill:
+                self._refilling[namespace] = time.time()
+
+        if pid is None:
+            # nothing reserved yet (or the background refill has not kept
+            # up): reserve a block now, and keep the rest of it
+            block = reserve_pids(api, size, namespace)
+            pid = block.pop(0)
+            self._add(namespace, block)
+        elif refill:
+            # eulfedora connections are per thread, so the object's api
+            # (and its timeouts and circuit breaker) can be used from another
+            thread = threading.Thread(target=self._refill,
+                                      args=(api, namespace, size))
+            thread.daemon = True
+            thread.start()
+        return pid
+
+    def _add(self, namespace, pids):
+        with self._lock:
+            self._pool(namespace).extend(pids)
+
+    def _refill(self, api, namespace, size):
+        try:
+            self._add(namespace, reserve_pids(api, size, namespace))
+        except Exception as err:
+            # not fatal (including timeouts); the pool will be refilled
+            # when it is next needed
+            logger.warn('Could not reserve pids in %s: %s' % (namespace, err))
+        finally:
+            with self._lock:
+                self._refilling.pop(namespace, None)
+
+    def available(self, namespace=None):
+        'Number of reserved pids available in a namespace.'
+        with self._lock:
+            return len(self._pool(namespace))
+
+    def clear(self):
+        'Discard all reserved pids.'
+        with self._lock:
+            self._reset()
+
+# pool shared by all new objects in this process
+pid_pool = PidPool()
+
+def next_pid(obj):
+    '''Pid for a new :class:`~eulfedora.models.DigitalObject`, in its
+    ``default_pidspace``, from the shared pool; intended for use as
+    ``get_default_pid``.'''
+    return pid_pool.next_pid(obj.api, obj.default_pidspace)
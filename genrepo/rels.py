@@ -0,0 +1,139 @@
+# file genrepo/rels.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Lightweight, read-only access to the RELS-EXT relationships used by
+genrepo.
+
+Loading RELS-EXT through :mod:`eulfedora` parses it into a full
+:class:`rdflib.Graph`, which is far more than is needed to read the few
+relationships the site displays.  :class:`RelsExt` holds just those
+values; it is filled in by stream-parsing the RDF/XML, or from the
+rdflib graph when that has already been loaded (e.g., because the
+object is being edited).'''
+
+from cStringIO import StringIO
+
+from lxml import etree
+
+from eulfedora.rdfns import model, oai, relsext
+from eulfedora.util import RequestFailed
+
+RELS_EXT_ID = 'RELS-EXT'
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+_RDF_RESOURCE = '{%s}resource' % RDF_NS
+
+# predicates that are read, and the RelsExt attribute each is stored in;
+# relations to other objects are stored as pids
+_PREDICATES = {
+    str(relsext.isMemberOfCollection): 'collection',
+    str(relsext.isSubsetOf): 'parent',
+    str(oai.itemID): 'oai_id',
+    str(oai.setSpec): 'oai_set',
+    str(oai.setName): 'oai_setlabel',
+    str(model.hasModel): 'cmodels',
+}
+_OBJECT_FIELDS = ('collection', 'parent')
+
+
+def _pid(uri):
+    return uri.replace('info:fedora/', '')
+
+class RelsExt(object):
+    '''The RELS-EXT values genrepo uses for an object.  Repeated
+    relationships are only supported for content models, which are
+    stored as a tuple of URIs.'''
+    __slots__ = ('collection', 'parent', 'oai_id', 'oai_set', 'oai_setlabel', 'cmodels')
+
+    def __init__(self):
+        self.collection = self.parent = None
+        self.oai_id = self.oai_set = self.oai_setlabel = None
+        self.cmodels = ()
+
+    def _add(self, field, value):
+        if field == 'cmodels':
+            self.cmodels += (value,)
+        elif field in _OBJECT_FIELDS:
+            setattr(self, field, _pid(value))
+        else:
+            setattr(self, field, value)
+
+
+def parse_rels_ext(data):
+    '''Read a :class:`RelsExt` from RDF/XML content, without building
+    an RDF graph.'''
+    rels = RelsExt()
+    for event, element in etree.iterparse(StringIO(data), events=('end',)):
+        if element.tag[0] == '{':
+            ns, name = element.tag[1:].split('}', 1)
+            field = _PREDICATES.get(ns + name)
+            if field is not None:
+                rels._add(field, element.get(_RDF_RESOURCE) or element.text or '')
+        element.clear()
+    return rels
+
+def graph_rels_ext(graph, subject):
+    'Read a :class:`RelsExt` from an already loaded :class:`rdflib.Graph`.'
+    rels = RelsExt()
+    for predicate, obj in graph.predicate_objects(subject):
+        field = _PREDICATES.get(str(predicate))
+        if field is not None:
+            rels._add(field, unicode(obj))
+    return rels
+
+
+class RelsExtReader(object):
+    '''Mixin for :class:`~eulfedora.models.DigitalObject` classes that
+    provides :attr:`rels` for reading RELS-EXT values cheaply.  Changes
+    are still made through the rdflib graph in ``rels_ext.content``;
+    once that has been loaded, :attr:`rels` is read from the graph so
+    that unsaved changes are included.'''
+
+    _rels = None
+
+    def _graph_loaded(self):
+        # use the graph if it has been loaded or the object is new; check
+        # the datastream cache directly, since initializing the datastream
+        # requires a request to Fedora for the list of datastreams
+        ds = self.dscache.get(RELS_EXT_ID, None)
+        return self._create or (ds is not None and ds._content is not None)
+
+    @property
+    def rels(self):
+        ':class:`RelsExt` for the current object'
+        if self._graph_loaded():
+            return graph_rels_ext(self.rels_ext.content, self.uriref)
+        if self._rels is None:
+            try:
+                data, url = self.api.getDatastreamDissemination(self.pid, RELS_EXT_ID)
+                self._rels = parse_rels_ext(data)
+            except RequestFailed:
+                # no RELS-EXT, or not accessible
+                if RELS_EXT_ID in self.ds_list:
+                    raise
+                self._rels = RelsExt()
+        return self._rels
+
+    def save(self, logMessage=None):
+        # keep the values that are saved: eulfedora discards the graph
+        # when an object is ingested, and values read before any changes
+        # would otherwise be used once it is
+        if self._graph_loaded():
+            saved = graph_rels_ext(self.rels_ext.content, self.uriref)
+        else:
+            saved = self._rels
+        result = super(RelsExtReader, self).save(logMessage)
+        self._rels = saved
+        return result
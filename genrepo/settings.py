@@ -61,11 +61,14 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'genrepo.metrics.MetricsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'genrepo.fedora.ReadRoutingMiddleware',
+    'genrepo.fedora.BackendUnavailableMiddleware',
 )
 
 ROOT_URLCONF = 'genrepo.urls'
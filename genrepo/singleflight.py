@@ -0,0 +1,130 @@
+# file genrepo/singleflight.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Coalescing of concurrent identical requests to Fedora.
+
+When many people view the same image at once, the site receives many
+identical requests for the same tiles at the same moment.  With
+:func:`single_flight`, only the first of them calls Fedora; the others
+wait for that call to finish and share its result (or its exception).
+
+Within a process this always applies.  If **SINGLE_FLIGHT_TIMEOUT** is
+set, it also applies across processes: the first process takes a lock in
+the shared cache, and the others wait up to that many seconds for the
+result to appear in the cache (for **SINGLE_FLIGHT_RESULT_TIMEOUT**
+seconds, default 5), calling Fedora themselves if it does not.
+
+Keys must identify everything that affects the result, including the
+credentials the call is made with (see :func:`genrepo.cache.cache_key`).'''
+
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# how often to check for a result from another process, in seconds
+POLL_INTERVAL = 0.025
+
+
+class _Call(object):
+    # a call in progress, and its outcome
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    'Group of calls, by key, of which only one per key runs at a time.'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        '''Call a function, unless a call with the same key is already in
+        progress in this process, in which case wait for it and return
+        its result (or raise its exception) instead.'''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = _shared(key, func, args, kwargs)
+            return call.result
+        except Exception:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        'Number of calls currently in progress.'
+        with self._lock:
+            return len(self._calls)
+
+
+def _shared(key, func, args, kwargs):
+    # run a call, coordinating with other processes through the cache if configured
+    timeout = getattr(settings, 'SINGLE_FLIGHT_TIMEOUT', 0)
+    if not timeout:
+        return func(*args, **kwargs)
+
+    lock_key = '%s:lock' % key
+    result_key = '%s:result' % key
+    found = cache.get(result_key)
+    if found is not None:
+        return found[0]
+    if not cache.add(lock_key, 1, timeout):
+        # another process is making the call; wait for its result
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            found = cache.get_many([result_key, lock_key])
+            if result_key in found:
+                return found[result_key][0]
+            if lock_key not in found:
+                # the other call failed; make the call here instead
+                break
+    try:
+        result = func(*args, **kwargs)
+        # wrapped, so that a result of None can be distinguished from a miss
+        cache.set(result_key, (result,),
+                  getattr(settings, 'SINGLE_FLIGHT_RESULT_TIMEOUT', 5))
+        return result
+    finally:
+        cache.delete(lock_key)
+
+
+# calls shared by all requests in this process
+_group = SingleFlight()
+
+def single_flight(key, func, *args, **kwargs):
+    '''Call ``func(*args, **kwargs)``, sharing the result with any
+    identical calls (with the same key) made at the same time.  Results
+    shared between processes must be picklable.'''
+    return _group.do(key, func, *args, **kwargs)
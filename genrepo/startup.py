@@ -0,0 +1,136 @@
+# file genrepo/startup.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Application startup: import timing and process warm-up.
+
+:func:`warm_up` is intended to be called from the WSGI script, so that
+the expensive one-time work of a new process (importing and resolving
+every view, loading XML schemas and vocabularies, connecting to Fedora)
+happens before the process starts taking requests instead of during
+the first few.'''
+
+import __builtin__
+import logging
+import sys
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ImportTimer(object):
+    '''Context manager that records how long each module takes to
+    import for the first time.  Times are inclusive, i.e. they include
+    the time spent importing any modules it imports in turn.
+
+    Example use::
+
+        with ImportTimer() as timer:
+            import genrepo.urls
+        for module, seconds in timer.slowest(10):
+            print module, seconds
+    '''
+
+    def __init__(self):
+        self.times = {}
+
+    def __enter__(self):
+        self._import = __builtin__.__import__
+        def timed_import(name, *args, **kwargs):
+            # only time the first import of a module; later imports are free
+            if name in sys.modules or name in self.times:
+                return self._import(name, *args, **kwargs)
+            start = time.time()
+            try:
+                return self._import(name, *args, **kwargs)
+            finally:
+                if name in sys.modules:
+                    self.times[name] = time.time() - start
+        __builtin__.__import__ = timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self._import
+
+    def slowest(self, count=None):
+        'List of (module, seconds) tuples, slowest first.'
+        times = sorted(self.times.iteritems(), key=lambda t: t[1], reverse=True)
+        return times[:count] if count else times
+
+
+def load_views():
+    '''Import the url configuration and every view it references.'''
+    from django.core.urlresolvers import get_resolver
+    resolver = get_resolver(None)
+    # resolving by name imports every view module referenced in the urls
+    resolver.reverse_dict
+    for namespace in resolver.namespace_dict.values():
+        namespace[1].reverse_dict
+
+def load_libraries():
+    'Load libraries that are otherwise only loaded when first used.'
+    from genrepo.file.mime import get_magic
+    get_magic()
+
+def load_vocabularies():
+    'Load vocabularies used to build form choices.'
+    from genrepo.file.forms import dcmi_type_options
+    dcmi_type_options()
+
+def connect_fedora():
+    '''Open a connection to Fedora (connections are kept open and
+    reused by the Fedora API).'''
+    from genrepo.fedora import Repository
+    Repository().api.describeRepository()
+
+def load_collections():
+    'Cache summaries of all collections, as displayed to anonymous users.'
+    from genrepo.collection.models import CollectionObject
+    from genrepo.summary import get_summaries
+    get_summaries([coll.pid for coll in CollectionObject.all()])
+
+# warm-up steps, in order
+WARM_UP_STEPS = [
+    ('views', load_views),
+    ('libraries', load_libraries),
+    ('vocabularies', load_vocabularies),
+    ('fedora', connect_fedora),
+    ('collections', load_collections),
+]
+
+def warm_up():
+    '''Run all warm-up steps, logging how long each one took.  A
+    failing step is logged and does not prevent the others from
+    running or the process from starting.
+
+    :returns: list of (step name, seconds, error) tuples
+    '''
+    results = []
+    if not getattr(settings, 'STARTUP_WARM_UP', True):
+        return results
+    for name, step in WARM_UP_STEPS:
+        start = time.time()
+        error = None
+        try:
+            step()
+        except Exception as err:
+            error = err
+            logger.error('Startup warm-up step %s failed: %s' % (name, err))
+        elapsed = time.time() - start
+        logger.info('Startup warm-up step %s: %.3fs' % (name, elapsed))
+        results.append((name, elapsed, error))
+    return results
@@ -0,0 +1,232 @@
+# file genrepo/summary.py
+#
+#   Copyright 2011 Emory University Libraries
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Compact, cacheable summaries of Fedora objects.
+
+Display pages need the same handful of values for every object (label,
+dates, collection, master file type and size, Dublin Core).  Reading
+them from a :class:`~eulfedora.models.DigitalObject` costs several
+Fedora requests per object, so they are collected once into an
+:class:`ObjectSummary` and kept in the shared cache until the object is
+modified (see :mod:`genrepo.cache`).  Summaries of publicly accessible
+objects are cached once for all users; others are cached separately
+for each access class.'''
+
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from eulfedora.models import DigitalObject
+from genrepo.fedora import Repository
+from eulfedora.util import RequestFailed, PermissionDenied
+
+from genrepo.cache import cache_key, object_version, object_versions, \
+     request_identity, is_public, get_negative, get_negatives, set_negative, \
+     NOT_FOUND, DENIED, PUBLIC
+from genrepo.metrics import cache_result
+
+# single-valued and repeating dublin core fields included in summaries
+DC_FIELDS = ['title', 'date', 'description', 'type', 'format', 'identifier',
+             'language', 'publisher', 'rights', 'source']
+DC_LIST_FIELDS = ['creator', 'contributor', 'subject', 'coverage', 'relation']
+
+# cache key prefix for summaries; changed along with the fields of
+# ObjectSummary, so that summaries cached by an earlier version are not used
+SUMMARY_KEY = 'summary-2'
+
+
+class DublinCoreSummary(namedtuple('DublinCoreSummary',
+        DC_FIELDS + ['%s_list' % field for field in DC_LIST_FIELDS])):
+    '''Dublin Core values for an object; uses the same field names as
+    :class:`eulxml.xmlmap.dc.DublinCore`, with repeating fields as tuples.'''
+    __slots__ = ()
+
+class CollectionSummary(namedtuple('CollectionSummary', 'pid label version')):
+    '''Pid and label of the collection an object belongs to, with the
+    cache version of the collection the label was read from.'''
+    __slots__ = ()
+
+class ObjectSummary(namedtuple('ObjectSummary', 'pid label created modified cmodels '
+        'collection mimetype size access_mimetype has_preview view_template dc')):
+    '''Summary information for a single Fedora object; everything
+    needed to display the object in a list or on its view page.
+    ``mimetype`` and ``size`` are those of the master file, and
+    ``access_mimetype`` the type of the copy delivered to browsers (see
+    :attr:`~genrepo.file.models.FileObject.access_copy`).'''
+    __slots__ = ()
+
+    @property
+    def uri(self):
+        return 'info:fedora/%s' % self.pid
+
+    @property
+    def icon(self):
+        'Name of the icon for the type of object, based on its content models.'
+        from genrepo.file.models import object_types
+        return object_types.for_cmodels(self.cmodels).icon
+
+
+def summarize(obj):
+    '''Generate an :class:`ObjectSummary` for an existing
+    :class:`~eulfedora.models.DigitalObject` that supports
+    :class:`~genrepo.rels.RelsExtReader`.'''
+    cmodels = tuple(sorted(obj.rels.cmodels))
+
+    collection = None
+    collection_pid = obj.rels.collection
+    if collection_pid:
+        version = object_version(collection_pid)
+        try:
+            label = DigitalObject(obj.api, collection_pid).label
+        except RequestFailed:
+            # collection may not be accessible with the current credentials
+            label = None
+        collection = CollectionSummary(collection_pid, label, version)
+
+    mimetype = size = access_mimetype = None
+    master = getattr(obj, 'master', None)
+    if master is not None and master.exists:
+        mimetype, size = master.mimetype, master.size
+        access_mimetype = obj.access_copy.mimetype
+
+    dc = obj.dc.content
+    values = [getattr(dc, field) for field in DC_FIELDS] + \
+             [tuple(getattr(dc, '%s_list' % field)) for field in DC_LIST_FIELDS]
+
+    return ObjectSummary(obj.pid, obj.label, obj.created, obj.modified, cmodels,
+                         collection, mimetype, size, access_mimetype,
+                         getattr(obj, 'has_preview', False),
+                         getattr(obj, 'view_template', None),
+                         DublinCoreSummary(*values))
+
+
+def _is_current(summary, versions=None):
+    # a summary is out of date if the collection label it includes has
+    # changed; uses the collection version in versions, if specified
+    if summary.collection is None:
+        return True
+    pid = summary.collection.pid
+    version = versions[pid] if versions is not None else object_version(pid)
+    return summary.collection.version == version
+
+def _load(pid, request, repo, identity, version, objtype=None):
+    # retrieve an object and cache its summary; the object type is
+    # determined from its content models, if not specified
+    if objtype is None:
+        # import here to avoid a circular import with the object models
+        from genrepo.file.models import init_by_cmodel
+        obj = init_by_cmodel(pid, request=request, repo=repo)
+    else:
+        obj = repo.get_object(pid, type=objtype)
+    try:
+        obj.getProfile()
+    except PermissionDenied:
+        set_negative(pid, identity, DENIED)
+        return None
+    except RequestFailed as rf:
+        # only cache a definite not-found; other errors may be temporary
+        if rf.code == 404:
+            set_negative(pid, identity, NOT_FOUND)
+        return None
+    summary = summarize(obj)
+    # summaries of public objects are the same for everyone; collections
+    # always have the public access content model, so the collection
+    # label is also safe to share
+    if is_public(summary.cmodels):
+        identity = PUBLIC
+    cache.set(cache_key(SUMMARY_KEY, pid, identity, version), summary,
+              getattr(settings, 'OBJECT_SUMMARY_TIMEOUT', 15 * 60))
+    return summary
+
+def _keys(pid, identity, version):
+    # cache keys to check for a summary: the public partition first,
+    # then the partition for the current access class
+    return [cache_key(SUMMARY_KEY, pid, PUBLIC, version),
+            cache_key(SUMMARY_KEY, pid, identity, version)]
+
+def _cached(keys, found, versions=None):
+    for key in keys:
+        summary = found.get(key)
+        if summary is not None and _is_current(summary, versions):
+            return summary
+
+def get_summary(pid, request=None, repo=None):
+    '''Get the :class:`ObjectSummary` for a pid, from the cache if
+    possible.  Objects are retrieved using the credentials for the
+    specified request, or from the specified repository.
+
+    Objects that do not exist or are not accessible are remembered
+    briefly (see :func:`genrepo.cache.set_negative`), so repeated
+    requests for them do not go back to Fedora.
+
+    :returns: :class:`ObjectSummary`, or None if the object does not
+        exist or is not accessible
+    '''
+    identity = request_identity(request)
+    version = object_version(pid)
+    keys = _keys(pid, identity, version)
+    summary = _cached(keys, cache.get_many(keys))
+    cache_result('summary', summary is not None)
+    if summary is not None:
+        return summary
+    # skip objects that were recently not found or not accessible
+    if get_negative(pid, identity) is not None:
+        return None
+    return _load(pid, request, repo, identity, version)
+
+def get_summaries(pids, request=None, repo=None):
+    '''Get summaries for a list of pids (e.g., one page of a
+    collection), in order.  Everything that is already cached is
+    retrieved in a single request, and the types of any objects that
+    have to be loaded from Fedora are determined with a single Resource
+    Index query.  Objects that do not exist or are not accessible are
+    skipped.  The cache versions of the collections in the cached
+    summaries, and any negative results, are also checked a list at a
+    time.'''
+    pids = list(pids)
+    identity = request_identity(request)
+    versions = object_versions(pids)
+    keys = dict((pid, _keys(pid, identity, versions[pid])) for pid in pids)
+    cached = cache.get_many([key for pid in pids for key in keys[pid]])
+    collections = set(summary.collection.pid for summary in cached.itervalues()
+                      if summary.collection is not None)
+    collection_versions = object_versions(collections) if collections else {}
+
+    summaries = {}
+    for pid in pids:
+        summary = _cached(keys[pid], cached, collection_versions)
+        if summary is not None:
+            summaries[pid] = summary
+    uncached = [pid for pid in pids if pid not in summaries]
+    # skip objects that were recently not found or not accessible
+    negatives = get_negatives(uncached, identity, versions) if uncached else {}
+    missing = [pid for pid in uncached if pid not in negatives]
+
+    if summaries:
+        cache_result('summary', True, len(summaries))
+    if len(pids) > len(summaries):
+        cache_result('summary', False, len(pids) - len(summaries))
+    if missing:
+        if repo is None:
+            repo = Repository(request=request)
+        from genrepo.file.models import object_types
+        types = object_types.for_pids(missing, repo)
+        for pid in missing:
+            summaries[pid] = _load(pid, request, repo, identity, versions[pid],
+                                   types[pid])
+
+    return [summaries[pid] for pid in pids if summaries.get(pid) is not None]
@@ -34,6 +34,9 @@ urlpatterns = patterns('',
     # files
     url(r'^files/', include('genrepo.file.urls', namespace='file')),
 
+    # application metrics, for monitoring
+    url(r'^metrics$', 'genrepo.metrics.export', name='metrics'),
+
     # enable django db-admin
     (r'^db-admin/', include(admin.site.urls)),
 )
@@ -42,9 +45,14 @@ urlpatterns = patterns('',
 # serve out media in django runserver for development
 # DISABLE THIS IN PRODUCTION
 if settings.DEV_ENV:
+    from genrepo.file.sitemaps import sitemap_root
     urlpatterns += patterns('',
         (r'^static/(?P<path>.*)$', 'django.views.static.serve', {
             'document_root': settings.MEDIA_ROOT,
             }),
+        # sitemaps are served from the root of the site
+        (r'^(?P<path>sitemap[^/]*\.xml\.gz)$', 'django.views.static.serve', {
+            'document_root': sitemap_root(),
+            }),
     )
 
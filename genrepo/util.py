@@ -14,8 +14,14 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import csv
+from urllib import urlencode
+
 from eulfedora.util import RequestFailed
 
+# size of the read buffer used for streamed risearch responses
+READ_SIZE = 8 * 1024
+
 def accessible(olist):
     '''Iterate through an input object list, and yield only those that exist
     and don't throw Fedora exceptions.'''
@@ -25,3 +31,39 @@ def accessible(olist):
                 yield obj
         except RequestFailed:
             pass
+
+
+def _iter_lines(response):
+    # yield lines from an http response without reading it all at once
+    pending = ''
+    chunk = response.read(READ_SIZE)
+    while chunk:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+        chunk = response.read(READ_SIZE)
+    if pending:
+        yield pending
+
+def risearch_rows(repo, query):
+    '''Run a sparql query against the Fedora Resource Index and
+    generate each result row as a list of values, as they arrive,
+    without loading the full result set into memory.'''
+    url = 'risearch?' + urlencode({'type': 'tuples', 'lang': 'sparql',
+                                   'format': 'CSV', 'flush': 'false',
+                                   'query': query})
+    with repo.risearch.open('GET', url) as response:
+        lines = (line.strip() for line in _iter_lines(response))
+        rows = csv.reader(line for line in lines if line)
+        # first row is the csv header
+        next(rows, None)
+        for row in rows:
+            yield row
+
+def risearch_pids(repo, query):
+    '''Run a single-variable sparql query against the Fedora Resource
+    Index and generate the resulting pids as they arrive, without
+    loading the full result set into memory.'''
+    for row in risearch_rows(repo, query):
+        yield row[0].replace('info:fedora/', '')